@@ -11,6 +11,17 @@
 Receives an numpy array of fft data from lightshowpi and computes a
 running mean and standard deviation for each element in the array
 
+Stats weighs every sample since the show started equally, EwmaStats
+and WindowStats follow only the recent input.
+
+Every class works in preallocated buffers, push, mean and std allocate
+nothing once constructed.  mean and std return the same arrays on every
+call, copy them if they need to outlive the next push.  To keep it that
+way every operand of a numpy operation is an array of the same dtype:
+python numbers, and mixing float32 with float64, make numpy allocate
+temporary arrays.  Sample counts are python floats, which are recycled,
+a python int above 256 is a new object every time it is incremented.
+
 derived from the work of John D. Cook
 http://www.johndcook.com/blog/standard_deviation/
 
@@ -22,6 +33,11 @@ numpy: for calculation
 import numpy
 
 
+def _scalar(value, dtype='float32'):
+    """A 0-d array, an operand that numpy does not need to convert"""
+    return numpy.array(value, dtype=dtype)
+
+
 class Stats(object):
     def __init__(self, length):
         """Constructor
@@ -31,19 +47,25 @@ class Stats(object):
         """
         self.length = length
         self.empty = numpy.zeros(length, dtype='float32')
-        self.clear()
-        self.sample_count = 0
-        self.old_mean = self.empty
-        self.old_std = self.empty
-        self.new_mean = self.empty
-        self.new_std = self.empty
+
+        # updated in place, mean() and std() return the same buffers on every call
+        self.new_mean = numpy.zeros(length, dtype='float32')
+        self.new_std = numpy.zeros(length, dtype='float32')
+        self.new_variance = numpy.zeros(length, dtype='float32')
+        self.std_dev = numpy.zeros(length, dtype='float32')
+        self.delta = numpy.zeros(length, dtype='float32')
+        self.work = numpy.zeros(length, dtype='float32')
+        self.count = 0.0
+        self.divisor = _scalar(0)
+
+    @property
+    def sample_count(self):
+        return int(self.count)
 
     def clear(self):
-        self.sample_count = 0
-        self.old_mean = self.empty
-        self.old_std = self.empty
-        self.new_mean = self.empty
-        self.new_std = self.empty
+        self.count = 0.0
+        self.new_mean.fill(0)
+        self.new_std.fill(0)
 
     def preload(self, mean, std, sample_count=2):
         """Add a starting samples to the running standard deviation and mean
@@ -62,12 +84,9 @@ class Stats(object):
         """
         if len(mean) == self.length and len(
                 std) == self.length and sample_count > 1 and self.sample_count == 0:
-            # cast all arrays to numpy just to make sure the data type is correct
-            self.new_mean = numpy.array(mean, dtype='float32')
-            self.new_std = numpy.array(std, dtype='float32')
-            self.old_mean = numpy.array(mean, dtype='float32')
-            self.old_std = numpy.array(std, dtype='float32')
-            self.sample_count = sample_count
+            self.new_mean[:] = mean
+            self.new_std[:] = std
+            self.count = float(sample_count)
 
     def push(self, data):
         """Add a new sample to the running standard deviation and mean
@@ -76,19 +95,20 @@ class Stats(object):
         :param data: new sample data, this must be a numpy array 
         :type data: numpy array
         """
-        self.sample_count += 1
+        self.count += 1.0
 
-        if self.sample_count == 1:
-            self.old_mean = self.new_mean
-            self.new_mean = data
-            self.old_std = self.empty
+        if self.count == 1.0:
+            numpy.copyto(self.new_mean, data)
+            self.new_std.fill(0)
         else:
-            self.new_mean = self.old_mean + (data - self.old_mean) / self.sample_count
-            self.new_std = self.old_std + (data - self.old_mean) * (data - self.new_mean)
-
-            # set up for next iteration
-            self.old_mean = self.new_mean
-            self.old_std = self.new_std
+            # mean += (data - old_mean) / n, std += (data - old_mean) * (data - new_mean)
+            self.divisor.fill(self.count)
+            numpy.subtract(data, self.new_mean, self.delta)
+            numpy.divide(self.delta, self.divisor, self.work)
+            numpy.add(self.new_mean, self.work, self.new_mean)
+            numpy.subtract(data, self.new_mean, self.work)
+            numpy.multiply(self.work, self.delta, self.work)
+            numpy.add(self.new_std, self.work, self.new_std)
 
     def num_data_values(self):
         """Get the current number of observations in the sample
@@ -112,8 +132,9 @@ class Stats(object):
         :return: current variance
         :rtype: numpy array
         """
-        if self.sample_count > 1:
-            return self.new_std / (self.sample_count - 1.0)
+        if self.count > 1.0:
+            self.divisor.fill(self.count - 1.0)
+            return numpy.divide(self.new_std, self.divisor, self.new_variance)
         else:
             return self.empty
 
@@ -123,4 +144,286 @@ class Stats(object):
         :return: current standard deviation
         :rtype: numpy array
         """
-        return numpy.sqrt(self.variance())
+        return numpy.sqrt(self.variance(), self.std_dev)
+
+
+class EwmaStats(object):
+    """Exponentially weighted mean and standard deviation
+
+    Each new sample counts for a fixed fraction of the result and older
+    samples fade out, so unlike Stats the result keeps following the
+    input however long the show runs.
+    """
+
+    def __init__(self, length, samples):
+        """Constructor
+
+        :param length: the length of the matrix
+        :type length: int
+        :param samples: time constant, the number of samples it takes an old
+                        sample's weight to fall to 1/e
+        :type samples: float
+        """
+        self.length = length
+        alpha = 1.0 - numpy.exp(-1.0 / max(samples, 1.0))
+        self.alpha = _scalar(alpha)
+        self.keep = _scalar(1.0 - alpha)
+        self.new_mean = numpy.zeros(length, dtype='float32')
+        self.new_variance = numpy.zeros(length, dtype='float32')
+        self.new_std = numpy.zeros(length, dtype='float32')
+        self.delta = numpy.zeros(length, dtype='float32')
+        self.work = numpy.zeros(length, dtype='float32')
+        self.count = 0.0
+
+    @property
+    def sample_count(self):
+        return int(self.count)
+
+    def clear(self):
+        self.count = 0.0
+        self.new_mean.fill(0)
+        self.new_variance.fill(0)
+
+    def preload(self, mean, std, sample_count=2):
+        """Add a starting mean and standard deviation
+
+        See Stats.preload, sample_count is only recorded.
+
+        :param mean: new sample mean starting point
+        :type mean: numpy array
+        :param std: new sample standard deviation starting point
+        :type std: numpy array
+        :param sample_count: how many samples to start with (min 2)
+        :type sample_count: int
+        """
+        if len(mean) == self.length and len(
+                std) == self.length and sample_count > 1 and self.sample_count == 0:
+            self.new_mean[:] = mean
+            self.new_variance[:] = numpy.square(std)
+            self.count = float(sample_count)
+
+    def push(self, data):
+        """Add a new sample to the weighted standard deviation and mean
+
+        :param data: new sample data, this must be a numpy array
+        :type data: numpy array
+        """
+        self.count += 1.0
+
+        if self.count == 1.0:
+            numpy.copyto(self.new_mean, data)
+            return
+
+        # mean += alpha * delta, variance = (1 - alpha) * (variance + alpha * delta ** 2)
+        numpy.subtract(data, self.new_mean, self.delta)
+        numpy.multiply(self.delta, self.alpha, self.work)
+        numpy.add(self.new_mean, self.work, self.new_mean)
+        numpy.multiply(self.work, self.delta, self.work)
+        numpy.add(self.new_variance, self.work, self.new_variance)
+        numpy.multiply(self.new_variance, self.keep, self.new_variance)
+
+    def num_data_values(self):
+        """Get the number of observations pushed, including the preload
+
+        :return: current samples observed
+        :rtype: int
+        """
+        return self.sample_count
+
+    def mean(self):
+        """Get the current mean
+
+        :return: current weighted mean
+        :rtype: numpy array
+        """
+        return self.new_mean
+
+    def variance(self):
+        """Get the current variance
+
+        :return: current weighted variance
+        :rtype: numpy array
+        """
+        return self.new_variance
+
+    def std(self):
+        """Get the current standard deviation
+
+        :return: current weighted standard deviation
+        :rtype: numpy array
+        """
+        return numpy.sqrt(self.new_variance, self.new_std)
+
+
+class WindowStats(object):
+    """Mean and standard deviation of the most recent samples
+
+    Samples are kept in a float32 ring buffer, the oldest one is
+    subtracted from running sums as each new one is added.  The sums are
+    kept in float64 so hours of adding and subtracting do not drift.
+    """
+
+    def __init__(self, length, samples):
+        """Constructor
+
+        :param length: the length of the matrix
+        :type length: int
+        :param samples: number of samples in the window
+        :type samples: int
+        """
+        self.length = length
+        self.window = max(int(samples), 2)
+        self.samples = numpy.zeros((self.window, length), dtype='float32')
+
+        # one view per row of the ring, and the index that follows each
+        # index, so moving around the ring creates no objects
+        self.rows = list(self.samples)
+        self.next_index = list(range(1, self.window)) + [0]
+
+        self.total = numpy.zeros(length, dtype='float64')
+        self.squares = numpy.zeros(length, dtype='float64')
+        self.work = numpy.zeros(length, dtype='float64')
+        self.new_mean = numpy.zeros(length, dtype='float32')
+        self.new_variance = numpy.zeros(length, dtype='float32')
+        self.new_std = numpy.zeros(length, dtype='float32')
+        self.zero = _scalar(0, 'float64')
+        self.count = 0.0
+        self.divisor = _scalar(0, 'float64')
+        self.full = False
+        self.index = 0
+
+    @property
+    def sample_count(self):
+        return int(self.count)
+
+    def clear(self):
+        self.samples.fill(0)
+        self.total.fill(0)
+        self.squares.fill(0)
+        self.count = 0.0
+        self.full = False
+        self.index = 0
+
+    def preload(self, mean, std, sample_count=2):
+        """Add starting samples with the given mean and standard deviation
+
+        See Stats.preload.  The samples are spread evenly above and below
+        the mean, and drop out of the window as real samples arrive.
+
+        :param mean: new sample mean starting point
+        :type mean: numpy array
+        :param std: new sample standard deviation starting point
+        :type std: numpy array
+        :param sample_count: how many samples to start with (min 2)
+        :type sample_count: int
+        """
+        if len(mean) == self.length and len(
+                std) == self.length and sample_count > 1 and self.sample_count == 0:
+            count = min(sample_count, self.window) // 2 * 2
+            deviation = numpy.asarray(std, dtype='float64') * numpy.sqrt((count - 1.0) / count)
+
+            for index in range(count):
+                if index % 2:
+                    self.push(mean - deviation)
+                else:
+                    self.push(mean + deviation)
+
+    def push(self, data):
+        """Add a new sample, replacing the oldest if the window is full
+
+        :param data: new sample data, this must be a numpy array
+        :type data: numpy array
+        """
+        oldest = self.rows[self.index]
+        work = self.work
+
+        if self.full:
+            numpy.copyto(work, oldest)
+            numpy.subtract(self.total, work, self.total)
+            numpy.multiply(work, work, work)
+            numpy.subtract(self.squares, work, self.squares)
+        else:
+            self.count += 1.0
+
+        numpy.copyto(oldest, data)
+        numpy.copyto(work, oldest)
+        numpy.add(self.total, work, self.total)
+        numpy.multiply(work, work, work)
+        numpy.add(self.squares, work, self.squares)
+
+        self.index = self.next_index[self.index]
+        if self.index == 0:
+            self.full = True
+
+    def num_data_values(self):
+        """Get the current number of observations in the window
+
+        :return: current samples observed
+        :rtype: int
+        """
+        return self.sample_count
+
+    def mean(self):
+        """Get the current mean
+
+        :return: mean of the window
+        :rtype: numpy array
+        """
+        if self.count > 0.0:
+            self.divisor.fill(self.count)
+            numpy.divide(self.total, self.divisor, self.work)
+            numpy.copyto(self.new_mean, self.work)
+
+        return self.new_mean
+
+    def variance(self):
+        """Get the current variance
+
+        :return: variance of the window
+        :rtype: numpy array
+        """
+        if self.count > 1.0:
+            # (squares - total ** 2 / count) / (count - 1)
+            work = self.work
+            numpy.multiply(self.total, self.total, work)
+            self.divisor.fill(self.count)
+            numpy.divide(work, self.divisor, work)
+            numpy.subtract(self.squares, work, work)
+            self.divisor.fill(self.count - 1.0)
+            numpy.divide(work, self.divisor, work)
+            numpy.maximum(work, self.zero, work)
+            numpy.copyto(self.new_variance, work)
+        else:
+            self.new_variance.fill(0)
+
+        return self.new_variance
+
+    def std(self):
+        """Get the current standard deviation
+
+        :return: standard deviation of the window
+        :rtype: numpy array
+        """
+        return numpy.sqrt(self.variance(), self.new_std)
+
+
+def create(kind, length, samples):
+    """Create running statistics
+
+    :param kind: cumulative, ewma or window
+    :type kind: str
+    :param length: the length of the matrix
+    :type length: int
+    :param samples: time constant or window size in samples, unused by cumulative
+    :type samples: float
+    :return: Stats, EwmaStats or WindowStats
+    :raise ValueError: for an unknown kind
+    """
+    if kind == 'cumulative':
+        return Stats(length)
+    elif kind == 'ewma':
+        return EwmaStats(length, samples)
+    elif kind == 'window':
+        return WindowStats(length, samples)
+
+    raise ValueError("Unknown running stats: " + str(kind))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+#
+
+"""Brightness of each light from a row of fft levels.
+
+A channel's level is scaled by the running mean and standard deviation
+of that channel, so an average level is a little under half brightness,
+and clipped to 0 - 1.  With a decay factor lights fade out instead of
+switching straight off.
+
+This runs for every chunk of audio, so everything is computed in
+preallocated buffers with in place numpy operations, once constructed
+no arrays are allocated.
+
+Third party dependencies:
+
+numpy: for calculation
+    http://www.numpy.org/
+"""
+
+import numpy as np
+
+
+def _scalar(value):
+    """A 0-d array, an operand that numpy does not need to convert"""
+    return np.array(value, dtype='float32')
+
+
+class Brightness(object):
+    """Brightness calculation, and the decay state between rows
+
+    Every operand is a float32 array, numpy allocates temporary arrays
+    to convert python numbers and to mix dtypes.
+    """
+
+    def __init__(self, length, decay_factor=0.0):
+        """Constructor
+
+        :param length: number of channels
+        :type length: int
+
+        :param decay_factor: brightness a decaying light loses each row, 0 for no decay
+        :type decay_factor: float
+        """
+        self.length = length
+        self.decay_factor = _scalar(decay_factor)
+        self.decay_enabled = decay_factor > 0
+        self.decay = np.zeros(length, dtype='float32')
+        self.levels = np.zeros(length, dtype='float32')
+        self.work = np.zeros(length, dtype='float32')
+        self.decaying = np.zeros(length, dtype=bool)
+
+        self.zero = _scalar(0.0)
+        self.one = _scalar(1.0)
+        self.half = _scalar(0.5)
+        self.scale = _scalar(1.25)
+        self.thousand = _scalar(1000.0)
+
+    def compute(self, matrix, mean, std, out=None):
+        """Brightness of every channel for a row of the frequency response matrix
+
+        :param matrix: row of data from cache matrix
+        :type matrix: numpy.array
+
+        :param mean: standard mean of fft values
+        :type mean: numpy.array
+
+        :param std: standard deviation of fft values
+        :type std: numpy.array
+
+        :param out: array to write the brightness levels to, by default a
+                    buffer that is overwritten by the next call
+        :type out: numpy.array
+
+        :return: brightness levels, after any decay
+        :rtype: numpy.array
+        """
+        if out is None:
+            out = self.levels
+        work = self.work
+
+        # (matrix - mean + std * 0.5) / (std * 1.25)
+        np.multiply(std, self.half, work)
+        np.subtract(matrix, mean, out)
+        np.add(out, work, out)
+        np.multiply(std, self.scale, work)
+        np.divide(out, work, out)
+
+        # insure that the brightness levels are in the correct range,
+        # np.clip and np.round(out, 3) without their temporary arrays
+        np.maximum(out, self.zero, out)
+        np.minimum(out, self.one, out)
+        np.multiply(out, self.thousand, out)
+        np.rint(out, out)
+        np.divide(out, self.thousand, out)
+
+        # calculate light decay rate if used
+        if self.decay_enabled:
+            # a light that gets brighter than it is decaying starts decaying from there
+            np.fmax(self.decay, out, self.decay)
+
+            # lights that are still decaying show their decayed brightness
+            np.subtract(self.decay, self.decay_factor, work)
+            np.greater(work, self.zero, self.decaying)
+            np.putmask(out, self.decaying, work)
+            np.putmask(self.decay, self.decaying, work)
+
+        return out
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+#
+
+"""Central, content addressed store for sync files.
+
+By default a song's sync file is written next to it as a hidden file.
+When a cache directory is configured sync files are kept there instead,
+named after a hash of the song's audio and the fft configuration used to
+analyze it.  This works with read only music folders, copies of a song
+in several folders share one sync file, and the directory is kept under
+a size limit by removing the sync files of the least recently played
+songs.
+
+Directory layout:
+
+    index.json      content hash of each song (by path, mtime and size)
+                    and the size and last play time of each file
+    index.lock      locked while the index is updated
+    <key>.sync      sync files, see sync_cache
+    <key>.sync.part sync files of songs whose first play was interrupted
+
+The same layout, with a different file suffix, is used by pcm_cache for
+decoded audio.  The two may share a directory, each store only counts
+and removes the files with its own suffix, partial files included,
+against its own size limit.
+
+Every file is written to a temporary file and renamed into place, so a
+reader never sees a partial index or sync file.
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import logging as log
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+INDEX = "index.json"
+LOCK = "index.lock"
+
+# added to the name of a file while it is being written, see sync_cache
+PARTIAL_SUFFIX = ".part"
+
+
+def file_hash(filename):
+    """sha1 of a file's contents
+
+    :param filename: path / filename
+    :type filename: str
+
+    :return: hex digest
+    :rtype: str
+    """
+    digest = hashlib.sha1()
+    with open(filename, "rb") as song_fp:
+        for block in iter(lambda: song_fp.read(1 << 20), ""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def cache_key(content_hash, config):
+    """Key of the sync file for a song's audio analyzed with config
+
+    :param content_hash: sha1 of the song's audio file
+    :type content_hash: str
+
+    :param config: fft configuration, see fft.FFT.get_config
+    :type config: dict
+
+    :rtype: str
+    """
+    return hashlib.sha1(content_hash + json.dumps(config, sort_keys=True)).hexdigest()
+
+
+class CacheStore(object):
+    """A directory of sync files shared by every song"""
+
+    def __init__(self, directory, max_size=0, suffix=".sync"):
+        """Constructor
+
+        :param directory: path of the cache directory, created if needed
+        :type directory: str
+
+        :param max_size: most bytes of sync files to keep, 0 for no limit
+        :type max_size: int
+
+        :param suffix: file extension of the cached files
+        :type suffix: str
+        """
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        self.suffix = suffix
+        self.index_filename = os.path.join(self.directory, INDEX)
+        self.lock_filename = os.path.join(self.directory, LOCK)
+
+        try:
+            os.makedirs(self.directory)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+
+    def read_index(self):
+        """Get the current index, an empty one if it is missing or corrupt
+
+        :rtype: dict
+        """
+        try:
+            with open(self.index_filename) as index_fp:
+                index = json.load(index_fp)
+        except (IOError, ValueError):
+            index = dict()
+
+        index.setdefault("files", dict())
+        index.setdefault("entries", dict())
+
+        return index
+
+    @contextmanager
+    def update_index(self):
+        """Lock, read and then write back the index
+
+        Used as a context manager, yields the index to modify.
+        """
+        with open(self.lock_filename, "a") as lock_fp:
+            fcntl.lockf(lock_fp, fcntl.LOCK_EX)
+            try:
+                index = self.read_index()
+                yield index
+
+                fd, temp_filename = tempfile.mkstemp(prefix=".index", dir=self.directory)
+                with os.fdopen(fd, "w") as index_fp:
+                    json.dump(index, index_fp)
+                os.rename(temp_filename, self.index_filename)
+            finally:
+                fcntl.lockf(lock_fp, fcntl.LOCK_UN)
+
+    def content_hash(self, song_filename):
+        """Get the hash of a song's audio
+
+        The song is only hashed when it is new or its mtime or size
+        has changed since it was last hashed.
+
+        :param song_filename: path / filename of the song
+        :type song_filename: str
+
+        :rtype: str
+        """
+        song_filename = os.path.abspath(song_filename)
+        song_stat = os.stat(song_filename)
+
+        known = self.read_index()["files"].get(song_filename)
+        if known is not None and known[0] == song_stat.st_mtime and known[1] == song_stat.st_size:
+            return known[2]
+
+        digest = file_hash(song_filename)
+        with self.update_index() as index:
+            index["files"][song_filename] = [song_stat.st_mtime, song_stat.st_size, digest]
+
+        return digest
+
+    def cache_filename(self, song_filename, config=None):
+        """Path of the sync file for a song
+
+        :param song_filename: path / filename of the song
+        :type song_filename: str
+
+        :param config: fft configuration, see fft.FFT.get_config, None
+                       for files that only depend on the song's audio
+        :type config: dict
+
+        :rtype: str
+        """
+        key = self.content_hash(song_filename)
+        if config is not None:
+            key = cache_key(key, config)
+
+        return os.path.join(self.directory, key + self.suffix)
+
+    def key(self, cache_filename):
+        """Index key of a cached file, its name"""
+        return os.path.basename(cache_filename)
+
+    def owns(self, name):
+        """Check if a file in the directory belongs to this store
+
+        :param name: name of the file
+        :type name: str
+
+        :rtype: bool
+        """
+        return name.endswith(self.suffix) or name.endswith(self.suffix + PARTIAL_SUFFIX)
+
+    def contains(self, cache_filename):
+        """Check if a sync file is in the store
+
+        :param cache_filename: path returned by cache_filename
+        :type cache_filename: str
+
+        :rtype: bool
+        """
+        key = self.key(cache_filename)
+
+        return key in self.read_index()["entries"] and os.path.isfile(cache_filename)
+
+    def touch(self, cache_filename, song_filename=None):
+        """Record that a sync file was written or played
+
+        Sync files of the least recently played songs are removed if the
+        store is over its size limit, the touched file is always kept.
+
+        :param cache_filename: path returned by cache_filename, or the
+                               partial file written in its place
+        :type cache_filename: str
+
+        :param song_filename: path / filename of the song, for reference
+        :type song_filename: str
+        """
+        key = self.key(cache_filename)
+
+        with self.update_index() as index:
+            entries = index["entries"]
+            entry = entries.setdefault(key, dict())
+            entry["size"] = os.path.getsize(cache_filename)
+            entry["last_played"] = time.time()
+            if song_filename is not None:
+                entry["song"] = os.path.abspath(song_filename)
+
+            self.evict(index, key)
+
+    def evict(self, index, keep=None):
+        """Remove least recently played sync files until the store fits max_size
+
+        :param index: the index, being updated
+        :type index: dict
+
+        :param keep: key that must not be removed
+        :type keep: str
+        """
+        if not self.max_size:
+            return
+
+        entries = index["entries"]
+        self.scan(entries)
+
+        owned = [key for key in entries if self.owns(key)]
+        total = sum(entries[key]["size"] for key in owned)
+
+        for key in sorted(owned, key=lambda k: entries[k]["last_played"]):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+
+            total -= entries.pop(key)["size"]
+            try:
+                os.remove(os.path.join(self.directory, key))
+            except OSError:
+                pass
+
+            log.info("Removed " + key + " from the cache directory")
+
+    def scan(self, entries):
+        """Bring the entries of this store's files up to date with the directory
+
+        Files that were never recorded, such as partial files left by an
+        interrupted play, are added, and the entries of files that are gone,
+        such as partial files that were completed, are removed.
+
+        :param entries: the index entries, being updated
+        :type entries: dict
+        """
+        names = set(name for name in os.listdir(self.directory) if self.owns(name))
+
+        for key in list(entries):
+            if self.owns(key) and key not in names:
+                del entries[key]
+
+        for name in names:
+            try:
+                file_stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+
+            entry = entries.setdefault(name, {"last_played": file_stat.st_mtime})
+            entry["size"] = file_stat.st_size
+
+            # a partial file still being written is in use
+            if name.endswith(PARTIAL_SUFFIX):
+                entry["last_played"] = max(entry["last_played"], file_stat.st_mtime)
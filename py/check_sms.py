@@ -14,7 +14,7 @@ When executed, this script will check all the SMS messages from a Google Voice a
 either the "help" command, which will cause a help message to be sent back to the original sender,
 or a single number indicating which song they are voting for.
 
-When a song is voted for, the playlist file will be updated with the sender's cell phone number to
+When a song is voted for, the playlist log will be updated with the sender's cell phone number to
 indicate it has received a vote from that caller.  This also enforces only a single vote per phone
 number per s (until that song is played).
 
@@ -36,8 +36,6 @@ Beautiful Soup: http://www.crummy.com/software/BeautifulSoup/
 """
 
 import argparse
-import csv
-import fcntl
 import logging
 import sys
 import time
@@ -48,6 +46,7 @@ from googlevoice.util import LoginError, ValidationError
 
 import configuration_manager
 import commands
+import playlist_store
 
 cm = configuration_manager.Configuration(True)
 parser = argparse.ArgumentParser()
@@ -169,44 +168,22 @@ def main():
     """
     # Load playlist from file, notifying users of any of their requests that have now played
     logging.info('loading playlist ' + args.playlist)
+    playlist = playlist_store.PlaylistStore(args.playlist)
     start_commands = False
     while True:
-        with open(args.playlist, 'rb') as playlist_fp:
-            fcntl.lockf(playlist_fp, fcntl.LOCK_SH)
-            playlist = csv.reader(playlist_fp, delimiter='\t')
-            songs = []
-
-            for song in playlist:
-                logging.debug(song)
-
-                if len(song) < 2 or len(song) > 4:
-                    logging.error('Invalid playlist.  Each line should be in the form: '
-                                  '<song name><tab><path to song>')
-                    logging.warning('Removing invalid entry')
-                    print "Error found in playlist"
-                    print "Deleting entry:", song
-                    continue
-                elif len(song) == 2:
-                    song.append(set())
-                elif len(song) >= 3:
-                    # Votes for the song are stored in the 3rd column
-                    song[2] = set(song[2].split(','))
-
-                    if len(song) == 4:
-                        # Notification of a song being played is stored in the 4th column
-                        song_played(song)
-                        del song[3]
-                        song[2] = set()
-
-                songs.append(song)
-
-            fcntl.lockf(playlist_fp, fcntl.LOCK_UN)
-
-        logging.info('loaded %d songs from playlist', len(songs))
-        cm.set_playlist(songs)
+        playlist.refresh()
+
+        for index, song in enumerate(playlist.songs):
+            # Notification of a song being played is stored in the 4th column
+            if len(song) > 3:
+                song_played(song)
+                playlist.played(index)
+
+        logging.info('loaded %d songs from playlist', len(playlist.songs))
+        cm.set_playlist(playlist.songs)
 
         if not start_commands:
-            commands.start(cm)
+            commands.start(cm, playlist)
             start_commands = True
 
         # Parse and act on any new sms messages
@@ -236,18 +213,6 @@ def main():
                 logging.info('Unknown request: "' + msg['text'] + '" from ' + msg['from'])
                 VOICE.send_sms(msg['from'], cm.sms.unknown_command_response)
 
-        # Update playlist with latest votes
-        with open(args.playlist, 'wb') as playlist_fp:
-            fcntl.lockf(playlist_fp, fcntl.LOCK_EX)
-            writer = csv.writer(playlist_fp, delimiter='\t')
-            for song in songs:
-                if len(song[2]) > 0:
-                    song[2] = ",".join(song[2])
-                else:
-                    del song[2]
-            writer.writerows(songs)
-            fcntl.lockf(playlist_fp, fcntl.LOCK_UN)
-
         # Delete all messages now that we've processed them
         for msg in messages:
             msg.delete(1)
@@ -30,8 +30,11 @@ need to define all commands in this file).
 import logging
 import math
 import re
+import socket
 import subprocess
 
+import control
+
 
 # The base command class. The class keeps track of all commands instantiated, so to install a new
 # command, simply instantiate a new instance of it.
@@ -208,7 +211,13 @@ def cmd_play(*args):
     args = args[1]
 
     if len(args) == 0 or not args.isdigit():
-        cm.update_state('play_now', -1)
+        try:
+            if send_to_player('skip') is None:
+                cm.update_state('play_now', -1)
+        except ValueError as error:
+            logging.warn('skip request failed: ' + str(error))
+
+            return 'Sorry, unable to skip ahead right now :('
 
         return 'Skipping straight ahead to the next show!'
     else:
@@ -217,7 +226,13 @@ def cmd_play(*args):
         if song < 1 or song > len(cm.playlist):
             return 'Sorry, the song you requested ' + args + ' is out of range :('
         else:
-            cm.update_state('play_now', song)
+            try:
+                if send_to_player('play', song) is None:
+                    cm.update_state('play_now', song)
+            except ValueError as error:
+                logging.warn('play request failed: ' + str(error))
+
+                return 'Sorry, the song you requested ' + args + ' can not be played right now :('
 
             return '"' + cm.playlist[song - 1][0] + '" coming right up!'
 
@@ -247,6 +262,16 @@ def cmd_volume(*args):
     else:
         return cm.sms.volume_description
 
+    # Let the player change the volume if it is running
+    try:
+        output = send_to_player('volume', sanitized_cmd)
+    except ValueError as error:
+        logging.warn('volume request failed: ' + str(error))
+
+        return 'volume request failed'
+    if output is not None:
+        return 'volume = ' + output
+
     # Execute the sanitized command and handle result
     volscript = cm.home_dir + '/bin/vol'
     output, error = subprocess.Popen(volscript + ' ' + sanitized_cmd,
@@ -277,7 +302,13 @@ def cmd_vote(*args):
 
         if user != 'Me' and 0 < song_num <= len(cm.playlist):
             song = cm.playlist[song_num - 1]
-            song[2].add(user)
+
+            # the vote is logged next to the playlist, the player picks it up
+            # when it next reads the playlist, before it chooses a song
+            if _PLAYLIST is not None:
+                _PLAYLIST.vote(song_num - 1, user)
+            else:
+                song[2].add(user)
             logging.info('Song requested: ' + str(song))
 
             return 'Thank you for requesting "' + song[0] \
@@ -286,9 +317,38 @@ def cmd_vote(*args):
         return cm.sms.unknown_command_response
 
 
-def start(config):
-    global cm, _CMD_NAMES
+def send_to_player(command, *args):
+    """Send a command to the player through its control channel
+
+    :param command: command name
+    :type command: str
+
+    :param args: arguments of the command
+
+    :return: the player's response, None if the player is not listening
+    :rtype: str
+
+    :raise ValueError: if the player could not carry out the command
+    """
+    try:
+        return control.send(control.socket_path(cm.home_dir), command, *args)
+    except socket.error as error:
+        logging.warn('control channel failed: ' + str(error))
+        return None
+
+
+def start(config, playlist=None):
+    """Register the commands
+
+    :param config: the configuration, with the playlist
+    :type config: configuration_manager.Configuration
+
+    :param playlist: the playlist store that records votes, if any
+    :type playlist: playlist_store.PlaylistStore
+    """
+    global cm, _CMD_NAMES, _PLAYLIST
     cm = config
+    _PLAYLIST = playlist
     _CMD_NAMES = cm.sms.commands
         
     Command('help', cmd_help)
@@ -15,17 +15,30 @@ manage these configuration files.
 
 import ConfigParser
 import ast
+import ctypes
+import ctypes.util
 import datetime
+import errno
 import fcntl
 import logging
 import os
 import os.path
+import struct
 import sys
+import threading
 import warnings
 import json
 import shlex
 from collections import defaultdict
 
+# inotify is used to watch the state file when libc provides it
+try:
+    _LIBC = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _LIBC.inotify_init1
+    _LIBC.inotify_add_watch
+except (OSError, AttributeError):
+    _LIBC = None
+
 # The home directory and configuration directory for the application.
 HOME_DIR = os.getenv("SYNCHRONIZED_LIGHTS_HOME")
 if not HOME_DIR:
@@ -51,6 +64,102 @@ def _as_list(list_str, delimiter=','):
     return [str.strip(item).rstrip() for item in list_str.split(delimiter)]
 
 
+class StateWatcher(object):
+    """Detect changes to the state file without re-reading it.
+
+    Uses inotify when it is available, otherwise compares the files
+    mtime, size and inode between calls.  Either way checking for a
+    change never opens, locks or parses the file.
+    """
+    _IN_MODIFY = 0x00000002
+    _IN_ATTRIB = 0x00000004
+    _IN_CLOSE_WRITE = 0x00000008
+    _IN_DELETE_SELF = 0x00000400
+    _IN_MOVE_SELF = 0x00000800
+    _IN_IGNORED = 0x00008000
+    _IN_NONBLOCK = os.O_NONBLOCK
+    _IN_CLOEXEC = 0o2000000
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, filename):
+        """
+        :param filename: path / filename of the file to watch
+        :type filename: str
+        """
+        self.filename = filename
+        self.inotify_fd = None
+        self.watch = -1
+        self.signature = self.stat()
+
+        if _LIBC is not None:
+            fd = _LIBC.inotify_init1(self._IN_NONBLOCK | self._IN_CLOEXEC)
+            if fd >= 0:
+                self.inotify_fd = fd
+                self.add_watch()
+            else:
+                logging.debug("inotify not available, falling back to stat")
+
+    def stat(self):
+        """Get the mtime, size and inode of the watched file
+
+        :return: file signature or None if the file does not exist
+        :rtype: tuple
+        """
+        try:
+            info = os.stat(self.filename)
+        except OSError:
+            return None
+        return info.st_mtime, info.st_size, info.st_ino
+
+    def add_watch(self):
+        """(Re)add the inotify watch, the file may have been replaced"""
+        mask = (self._IN_MODIFY | self._IN_ATTRIB | self._IN_CLOSE_WRITE |
+                self._IN_DELETE_SELF | self._IN_MOVE_SELF)
+        self.watch = _LIBC.inotify_add_watch(self.inotify_fd, self.filename, mask)
+
+    def changed(self):
+        """Check if the file has changed since the last call
+
+        :return: True if the file changed
+        :rtype: bool
+        """
+        if self.inotify_fd is None or self.watch < 0:
+            if self.inotify_fd is not None:
+                self.add_watch()
+            signature = self.stat()
+            changed = signature != self.signature
+            self.signature = signature
+            return changed
+
+        changed = False
+        while True:
+            try:
+                events = os.read(self.inotify_fd, 4096)
+            except OSError as error:
+                if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+            offset = 0
+            while offset < len(events):
+                _, mask, _, length = self._EVENT.unpack_from(events, offset)
+                offset += self._EVENT.size + length
+                changed = True
+                if mask & self._IN_IGNORED:
+                    self.watch = -1
+
+        if self.watch < 0:
+            self.add_watch()
+
+        return changed
+
+    def close(self):
+        """Stop watching the file"""
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+
+
 class Configuration(object):
     """Configuration management for the lightshow.
 
@@ -74,12 +183,16 @@ class Configuration(object):
 
         self.state_section = 'do_not_modify'
 
+        # the player's control thread updates the state too
+        self.state_lock = threading.RLock()
+
         self.load_config()
 
         # Ensure state file has been created
         if not os.path.isfile(self.state_file):
             open(self.state_file, 'w').close()
 
+        self.state_watcher = StateWatcher(self.state_file)
         self.load_state()
 
         # synchronized_lights and check_sms both use configuration_manager
@@ -109,11 +222,24 @@ class Configuration(object):
     # handle the program state / next 3 methods
     def load_state(self):
         """Force the state to be reloaded form disk."""
-        with open(self.state_file) as state_fp:
+        with self.state_lock, open(self.state_file) as state_fp:
             fcntl.lockf(state_fp, fcntl.LOCK_SH)
             self.state.readfp(state_fp, self.state_file)
             fcntl.lockf(state_fp, fcntl.LOCK_UN)
 
+    def refresh_state(self):
+        """Reload the state from disk only if the file has changed
+
+        Cheap enough to call on every audio chunk.
+
+        :return: True if the state was reloaded
+        :rtype: bool
+        """
+        if self.state_watcher.changed():
+            self.load_state()
+            return True
+        return False
+
     def get_state(self, name, default=""):
         """
         Get application state
@@ -147,15 +273,16 @@ class Configuration(object):
         value = str(value)
         logging.info('Updating application state {%s: %s}', name, value)
 
-        if not self.state.has_section(self.state_section):
-            self.state.add_section(self.state_section)
+        with self.state_lock:
+            if not self.state.has_section(self.state_section):
+                self.state.add_section(self.state_section)
 
-        self.state.set(self.state_section, name, value)
+            self.state.set(self.state_section, name, value)
 
-        with open(self.state_file, 'wb') as state_fp:
-            fcntl.lockf(state_fp, fcntl.LOCK_EX)
-            self.state.write(state_fp)
-            fcntl.lockf(state_fp, fcntl.LOCK_UN)
+            with open(self.state_file, 'wb') as state_fp:
+                fcntl.lockf(state_fp, fcntl.LOCK_EX)
+                self.state.write(state_fp)
+                fcntl.lockf(state_fp, fcntl.LOCK_UN)
 
     def set_hardware(self):
         """
@@ -198,6 +325,9 @@ class Configuration(object):
         ntwrk["networking"] = self.config.get('network', 'networking')
         ntwrk["port"] = self.config.getint('network', 'port')
         ntwrk["buffer"] = self.config.getint('network', 'buffer')
+        ntwrk["protocol"] = self.config.get('network', 'protocol').lower()
+        ntwrk["jitter_delay"] = self.config.getfloat('network', 'jitter_delay')
+        ntwrk["presentation_lead"] = self.config.getfloat('network', 'presentation_lead')
 
         if len(self.config.get('network', 'channels')) == 0:
             channels = [_ for _ in range(self.gpio_len)]
@@ -229,6 +359,8 @@ class Configuration(object):
             
         lghtshw["input_channels"] = self.config.getint(ls, 'input_channels')
         lghtshw["input_sample_rate"] = self.config.getint(ls, 'input_sample_rate')
+        lghtshw["input_stats"] = self.config.get(ls, 'input_stats')
+        lghtshw["input_stats_seconds"] = self.config.getfloat(ls, 'input_stats_seconds')
 
         command_string = self.config.get(ls, 'stream_command_string')
         lghtshw["stream_command_string"] = shlex.split(command_string)
@@ -294,6 +426,9 @@ class Configuration(object):
         audio_prcssng["fm"] = self.config.getboolean('audio_processing', 'fm')
         audio_prcssng["frequency"] = self.config.get('audio_processing', 'frequency')
         audio_prcssng["light_delay"] = self.config.getfloat('audio_processing', 'light_delay')
+        audio_prcssng["light_rate"] = self.config.getfloat('audio_processing', 'light_rate')
+        audio_prcssng["light_interpolate"] = \
+            self.config.getboolean('audio_processing', 'light_interpolate')
         audio_prcssng["min_frequency"] = \
             self.config.getfloat('audio_processing', 'min_frequency')
         audio_prcssng["max_frequency"] = \
@@ -305,6 +440,27 @@ class Configuration(object):
         audio_prcssng["custom_channel_frequencies"] = \
             map(int, temp.split(',')) if temp else 0
 
+        audio_prcssng["decode_queue_depth"] = \
+            self.config.getint('audio_processing', 'decode_queue_depth')
+        audio_prcssng["light_queue_depth"] = \
+            self.config.getint('audio_processing', 'light_queue_depth')
+        temp = self.config.get('audio_processing', 'pipeline_cpus')
+        audio_prcssng["pipeline_cpus"] = map(int, temp.split(',')) if temp else []
+
+        temp = self.config.get('audio_processing', 'cache_dir')
+        audio_prcssng["cache_dir"] = temp.replace('$SYNCHRONIZED_LIGHTS_HOME', self.home_dir)
+        audio_prcssng["cache_dir_size"] = \
+            self.config.getint('audio_processing', 'cache_dir_size') * 1024 * 1024
+
+        temp = self.config.get('audio_processing', 'pcm_cache_dir')
+        audio_prcssng["pcm_cache_dir"] = temp.replace('$SYNCHRONIZED_LIGHTS_HOME', self.home_dir)
+        audio_prcssng["pcm_cache_dir_size"] = \
+            self.config.getint('audio_processing', 'pcm_cache_dir_size') * 1024 * 1024
+
+        audio_prcssng["lookahead"] = self.config.getboolean('audio_processing', 'lookahead')
+        temp = self.config.get('audio_processing', 'lookahead_cpu')
+        audio_prcssng["lookahead_cpu"] = int(temp) if temp else -1
+
         self.audio_processing = Section(audio_prcssng)
 
     def set_sms(self):
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+#
+
+"""Control channel between check_sms and the player.
+
+Commands used to reach the player only through the state file, which
+the player had to keep checking, every audio chunk while a song plays
+and every tenth of a second during the pre and post shows.  While it
+plays, synchronized_lights now listens on a unix socket in the
+SYNCHRONIZED_LIGHTS_HOME directory and acts on commands as soon as
+they arrive.  The state file is still written, by the player, so it
+remains a snapshot of the state that the next song's player starts
+from.
+
+Each connection carries one request, a line of tab separated words,
+the command then its arguments, and gets back one line:
+
+    play<tab><song number>          play a song now
+    skip                            skip ahead to the next song
+    volume<tab><- | + | 0 - 100>    change the system volume
+
+    ok<tab><response>
+    error<tab><reason>
+
+Between songs, or if the player is not running, nothing is listening
+and send returns None, the sender should fall back to the state file.
+"""
+
+import errno
+import logging as log
+import os
+import socket
+import threading
+
+SOCKET_NAME = "control.sock"
+
+# seconds a client may take to send its request or read the response
+TIMEOUT = 2.0
+
+
+def socket_path(home_dir):
+    """Path of the control socket
+
+    :param home_dir: the SYNCHRONIZED_LIGHTS_HOME directory
+    :type home_dir: str
+
+    :return: path / filename of the socket
+    :rtype: str
+    """
+    return os.path.join(home_dir, SOCKET_NAME)
+
+
+def send(path, command, *args):
+    """Send a command to the player
+
+    :param path: path / filename of the control socket
+    :type path: str
+
+    :param command: command name
+    :type command: str
+
+    :param args: arguments of the command
+
+    :return: the player's response, None if the player is not listening
+    :rtype: str
+
+    :raise ValueError: if the player could not carry out the command
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(TIMEOUT)
+    try:
+        try:
+            client.connect(path)
+        except socket.error as error:
+            if error.errno in (errno.ENOENT, errno.ECONNREFUSED):
+                return None
+            raise
+
+        client.sendall("\t".join([command] + [str(arg) for arg in args]) + "\n")
+        reply = _read_line(client)
+    finally:
+        client.close()
+
+    if reply is None:
+        return None
+
+    status, _, response = reply.partition("\t")
+    if status != "ok":
+        raise ValueError(response)
+
+    return response
+
+
+def _read_line(connection):
+    """Read one line from a connection, None if it closed without one"""
+    data = ""
+    while "\n" not in data:
+        received = connection.recv(4096)
+        if not received:
+            return None
+        data += received
+
+    return data[:data.index("\n")]
+
+
+class ControlServer(object):
+    """Accept commands on the control socket, in a background thread
+
+    Each command is handled by calling a function with the command's
+    arguments, it returns the response or raises ValueError if it can
+    not carry out the command.  interrupt is set by commands that stop
+    the show, so the show can wait on it instead of polling.
+    """
+
+    def __init__(self, path, handlers):
+        """Constructor
+
+        :param path: path / filename of the control socket
+        :type path: str
+
+        :param handlers: function to handle each command, by command name
+        :type handlers: dict
+        """
+        self.path = path
+        self.handlers = handlers
+        self.interrupt = threading.Event()
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        """Start listening
+
+        :return: False if the socket is in use or could not be created
+        :rtype: bool
+        """
+        if os.path.exists(self.path):
+            # left behind by a player that did not exit cleanly?
+            try:
+                if send(self.path, "ping") is not None:
+                    log.warning("Another player is listening on " + self.path)
+                    return False
+            except (socket.error, ValueError):
+                pass
+
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(self.path)
+            os.chmod(self.path, 0o660)
+            server.listen(4)
+        except socket.error as error:
+            log.warning("Unable to listen on " + self.path + ": " + str(error))
+            server.close()
+            return False
+
+        self.server = server
+        self.thread = threading.Thread(target=self.run, name="control")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+        return True
+
+    def run(self):
+        """Handle connections until the server is closed"""
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except socket.error as error:
+                if error.errno == errno.EINTR:
+                    continue
+                return
+
+            try:
+                connection.settimeout(TIMEOUT)
+                request = _read_line(connection)
+                if request is not None:
+                    connection.sendall(self.handle(request.split("\t")) + "\n")
+            except socket.error as error:
+                log.debug("Control connection failed: " + str(error))
+            finally:
+                connection.close()
+
+    def handle(self, request):
+        """Carry out one request
+
+        :param request: command name and arguments
+        :type request: list
+
+        :return: response line
+        :rtype: str
+        """
+        command, args = request[0], request[1:]
+
+        if command == "ping":
+            return "ok\tpong"
+
+        handler = self.handlers.get(command)
+        if handler is None:
+            return "error\tunknown command " + command
+
+        log.info("Control request: " + " ".join(request))
+        try:
+            return "ok\t" + str(handler(*args))
+        except (TypeError, ValueError) as error:
+            return "error\t" + str(error)
+        except Exception as error:
+            log.exception("Control command " + command + " failed")
+            return "error\t" + str(error)
+
+    def close(self):
+        """Stop listening and remove the socket"""
+        if self.server is None:
+            return
+
+        # accept returns with an error once the socket is shut down
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.server.close()
+        self.server = None
+
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
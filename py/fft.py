@@ -10,6 +10,12 @@
 This is simply a wrapper rpi-audio-level by Colin Guyon.
 https://github.com/colin-guyon/rpi-audio-levels
 
+rpi-audio-levels uses the Raspberry Pi's GPU and is only available on a
+Pi, everywhere else (or when asked for) the levels are computed with
+numpy's fft instead.  Both backends reduce the power spectrum the same
+way, but their levels are not bit for bit the same, so the backend is
+part of the configuration a sync file is checked against.
+
 Initial FFT code inspired from the code posted here:
 http://www.raspberrypi.org/phpBB3/viewtopic.php?t=35838&p=454041
 
@@ -25,10 +31,115 @@ rpi-audio-levels - https://bitbucket.org/tom_slick/rpi-audio-levels (modified fo
 import ConfigParser
 import logging
 import os.path
+from collections import OrderedDict
 from numpy import *
+from numpy.fft import rfft
 import math
 
-from rpi_audio_levels import AudioLevels
+try:
+    from rpi_audio_levels import AudioLevels
+except ImportError:
+    AudioLevels = None
+
+
+class NumpyLevels(object):
+    """numpy implementation of rpi_audio_levels.AudioLevels
+
+    The power spectrum of each chunk is summed over each band with a
+    single add.reduceat over a precomputed index of the band edges, and
+    the log10 of each sum is the level.  reduceat adds in the same order
+    however many chunks are passed at once, so levels computed for a
+    whole song match the ones computed chunk by chunk exactly.
+    """
+
+    def __init__(self, chunk_size, num_bins):
+        """
+        :param chunk_size: samples in each chunk of audio data
+        :type chunk_size: int
+
+        :param num_bins: number of bands to compute levels for
+        :type num_bins: int
+        """
+        self.chunk_size = chunk_size
+        self.num_bins = num_bins
+        self.bands_indexes = None
+        self.size = None
+        self.index = None
+
+    def band_index(self, bands_indexes, size):
+        """reduceat index that sums power[start:end] for each band
+
+        The index holds the start and end of each band in turn, so every
+        other result of reduceat is a band sum.  Edges are clipped to the
+        spectrum, the power spectrum gets one zero bin appended so an
+        empty band sums to zero.
+
+        :param bands_indexes: [start, end) fft bin range of each band
+        :type bands_indexes: list
+
+        :param size: number of frequency bins in the power spectrum
+        :type size: int
+
+        :return: index for add.reduceat
+        :rtype: numpy.array
+        """
+        if self.index is None or size != self.size or bands_indexes != self.bands_indexes:
+            edges = clip(array(bands_indexes, dtype=intp).reshape(-1, 2), 0, size)
+            edges[:, 1] = maximum(edges[:, 0], edges[:, 1])
+            empty = edges[:, 0] == edges[:, 1]
+            edges[empty] = size
+
+            self.index = edges.ravel()
+            self.bands_indexes = [list(band) for band in bands_indexes]
+            self.size = size
+
+        return self.index
+
+    def compute(self, data, bands_indexes):
+        """Compute the level of each band
+
+        :param data: windowed audio samples, or a 2d array with one chunk per row
+        :type data: numpy.array
+
+        :param bands_indexes: [start, end) fft bin range of each band
+        :type bands_indexes: list
+
+        :return: (levels, means, stds) like AudioLevels, only levels is computed
+        :rtype: tuple
+        """
+        fourier = rfft(data)
+        power = fourier.real ** 2 + fourier.imag ** 2
+
+        index = self.band_index(bands_indexes, power.shape[-1])
+        padding = zeros(power.shape[:-1] + (1,), dtype=power.dtype)
+        sums = add.reduceat(concatenate((power, padding), axis=-1), index, axis=-1)[..., ::2]
+
+        with errstate(divide="ignore"):
+            return log10(sums).astype(float32), None, None
+
+
+# fft backends by name in order of preference,
+# each is called as backend(chunk_size, num_bins)
+BACKENDS = OrderedDict()
+
+
+def register_backend(name, factory):
+    """Add an fft backend
+
+    :param name: name used to select the backend
+    :type name: str
+
+    :param factory: called with (chunk_size, num_bins), returns an object
+                    with the compute method of AudioLevels
+    :type factory: function
+    """
+    BACKENDS[name] = factory
+
+
+if AudioLevels is not None:
+    register_backend("gpu", lambda chunk_size, num_bins:
+                     AudioLevels(math.log(chunk_size / 2, 2), num_bins))
+register_backend("numpy", NumpyLevels)
 
 
 class FFT(object):
@@ -40,7 +151,8 @@ class FFT(object):
                  max_frequency,
                  custom_channel_mapping,
                  custom_channel_frequencies,
-                 input_channels=2):
+                 input_channels=2,
+                 backend=None):
         """
         :param chunk_size: chunk size of audio data
         :type chunk_size: int
@@ -67,7 +179,15 @@ class FFT(object):
                                         utilized for each channel
         :type custom_channel_frequencies: list | int
 
+        :param backend: name of the fft backend to use, None for the best available
+        :type backend: str
+
+        :raise ValueError: if backend is not a known backend
         """
+        if backend is None:
+            backend = BACKENDS.keys()[0]
+        elif backend not in BACKENDS:
+            raise ValueError("Unknown fft backend " + str(backend))
 
         self.chunk_size = chunk_size
         self.sample_rate = sample_rate
@@ -81,7 +201,9 @@ class FFT(object):
         self.frequency_limits = self.calculate_channel_frequency()
         self.config = ConfigParser.RawConfigParser(allow_no_value=True)
         self.config_filename = ""
-        self.audio_levels = AudioLevels(math.log(chunk_size / 2, 2), num_bins)
+        self.backend = backend
+        self.audio_levels = BACKENDS[backend](chunk_size, num_bins)
+        logging.debug("Using the %s fft backend", backend)
 
         fl = array(self.frequency_limits)
         self.piff = ((fl * self.chunk_size) / self.sample_rate).astype(int)
@@ -91,6 +213,17 @@ class FFT(object):
                 self.piff[a][1] += 1
         self.piff = self.piff.tolist()
         
+    def get_audio_levels(self):
+        """Get the fft backend, creating it again if it was released
+
+        :return: the backend's level calculator
+        :rtype: AudioLevels | NumpyLevels
+        """
+        if self.audio_levels is None:
+            self.audio_levels = BACKENDS[self.backend](self.chunk_size, self.num_bins)
+
+        return self.audio_levels
+
     def calculate_levels(self, data):
         """Calculate frequency response for each channel defined in frequency_limits
 
@@ -124,11 +257,73 @@ class FFT(object):
 
         # Apply FFT - real data
         # Calculate the power spectrum
-        cache_matrix = array(self.audio_levels.compute(data, self.piff)[0])
+        cache_matrix = array(self.get_audio_levels().compute(data, self.piff)[0])
         cache_matrix[isinf(cache_matrix)] = 0.0
 
         return cache_matrix
 
+    def calculate_levels_batch(self, data, num_channels=None, block_rows=256):
+        """Calculate frequency response for many consecutive chunks at once
+
+        The audio is cut into the same chunks calculate_levels would be
+        called with, and the window, fft and band reduction are applied to
+        a block of chunks at a time.  The result is identical to calling
+        calculate_levels on each chunk in turn, a short chunk at the end is
+        passed to calculate_levels.
+
+        :param data: decoder.frames(), audio data for many chunks
+        :type data: str
+
+        :param num_channels: channels in data, the audio is cut into chunks
+                             of chunk_size frames (default input_channels)
+        :type num_channels: int
+
+        :param block_rows: chunks to process in each block, limits memory use
+        :type block_rows: int
+
+        :return: one row of levels per chunk
+        :rtype: numpy.array
+        """
+        samples = frombuffer(data, dtype="int16")
+        chunk_samples = self.chunk_size * (num_channels or self.input_channels)
+        rows = len(samples) // chunk_samples
+
+        levels = zeros((rows, self.num_bins), dtype="float32")
+
+        for start in range(0, rows, block_rows):
+            end = min(start + block_rows, rows)
+            chunks = samples[start * chunk_samples:end * chunk_samples].reshape(-1, chunk_samples)
+
+            # just the left channel if stereo
+            if self.input_channels == 2:
+                chunks = chunks[:, ::2]
+
+            if chunks.shape[1] != len(self.window):
+                self.window = hanning(chunks.shape[1]).astype(float32)
+
+            chunks = chunks * self.window
+
+            # chunks of silence are left at zero
+            audible = flatnonzero(any(chunks != 0.0, axis=1))
+            if not len(audible):
+                continue
+
+            audio_levels = self.get_audio_levels()
+            if isinstance(audio_levels, NumpyLevels):
+                block = audio_levels.compute(chunks[audible], self.piff)[0]
+            else:
+                block = array([audio_levels.compute(chunk, self.piff)[0]
+                               for chunk in chunks[audible]])
+            block[isinf(block)] = 0.0
+
+            levels[start + audible] = block
+
+        if len(samples) > rows * chunk_samples:
+            remainder = self.calculate_levels(samples[rows * chunk_samples:].tostring())
+            levels = vstack((levels, remainder))
+
+        return levels
+
     def calculate_channel_frequency(self):
         """Calculate frequency values
 
@@ -189,6 +384,25 @@ class FFT(object):
         else:
             return frequency_store
 
+    def get_config(self):
+        """Get the configuration used to generate the fft data
+
+        :return: the settings that change the fft output
+        :rtype: dict
+        """
+        fft_config = dict()
+        fft_config["chunk_size"] = self.chunk_size
+        fft_config["sample_rate"] = self.sample_rate
+        fft_config["num_bins"] = self.num_bins
+        fft_config["min_frequency"] = self.min_frequency
+        fft_config["max_frequency"] = self.max_frequency
+        fft_config["custom_channel_mapping"] = self.custom_channel_mapping
+        fft_config["custom_channel_frequencies"] = self.custom_channel_frequencies
+        fft_config["input_channels"] = self.input_channels
+        fft_config["backend"] = self.backend
+
+        return fft_config
+
     def compare_config(self, cache_filename):
         """
         Compare the current configuration used to generate fft to a saved
@@ -209,7 +423,6 @@ class FFT(object):
                 self.config.readfp(f)
 
         fft_cache = dict()
-        fft_current = dict()
 
         try:
             fft_cache["chunk_size"] = self.config.getint("fft", "chunk_size")
@@ -233,27 +446,26 @@ class FFT(object):
                 fft_cache["custom_channel_frequencies"] = temp
 
             fft_cache["input_channels"] = self.config.getint("fft", "input_channels")
+            fft_cache["backend"] = self.config.get("fft", "backend")
         except ConfigParser.Error:
             has_config = False
 
-        fft_current["chunk_size"] = self.chunk_size
-        fft_current["sample_rate"] = self.sample_rate
-        fft_current["num_bins"] = self.num_bins
-        fft_current["min_frequency"] = self.min_frequency
-        fft_current["max_frequency"] = self.max_frequency
-        fft_current["custom_channel_mapping"] = self.custom_channel_mapping
-        fft_current["custom_channel_frequencies"] = self.custom_channel_frequencies
-        fft_current["input_channels"] = self.input_channels
+        fft_current = self.get_config()
 
         if fft_cache != fft_current:
             has_config = False
             logging.warn("Cached config data does not match")
 
-        if has_config:
-            self.audio_levels = None
-            
         return has_config
 
+    def release_audio_levels(self):
+        """Free the fft backend, the GPU's memory for rpi_audio_levels
+
+        Call when a complete sync file means no levels will be computed,
+        the backend is created again if they are.
+        """
+        self.audio_levels = None
+
     def save_config(self):
         """Save the current configuration used to generate the fft data"""
         if self.config.has_section("fft"):
@@ -282,6 +494,7 @@ class FFT(object):
                             str(self.custom_channel_frequencies))
 
         self.config.set('fft', 'input_channels', str(self.input_channels))
+        self.config.set('fft', 'backend', self.backend)
 
         with open(self.config_filename, "w") as f:
             self.config.write(f)
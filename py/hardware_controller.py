@@ -31,9 +31,12 @@ import signal
 import threading
 import os
 
+import numpy as np
+
 import configuration_manager
 from collections import defaultdict
 import networking
+import pattern_scheduler
 
 
 state = None
@@ -101,8 +104,102 @@ else:
 # left in for compatibility with external scripts
 _GPIO_PINS = cm.hardware.gpio_pins
 
+# pwm level of full brightness of each pin, 0 for onoff pins, and the
+# onoff pins, for set_lights
+_pwm_scale = np.array([_PWM_MAX if is_pin_pwm[pin] else 0 for pin in range(GPIOLEN)], dtype=float)
+_onoff_mask = np.array([not is_pin_pwm[pin] for pin in range(GPIOLEN)], dtype=bool)
+
+# scratch buffers, so set_lights does not allocate on every frame
+_brightness = np.zeros(GPIOLEN, dtype=float)
+_work = np.zeros(GPIOLEN, dtype=float)
+_flags = np.zeros(GPIOLEN, dtype=bool)
+_levels = np.zeros(GPIOLEN, dtype=int)
+_frame = np.zeros(GPIOLEN, dtype=float)
+
+# last pwm or digital level written to each pin, -1 if unknown
+# writes that would not change a pin are skipped, saving a bus
+# transaction per pin on i2c / spi expanders
+_last_levels = np.empty(GPIOLEN, dtype=int)
+_last_levels.fill(-1)
+writes_issued = 0
+writes_suppressed = 0
+
+# override masks for set_lights, built by build_override_masks
+_always_off_mask = None
+_always_on_mask = None
+_inverted_mask = None
+
+# per pin lookup tables for set_light, also built by build_override_masks
+# override is None, or the 0 / 1 brightness an always off / on pin is set to
+_pin_override = None
+_pin_inverted = None
+# gpio pin number, and the pin index network clients know it by
+_pin_physical = None
+_pin_broadcast = None
+# for each pin index, the pin whose brightness set_lights broadcasts for it
+_frame_source = None
+# pwm level of full brightness, 0 for onoff pins
+_pin_pwm_max = None
+
+# ticks per second of the test patterns
+PATTERN_RATE = 100.0
+
 
 # Functions
+def forget_levels(pin=None):
+    """Forget the last level written so the next write always goes out
+
+    :param pin: index of pin in cm.hardware.gpio_pins, None for all pins
+    :type pin: int
+    """
+    if pin is None:
+        _last_levels.fill(-1)
+    else:
+        _last_levels[pin] = -1
+
+
+def write_counts():
+    """Get the number of pin writes issued and suppressed
+
+    :return: writes issued, writes skipped because the level was unchanged
+    :rtype: tuple
+    """
+    return writes_issued, writes_suppressed
+
+
+def reset_write_counts():
+    """Reset the counters returned by write_counts"""
+    global writes_issued, writes_suppressed
+    writes_issued = 0
+    writes_suppressed = 0
+
+
+def write_level(pin, level):
+    """Write a pwm or digital level to a pin unless it already has it
+
+    Callers build the pin tables first, see build_override_masks.
+
+    :param pin: index of pin in cm.hardware.gpio_pins
+    :type pin: int
+
+    :param level: pwm level, or 0 / 1 for onoff pins
+    :type level: int
+    """
+    global writes_issued, writes_suppressed
+
+    if _last_levels[pin] == level:
+        writes_suppressed += 1
+        return
+
+    _last_levels[pin] = level
+    writes_issued += 1
+
+    if _pin_pwm_max[pin]:
+        wiringpi.softPwmWrite(_pin_physical[pin], level)
+    else:
+        wiringpi.digitalWrite(_pin_physical[pin], level)
+
+
 def enable_device():
     """enable the specified device """
     try:
@@ -196,6 +293,8 @@ def set_pin_as_output(pin):
     :param pin: index of pin in cm.hardware.gpio_pins
     :type pin: int
     """
+    forget_levels(pin)
+
     if is_pin_pwm[pin]:
         wiringpi.softPwmCreate(cm.hardware.gpio_pins[pin], 0, _PWM_MAX)
     else:
@@ -214,6 +313,7 @@ def set_pin_as_input(pin):
     :param pin: index of pin in cm.hardware.gpio_pins
     :type pin: int
     """
+    forget_levels(pin)
     wiringpi.pinMode(cm.hardware.gpio_pins[pin], _GPIOASINPUT)
 
 
@@ -295,6 +395,9 @@ def set_light(pin, use_overrides=False, brightness=1.0):
     :param brightness: float, a float representing the brightness of the lights
     :type brightness: float
     """
+    if _pin_override is None:
+        build_override_masks()
+
     if math.isnan(brightness):
         brightness = 0.0
 
@@ -302,21 +405,132 @@ def set_light(pin, use_overrides=False, brightness=1.0):
         brightness = 1.0 - brightness
 
     if use_overrides:
-        if pin + 1 in always_off_channels:
-            brightness = 0
-        elif pin + 1 in always_on_channels:
-            brightness = 1
+        override = _pin_override[pin]
+        if override is not None:
+            brightness = override
 
-        if pin + 1 in inverted_channels:
+        if _pin_inverted[pin]:
             brightness = 1 - brightness
 
     if not network.playing and server:
-        network.broadcast(cm.hardware.gpio_pins.index(cm.hardware.gpio_pins[pin]), brightness)
+        network.broadcast(_pin_broadcast[pin], brightness)
 
-    if is_pin_pwm[pin]:
-        wiringpi.softPwmWrite(cm.hardware.gpio_pins[pin], int(brightness * _PWM_MAX))
+    pwm_max = _pin_pwm_max[pin]
+    if pwm_max:
+        write_level(pin, int(brightness * pwm_max))
+    else:
+        write_level(pin, int(brightness > 0.5))
+
+
+def channel_mask(channels):
+    """Build a boolean mask over all pins from a list of channels
+
+    :param channels: channel numbers, starting at 1, -1 for none
+    :type channels: list
+
+    :return: True for each pin in channels
+    :rtype: numpy.array
+    """
+    mask = np.zeros(GPIOLEN, dtype=bool)
+
+    for channel in channels:
+        if 0 < channel <= GPIOLEN:
+            mask[channel - 1] = True
+
+    return mask
+
+
+def build_override_masks():
+    """Build the override masks used by set_lights and the pin tables used by set_light
+
+    Must be called again if always_on_channels, always_off_channels or
+    inverted_channels are changed, initialize() does this for you.
+    """
+    global _always_off_mask, _always_on_mask, _inverted_mask
+    global _pin_override, _pin_inverted, _pin_physical, _pin_broadcast, _pin_pwm_max
+    global _frame_source
+
+    _always_off_mask = channel_mask(always_off_channels)
+    # always off wins if a channel is in both lists
+    _always_on_mask = channel_mask(always_on_channels) & ~_always_off_mask
+    _inverted_mask = channel_mask(inverted_channels)
+
+    _pin_override = [0 if _always_off_mask[pin] else 1 if _always_on_mask[pin] else None
+                     for pin in range(GPIOLEN)]
+    _pin_inverted = _inverted_mask.tolist()
+    _pin_physical = list(_GPIO_PINS)
+    # a gpio pin listed more than once is always sent as its first channel
+    _pin_broadcast = [_GPIO_PINS.index(_GPIO_PINS[pin]) for pin in range(GPIOLEN)]
+    # as set_light would, the last channel of a gpio pin listed more than once wins
+    last = dict((_pin_broadcast[pin], pin) for pin in range(GPIOLEN))
+    _frame_source = np.array([last.get(pin, pin) for pin in range(GPIOLEN)], dtype=int)
+    _pin_pwm_max = [_PWM_MAX if is_pin_pwm[pin] else 0 for pin in range(GPIOLEN)]
+
+
+def set_lights(brightness, use_overrides=False, pins=None):
+    """Set the brightness of all the lights at once
+
+    Does the same as calling set_light for every pin, but applies the
+    overrides and active low mode to the whole array in one pass.
+
+    :param brightness: a brightness between 0 and 1.0 for each pin
+    :type brightness: numpy.array
+
+    :param use_overrides: should overrides be used
+    :type use_overrides: bool
+
+    :param pins: True for each pin to set, the others are left as they
+                 are, None to set every pin
+    :type pins: numpy.array
+    """
+    global writes_suppressed
+
+    if _always_off_mask is None:
+        build_override_masks()
+
+    np.copyto(_brightness, brightness)
+    brightness = _brightness
+    np.isnan(brightness, out=_flags)
+    np.copyto(brightness, 0.0, where=_flags)
+
+    if _ACTIVE_LOW_MODE:
+        np.subtract(1.0, brightness, out=brightness)
+
+    if use_overrides:
+        np.copyto(brightness, 0.0, where=_always_off_mask)
+        np.copyto(brightness, 1.0, where=_always_on_mask)
+        np.subtract(1.0, brightness, out=_work)
+        np.copyto(brightness, _work, where=_inverted_mask)
+
+    if not network.playing and server:
+        if pins is None:
+            # one frame, with each pin known to clients as set_light sends it
+            np.take(brightness, _frame_source, out=_frame)
+            network.broadcast_levels(_frame, None)
+        else:
+            # a frame would also set the other pins, send each pin as set_light does
+            for pin in np.flatnonzero(pins).tolist():
+                network.broadcast(_pin_broadcast[pin], float(brightness[pin]))
+
+    # pwm levels are truncated, onoff pins are on above half brightness
+    np.multiply(brightness, _pwm_scale, out=_work)
+    np.copyto(_levels, _work, casting='unsafe')
+    np.greater(brightness, 0.5, out=_flags)
+    np.copyto(_levels, _flags, where=_onoff_mask)
+
+    # only write the pins whose level has changed
+    np.not_equal(_levels, _last_levels, out=_flags)
+    if pins is None:
+        selected = GPIOLEN
     else:
-        wiringpi.digitalWrite(cm.hardware.gpio_pins[pin], int(brightness > 0.5))
+        np.logical_and(_flags, pins, out=_flags)
+        selected = np.count_nonzero(pins)
+    changed = np.count_nonzero(_flags)
+    writes_suppressed += selected - changed
+
+    if changed:
+        for pin in np.flatnonzero(_flags).tolist():
+            write_level(pin, int(_levels[pin]))
 
 
 def clean_up():
@@ -335,6 +549,7 @@ def initialize():
     wiringpi.wiringPiSetup()
     enable_device()
     set_pins_as_outputs()
+    build_override_masks()
 
     turn_off_lights()
 
@@ -375,6 +590,58 @@ def light_off(pins, override=False, brightness=0.0):
         set_light(pin, use_overrides=override, brightness=brightness)
 
 
+def light_pins(light):
+    """The pins of a light, with custom channel mapping if it is used
+
+    :param light: index of the light
+    :type light: int
+
+    :return: indexes of pins in cm.hardware.gpio_pins
+    :rtype: list
+    """
+    if ccm:
+        return ccm_map[light]
+
+    return [light]
+
+
+def run_patterns(patterns, use_overrides=False, stop_event=None):
+    """Run patterns in one scheduler, writing their lights once per tick
+
+    Only the lights the patterns have set are written, the others are
+    left as they are.
+
+    :param patterns: pattern generators, see pattern_scheduler
+    :type patterns: list
+
+    :param use_overrides: should overrides be used
+    :type use_overrides: bool
+
+    :param stop_event: stops the patterns when set
+    :type stop_event: threading.Event
+    """
+    scheduler = pattern_scheduler.PatternScheduler(
+        lambda levels, used: set_lights(levels, use_overrides, used),
+        GPIOLEN, PATTERN_RATE, stop_event)
+
+    for pattern in patterns:
+        scheduler.spawn(pattern(scheduler))
+
+    scheduler.run()
+
+
+def print_channel(light):
+    """Show the gpio pins of a light"""
+    if ccm:
+        for p in ccm_map[light]:
+            print "channel %s : gpio pin number %d" % (str(p + 1), cm.hardware.gpio_pins[p])
+    else:
+        print "channel %s : gpio pin number %d" % (
+            str(light + 1), cm.hardware.gpio_pins[light])
+
+    print
+
+
 def fade(from_test=False):
     """Fade lights in and out in sequence"""
     # Test fading in and out for each light configured in pwm mode
@@ -385,32 +652,26 @@ def fade(from_test=False):
         print "custom channel mapping is being used"
         print "multiple channels may display that the same time"
 
-    while True:
-        for light in lights:
-            if ccm:
-                for p in ccm_map[light]:
-                    print "channel %s : gpio pin number %d" % (str(p + 1), cm.hardware.gpio_pins[p])
-            else:
-                print "channel %s : gpio pin number %d" % (
-                    str(light + 1), cm.hardware.gpio_pins[light])
-
-            print
+    def pattern(scheduler):
+        while True:
+            for light in lights:
+                print_channel(light)
 
-            if is_pin_pwm[light]:
-                for _ in range(flashes):
-                    for brightness in range(0, _PWM_MAX + 1):
+                if is_pin_pwm[light]:
+                    for _ in range(flashes):
                         # fade in
-                        light_on(light, False, float(brightness) / _PWM_MAX)
-                        time.sleep(sleep / _PWM_MAX)
-                    for brightness in range(_PWM_MAX - 1, -1, -1):
+                        for delay in scheduler.ramp(light_pins(light), 0.0, 1.0, sleep):
+                            yield delay
                         # fade out
-                        light_on(light, False, float(brightness) / _PWM_MAX)
-                        time.sleep(sleep / _PWM_MAX)
-            else:
-                print "channel %s not set to pwm mode" % light
+                        for delay in scheduler.ramp(light_pins(light), 1.0, 0.0, sleep):
+                            yield delay
+                else:
+                    print "channel %s not set to pwm mode" % light
 
-        if from_test:
-            return
+            if from_test:
+                return
+
+    run_patterns([pattern])
 
 
 def flash(from_test=False):
@@ -422,24 +683,21 @@ def flash(from_test=False):
         print "custom channel mapping is being used"
         print "multiple channels may display that the same time"
 
-    while True:
-        for light in lights:
-            if ccm:
-                for p in ccm_map[light]:
-                    print "channel %s : gpio pin number %d" % (str(p + 1), cm.hardware.gpio_pins[p])
-            else:
-                print "channel %s : gpio pin number %d" % (
-                    str(light + 1), cm.hardware.gpio_pins[light])
+    def pattern(scheduler):
+        while True:
+            for light in lights:
+                print_channel(light)
 
-            print
+                for _ in range(flashes):
+                    scheduler.set(light_pins(light), 1.0)
+                    yield sleep
+                    scheduler.set(light_pins(light), 0.0)
+                    yield sleep
+
+            if from_test:
+                return
 
-            for _ in range(flashes):
-                light_on(light)
-                time.sleep(sleep)
-                light_off(light)
-                time.sleep(sleep)
-        if from_test:
-            return
+    run_patterns([pattern])
 
 
 def cylon():
@@ -448,46 +706,35 @@ def cylon():
     Lights one channel at a time in order
     Then backs down to the first rapidly
     """
-    # pause for 1 second
-    time.sleep(1)
-
-    # working loop
-    print "Press <CTRL>-C to stop"
-    while True:
-        # here we just loop over the gpio pins and do something with them
-        # except the last one
-        for light in range(len(lights) - 1):
-            # turn off all the lights
-            for l in lights:
-                light_off(l)
-
-            # then turn on one
-            light_on(light)
+    def only(scheduler, light):
+        """turn off all the lights, then turn on one"""
+        for l in lights:
+            scheduler.set(light_pins(l), 0.0)
+        scheduler.set(light_pins(light), 1.0)
 
-            # wait a little bit
-            time.sleep(.06)
+    def pattern(scheduler):
+        # pause for 1 second
+        yield 1.0
 
-        # to make the transition back smoother we handle the last pin here
-        for l in lights:
-            light_off(l)
-        light_on(light + 1)
+        while True:
+            # here we just loop over the gpio pins and do something with them
+            # except the last one
+            for light in range(len(lights) - 1):
+                only(scheduler, light)
 
-        # this loop walks it back the other way
-        for light in range(len(lights) - 1, 0, -1):
-            # turn off all the lights
-            for l in lights:
-                light_off(l)
+                # wait a little bit
+                yield .06
 
-            # then turn on one
-            light_on(light)
+            # this loop walks it back the other way
+            for light in range(len(lights) - 1, 0, -1):
+                only(scheduler, light)
 
-            # wait a little bit
-            time.sleep(.06)
+                # wait a little bit
+                yield .06
 
-        # again to make it smoother handle the first pin like the last pin
-        for l in lights:
-            light_off(l)
-        light_on(light - 1)
+    # working loop
+    print "Press <CTRL>-C to stop"
+    run_patterns([pattern])
 
 
 def random_pattern():
@@ -523,39 +770,35 @@ def random_pattern():
     # your gpio pins
     pins = cm.hardware.gpio_pins
 
-    min_pause = sleep * 1000
-
     # min and max time to pause before restarting light group
+    min_pause = sleep
     max_pause = min_pause * 4.0
 
-    light_group = list()
-    step_range = [_ for _ in range(_PWM_MAX)]
-    step_range.extend([_ for _ in range(_PWM_MAX, -1, -1)])
+    def group_pattern(lits):
+        def pattern(scheduler):
+            while True:
+                yield random.uniform(min_pause, max_pause)
 
-    def the_lights(exit_e, lits):
-        while True:
-            if exit_e.is_set():
-                break
-
-            time.sleep(random.randrange(min_pause, max_pause) * .001)
-
-            # activate the lights
-            for stp in step_range:
-                for pin in lits:
-                    light_on(pins.index(pin), True, stp * .01)
+                # activate the lights
+                for delay in scheduler.ramp(lits, 0.0, 1.0, pwm_speed):
+                    yield delay
+                for delay in scheduler.ramp(lits, 1.0, 0.0, pwm_speed):
+                    yield delay
 
-                time.sleep(pwm_speed / float(_PWM_MAX))
+        return pattern
 
-    # start the threads
+    light_groups = list()
     for group in range(0, len(pins), lights_per_group):
-        light_group.append(threading.Thread(target=the_lights, args=(
-            exit_event, pins[group:group + lights_per_group],)))
-        light_group[-1].setDaemon(True)
-        light_group[-1].start()
+        lits = list()
+        for pin in pins[group:group + lights_per_group]:
+            lits.extend(light_pins(pins.index(pin)))
+
+        # with custom channel mapping a group can be left without pins
+        if lits:
+            light_groups.append(group_pattern(lits))
 
     print "press <ctrl-c> to exit"
-    while True:
-        time.sleep(.1)
+    run_patterns(light_groups, True, exit_event)
 
 
 def dance():
@@ -567,75 +810,64 @@ def dance():
     # the gpio pins in reversed order
     lights2 = lights[::-1]
 
-    # get _PWM_MAX from the hc module
-    # this is the max value for the pwm channels
-    pwm_max = _PWM_MAX
+    def pair(scheduler, light):
+        pins = light_pins(lights[light]) + light_pins(lights2[light])
 
-    # working loop, we will do this sequence 10 times then end
-    while True:
-        # here we just loop over the gpio pins and turn them on and off
-        # with the pwm feature of lightshowpi
-        for light in range(int(len(lights) / 2)):
-            if is_pin_pwm[light]:
-                for brightness in range(0, pwm_max):
-                    # fade in
-                    light_on(lights[light], 0, brightness=float(brightness) / pwm_max)
-                    light_on(lights2[light], brightness=float(brightness) / pwm_max)
-                    time.sleep(.1 / pwm_max)
+        if is_pin_pwm[light]:
+            # fade in
+            for delay in scheduler.ramp(pins, 0.0, 1.0, .1):
+                yield delay
 
-                for brightness in range(pwm_max - 1, -1, -1):
-                    # fade out
-                    light_on(lights[light], brightness=float(brightness) / pwm_max)
-                    light_on(lights2[light], brightness=float(brightness) / pwm_max)
-                    time.sleep(.1 / pwm_max)
-            else:
-                light_on(lights[light], 1)
-                light_on(lights2[light], 1)
-                time.sleep(.5)
-                light_off(lights[light], 0)
-                light_off(lights2[light], 0)
-
-        for light in range(int(len(lights) / 2) - 1, -1, -1):
-            if is_pin_pwm[light]:
-                for brightness in range(0, pwm_max):
-                    # fade in
-                    light_on(lights[light], brightness=float(brightness) / pwm_max)
-                    light_on(lights2[light], brightness=float(brightness) / pwm_max)
-                    time.sleep(.1 / pwm_max)
+            # fade out
+            for delay in scheduler.ramp(pins, 1.0, 0.0, .1):
+                yield delay
+        else:
+            scheduler.set(pins, 1.0)
+            yield .5
+            scheduler.set(pins, 0.0)
 
-                for brightness in range(pwm_max - 1, -1, -1):
-                    # fade out
-                    light_on(lights[light], brightness=float(brightness) / pwm_max)
-                    light_on(lights2[light], brightness=float(brightness) / pwm_max)
-                    time.sleep(.1 / pwm_max)
-            else:
-                light_on(lights[light], 1)
-                light_on(lights2[light], 1)
-                time.sleep(.5)
-                light_off(lights[light], 0)
-                light_off(lights2[light], 0)
+    def pattern(scheduler):
+        # working loop
+        while True:
+            # here we just loop over the gpio pins and turn them on and off
+            # with the pwm feature of lightshowpi
+            for light in range(int(len(lights) / 2)):
+                for delay in pair(scheduler, light):
+                    yield delay
+
+            for light in range(int(len(lights) / 2) - 1, -1, -1):
+                for delay in pair(scheduler, light):
+                    yield delay
+
+    run_patterns([pattern])
 
 
 def step():
     """Test fading in and out for each light configured in pwm mode"""
-    print "Press <CTRL>-C to stop"
-    while True:
-        for light in lights:
-            print "channel %s " % light
-            for brightness in range(0, _PWM_MAX):
-                # fade in
-                light_on(light, False, float(brightness) / _PWM_MAX)
-                time.sleep(sleep / _PWM_MAX)
-
-        for light in reversed(lights):
-            print "channel %s " % light
-            for brightness in range(_PWM_MAX - 1, -1, -1):
-                # fade out
+    def pattern(scheduler):
+        while True:
+            for light in lights:
+                print "channel %s " % light
+                if is_pin_pwm[light]:
+                    # fade in
+                    for delay in scheduler.ramp(light_pins(light), 0.0, 1.0, sleep):
+                        yield delay
+                else:
+                    scheduler.set(light_pins(light), 1.0)
+                    yield sleep
+
+            for light in reversed(lights):
+                print "channel %s " % light
                 if is_pin_pwm[light]:
-                    light_on(light, False, float(brightness) / _PWM_MAX)
+                    # fade out
+                    for delay in scheduler.ramp(light_pins(light), 1.0, 0.0, sleep):
+                        yield delay
                 else:
-                    light_off(light, False, 0)
-                time.sleep(sleep / _PWM_MAX)
+                    scheduler.set(light_pins(light), 0.0)
+                    yield sleep
+
+    print "Press <CTRL>-C to stop"
+    run_patterns([pattern])
 
 
 def test():
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+#
+
+"""Jitter buffer for network clients.
+
+Frames from the server carry a sequence number and a media timestamp,
+the position in the song the frame belongs to.  Wi-Fi often delivers
+packets in bursts or out of order, so instead of showing each frame as
+it arrives the client holds frames for a short delay, puts them back in
+order and shows each one at its media time on the local clock.  Frames
+that arrive after a later frame has been shown, or too late to be
+useful, are dropped.
+
+The local clock is anchored to the media clock with the smallest
+arrival offset seen (the packet that had the quickest trip), creeping
+slowly upward so the clocks can drift apart.  A jump backwards in
+sequence or media time (a new song or a restarted server) starts over.
+
+When the server schedules its frames and the client's clock has been
+synced to the server's, each frame is pushed with the local time it is
+due instead, so every client shows it at the same moment.
+"""
+
+import heapq
+import time
+
+# seconds the offset may creep up per second to follow clock drift, far
+# more than two crystal clocks drift apart but little enough not to be seen
+_DRIFT = 0.0005
+
+# a jump of this many seconds in media time means a new stream
+_RESYNC_SECONDS = 1.0
+
+# a jump back of this many sequence numbers means a new stream, frames
+# missing from further back than this are no longer expected
+_RESYNC_FRAMES = 1000
+
+
+class JitterBuffer(object):
+    """Reorder frames and release them at their media time"""
+
+    def __init__(self, delay=0.05, clock=time.time):
+        """
+        :param delay: seconds to hold each frame before showing it
+        :type delay: float
+
+        :param clock: local clock, returns seconds
+        :type clock: function
+        """
+        self.delay = delay
+        self.clock = clock
+        self.frames = list()
+        self.offset = None
+        self.offset_time = None
+        self.last_sequence = None
+        self.last_timestamp = None
+        self.highest_sequence = None
+
+        # sequence numbers skipped and counted as lost, until they arrive
+        self.missing = set()
+
+        self.received = 0
+        self.rendered = 0
+        self.late = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.lost = 0
+        self.latency_total = 0.0
+
+    def reset(self):
+        """Forget the current stream, the next frame starts a new one"""
+        self.frames = list()
+        self.offset = None
+        self.offset_time = None
+        self.last_sequence = None
+        self.last_timestamp = None
+        self.highest_sequence = None
+        self.missing = set()
+
+    def push(self, sequence, timestamp, levels, due=None):
+        """Add a frame received from the network
+
+        :param sequence: sequence number of the frame
+        :type sequence: int
+
+        :param timestamp: media time of the frame in seconds
+        :type timestamp: float
+
+        :param levels: brightness levels
+        :type levels: numpy.array
+
+        :param due: local time to show the frame, None to schedule it
+                    from its media time
+        :type due: float
+        """
+        now = self.clock()
+        self.received += 1
+
+        if self.last_timestamp is not None and (
+                timestamp < self.last_timestamp - _RESYNC_SECONDS or
+                sequence < self.last_sequence - _RESYNC_FRAMES):
+            self.reset()
+
+        sample = now - timestamp
+        if self.offset is None or sample < self.offset:
+            self.offset = sample
+        else:
+            # by the time passed, so the creep does not depend on the frame rate
+            self.offset = min(self.offset + _DRIFT * (now - self.offset_time), sample)
+        self.offset_time = now
+
+        if self.highest_sequence is not None:
+            if sequence > self.highest_sequence + 1:
+                gap = range(max(self.highest_sequence + 1, sequence - _RESYNC_FRAMES), sequence)
+                self.lost += sequence - self.highest_sequence - 1
+                self.missing.update(gap)
+
+                if len(self.missing) > _RESYNC_FRAMES:
+                    oldest = sequence - _RESYNC_FRAMES
+                    self.missing = set(missing for missing in self.missing if missing >= oldest)
+            elif sequence in self.missing:
+                # it was counted as lost when the gap was seen
+                self.missing.discard(sequence)
+                self.reordered += 1
+                self.lost -= 1
+
+        if self.highest_sequence is None or sequence > self.highest_sequence:
+            self.highest_sequence = sequence
+
+        if self.last_sequence is not None and sequence <= self.last_sequence:
+            if sequence == self.last_sequence:
+                self.duplicates += 1
+            else:
+                self.late += 1
+            return
+
+        if any(frame[0] == sequence for frame in self.frames):
+            self.duplicates += 1
+            return
+
+        if due is None:
+            due = timestamp + self.offset + self.delay
+
+        heapq.heappush(self.frames, (sequence, timestamp, due, levels))
+
+    def due(self, timestamp):
+        """Local time a frame with this media time should be shown"""
+        return timestamp + self.offset + self.delay
+
+    def time_until_next(self):
+        """Seconds until the next frame is due
+
+        :return: seconds, 0 if a frame is due now, None if the buffer is empty
+        :rtype: float
+        """
+        if not self.frames:
+            return None
+
+        return max(self.frames[0][2] - self.clock(), 0.0)
+
+    def pop_due(self):
+        """Get the frame to show now
+
+        If several frames are due only the newest is returned, the older
+        ones are counted as late.
+
+        :return: levels of the frame to show, None if no frame is due
+        :rtype: numpy.array
+        """
+        now = self.clock()
+        frame = None
+
+        while self.frames and self.frames[0][2] <= now:
+            if frame is not None:
+                self.late += 1
+            frame = heapq.heappop(self.frames)
+
+        if frame is None:
+            return None
+
+        sequence, timestamp, due, levels = frame
+
+        # more than a full delay behind, not worth showing
+        if now - due > self.delay:
+            self.late += 1
+            self.last_sequence = sequence
+            self.last_timestamp = timestamp
+            return None
+
+        self.rendered += 1
+        self.latency_total += now - due + self.delay
+        self.last_sequence = sequence
+        self.last_timestamp = timestamp
+
+        return levels
+
+    def stats(self):
+        """Packet loss, reorder and latency statistics
+
+        latency is the average time from the quickest possible arrival
+        of a frame to when it was shown, which includes the delay.
+
+        :return: statistics
+        :rtype: dict
+        """
+        return {"received": self.received,
+                "rendered": self.rendered,
+                "late": self.late,
+                "duplicates": self.duplicates,
+                "reordered": self.reordered,
+                "lost": self.lost,
+                "latency": self.latency_total / self.rendered if self.rendered else 0.0}
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+#
+
+"""Update the lights at a fixed rate.
+
+By default the lights are updated once per chunk of audio, so how often
+depends on the sample rate and number of channels of the song, and
+light_delay can only delay them by whole chunks.  The scheduler instead
+shows a frame every 1 / rate seconds.  For each frame it estimates which
+chunk of audio is playing, minus light_delay, from the playback clock
+and shows the brightness of that chunk, faded toward the next chunk by
+how far the audio is between the two (or held until the next chunk).
+
+The light stage adds the brightness of each chunk as it is computed,
+and the scheduler shows frames, in the same thread, until the audio
+reaches the chunks that have not been added yet.  The chunks of the
+last light_delay seconds, and a few more, are kept, so the delay never
+makes it wait for audio beyond the chunks it has, and the next chunk is
+computed while the current frames are shown.
+"""
+
+import logging as log
+import math
+import time
+
+import numpy as np
+
+
+class LightScheduler(object):
+    """Show frames at a fixed rate from the brightness of each chunk"""
+
+    def __init__(self, clock, stop_event, render, length, rate, delay=0.0,
+                 interpolate=True, rows_ahead=2):
+        """Constructor
+
+        :param clock: the playback clock of the song
+        :type clock: pipeline.PlaybackClock
+
+        :param stop_event: set when playback is stopped
+        :type stop_event: threading.Event
+
+        :param render: shows a frame, called with the brightness of every light
+        :type render: function
+
+        :param length: number of lights
+        :type length: int
+
+        :param rate: frames per second
+        :type rate: float
+
+        :param delay: seconds to delay the lights from the audio
+        :type delay: float
+
+        :param interpolate: fade from one chunk's brightness to the next,
+                            otherwise hold each until the next
+        :type interpolate: bool
+
+        :param rows_ahead: chunks to add before the audio reaches them
+        :type rows_ahead: int
+        """
+        self.clock = clock
+        self.stop_event = stop_event
+        self.render = render
+        self.period = 1.0 / rate
+        self.delay = delay
+        self.interpolate = interpolate
+        self.rows_ahead = max(int(rows_ahead), 1)
+
+        # chunks played during the delay, still to be shown
+        self.delay_rows = 0
+        if delay > 0 and clock.chunk_seconds > 0:
+            self.delay_rows = int(math.ceil(delay / clock.chunk_seconds))
+
+        # brightness of the most recent chunks, chunk n is in rows[n % len(rows)]
+        # unless it was never added, rows_added[n % len(rows)] is the chunk it holds
+        size = self.rows_ahead + self.delay_rows + 2
+        self.rows = [np.zeros(length, dtype='float32') for _ in range(size)]
+        self.rows_added = [-1] * size
+        self.last_row = -1
+
+        self.levels = np.zeros(length, dtype='float32')
+        self.work = np.zeros(length, dtype='float32')
+        self.fraction = np.zeros((), dtype='float32')
+
+        self.next_frame = None
+        self.shown = 0.0
+        self.frames = 0
+        self.dropped = 0
+
+    def add(self, row, levels):
+        """Add the brightness of the next chunk, and show the frames before it is needed
+
+        :param row: index of the chunk
+        :type row: int
+
+        :param levels: brightness of every light for the chunk
+        :type levels: numpy.array
+
+        :return: False if playback has stopped or finished
+        :rtype: bool
+        """
+        np.copyto(self.rows[row % len(self.rows)], levels)
+        self.rows_added[row % len(self.rows)] = row
+        self.last_row = row
+
+        return self.run(row - self.rows_ahead + 1)
+
+    def finish(self):
+        """No more chunks, show frames until the end of the last one"""
+        if self.last_row >= 0:
+            self.run(self.last_row + self.delay_rows + 1)
+
+        log.debug("Light scheduler showed " + str(self.frames) + " frames, dropped " +
+                  str(self.dropped))
+
+    def run(self, limit):
+        """Show frames until the audio reaches chunk limit
+
+        :param limit: index of the first chunk of audio to stop at
+        :type limit: int
+
+        :return: False if playback has stopped or finished
+        :rtype: bool
+        """
+        while not self.stop_event.is_set() and not self.clock.finished:
+            if self.next_frame is None:
+                self.next_frame = time.time()
+
+            playing = self.clock.position(self.next_frame)
+            if playing is None:
+                # the audio has not started yet
+                if not self.clock.wait_for(0):
+                    return False
+                self.next_frame = None
+                continue
+
+            position = playing - self.delay / self.clock.chunk_seconds
+            if playing >= limit or position >= self.last_row + 1:
+                return True
+
+            wait = self.next_frame - time.time()
+            if wait > 0 and self.stop_event.wait(wait):
+                return False
+            if self.clock.finished:
+                return False
+
+            if position >= 0:
+                self.show(position)
+
+            self.next_frame += self.period
+
+            # fallen behind, skip the frames that are already late
+            late = time.time() - self.next_frame
+            if late > self.period:
+                skipped = int(late / self.period)
+                self.dropped += skipped
+                self.next_frame += skipped * self.period
+
+        return False
+
+    def show(self, position):
+        """Show the frame for a fractional chunk index
+
+        :param position: index of the chunk, the fraction is how far it has played
+        :type position: float
+        """
+        # the estimate can step back a little each time the clock advances
+        position = max(position, self.shown)
+        self.shown = position
+
+        row = min(int(position), self.last_row)
+        if self.rows_added[row % len(self.rows)] != row:
+            # the light stage fell behind and never saw this chunk, hold the last frame
+            return
+        current = self.rows[row % len(self.rows)]
+
+        if (self.interpolate and row < self.last_row and
+                self.rows_added[(row + 1) % len(self.rows)] == row + 1):
+            following = self.rows[(row + 1) % len(self.rows)]
+            self.fraction.fill(position - row)
+            np.subtract(following, current, self.work)
+            np.multiply(self.work, self.fraction, self.work)
+            np.add(current, self.work, self.levels)
+        else:
+            np.copyto(self.levels, current)
+
+        self.render(self.levels)
+        self.frames += 1
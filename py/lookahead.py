@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+#
+
+"""Analyze the next song in the background while the current one plays.
+
+A song that has no sync file has its fft computed live as it plays.
+To avoid that, as soon as a song starts the song expected to play next
+is decoded and analyzed by a separate process.  That process runs at
+the lowest priority, optionally pinned to a spare cpu core, so it only
+uses cpu time the show does not need.
+
+The process is a fresh interpreter rather than a fork of the show, a
+fork of a process that is already running threads can inherit a lock
+that one of those threads held and hang on it.
+
+The expected next song is checked again every few seconds, by a thread
+of the show rather than the audio output loop.  If it changes, for
+example because of votes or a play_now request, the analysis stops and
+starts over with the new song.  Stopped analysis is not wasted, the
+rows computed so far are kept in the song's partial sync file.
+"""
+
+import logging as log
+import os
+import signal
+import subprocess
+import threading
+import time
+
+import pipeline
+
+
+class Lookahead(object):
+    """Keep the analysis of the expected next song running"""
+
+    def __init__(self, command, predict, interval=2.0):
+        """Constructor
+
+        :param command: returns the command line of the process that analyzes
+                        a song, command(song), the process should call
+                        run_analysis
+        :type command: function
+
+        :param predict: returns the song expected to play next, None if unknown
+        :type predict: function
+
+        :param interval: seconds between checks of the expected next song
+        :type interval: float
+        """
+        self.command = command
+        self.predict = predict
+        self.interval = interval
+        self.song = None
+        self.process = None
+        self.done = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Start checking the expected next song in a background thread"""
+        self.thread = threading.Thread(target=self.watch, name="lookahead")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def watch(self):
+        """Body of the thread, poll every interval seconds until stopped"""
+        while not self.done.is_set():
+            self.poll()
+            self.done.wait(self.interval)
+
+    def poll(self):
+        """Start, or restart, the analysis if the expected next song has changed"""
+        try:
+            song = self.predict()
+        except (IOError, OSError, ValueError, IndexError) as error:
+            log.warning("Unable to determine the next song: " + str(error))
+            return
+
+        if song == self.song:
+            return
+
+        self.stop_analysis()
+
+        if song is not None:
+            log.info("Analyzing the next song in the background: " + str(song[0]))
+            try:
+                self.process = subprocess.Popen(self.command(song), close_fds=True)
+            except OSError as error:
+                log.warning("Unable to start the background analysis: " + str(error))
+                return
+            self.song = song
+
+    def stop(self, timeout=5.0):
+        """Stop checking the next song and stop the analysis
+
+        :param timeout: seconds to wait for the analysis to stop before killing it
+        :type timeout: float
+        """
+        self.done.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        self.stop_analysis(timeout)
+
+    def stop_analysis(self, timeout=5.0):
+        """Stop the analysis
+
+        :param timeout: seconds to wait for the analysis to stop before killing it
+        :type timeout: float
+        """
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+            deadline = time.time() + timeout
+            while self.process.poll() is None and time.time() < deadline:
+                time.sleep(0.05)
+
+            if self.process.poll() is None:
+                self.process.kill()
+                self.process.wait()
+
+        self.process = None
+        self.song = None
+
+
+def run_analysis(analyze, song, cpu=-1):
+    """Body of the background process
+
+    :param analyze: called as analyze(song, stop_event), it should return
+                    soon after stop_event is set
+    :type analyze: function
+
+    :param song: song_filename, config_filename, cache_filename
+    :type song: tuple
+
+    :param cpu: cpu core to run the analysis on, -1 for any
+    :type cpu: int
+    """
+    stop_event = threading.Event()
+
+    # CTRL<C> is handled by the show, which stops this process with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    os.nice(19)
+    pipeline.set_cpu_affinity(cpu)
+
+    try:
+        analyze(song, stop_event)
+    except Exception:
+        log.exception("Background analysis of " + str(song[0]) + " failed")
@@ -10,13 +10,209 @@
 
 The network controller handles all interaction with the raspberry pi
 to send or receive data to/from lightshowpi network enabled raspberry pi(s).
+
+Data is sent as small binary packets (little endian):
+
+    header      magic, version, message type, bytes per level,
+                sequence number, timestamp, presentation time,
+                channel count
+    body        FRAME:  one quantized brightness level per channel
+                PIN:    pin number (uint16) followed by its level
+                PING / PONG:  empty
+
+The timestamp of a FRAME is its position in the song, the presentation
+time is when the server will play that part of the song, on the
+server's clock (0 if not scheduled).  Clients estimate the difference
+between their clock and the server's with an NTP style exchange: a
+client sends a PING with its send time as the timestamp to the address
+frames come from, and the server answers with a PONG echoing that
+timestamp and its own receive time as the presentation time.
+
+Levels are brightness * 200 as uint8, or * 64000 as uint16 when
+pwm_range is larger than 200, rounded down, and clients decode each to
+the middle of its step.  A client then sets the same pwm level as the
+server whenever its pwm_range divides the scale (the default 100 does),
+and the same onoff state for any brightness but exactly 0.5.
+
+Older clients only understand pickled data, and stop on a binary
+packet.  With protocol = auto the server sends pickle until an updated
+client PINGs it, which a client does as soon as it hears from a server
+it has not heard from before, then sends binary packets until no client
+has sent one for CLIENT_TIMEOUT seconds.  Older and updated clients can
+not share a server, once an updated client is heard the older ones
+stop.  Clients only unpickle data with protocol = pickle, otherwise
+they warn that the server is sending it, as they do for packets of
+another protocol VERSION.
 """
 
 import cPickle
+import errno
 import logging as log
 import socket
+import struct
+import threading
+import time
 import numpy as np
 import sys
+from collections import deque
+
+MAGIC = "LSPI"
+VERSION = 1
+
+# seconds without a PING before an auto server falls back to pickle
+CLIENT_TIMEOUT = 30.0
+
+# message types
+FRAME = 0
+PIN = 1
+PING = 2
+PONG = 3
+
+_HEADER = struct.Struct("<4sBBBxIddH")
+_PIN = struct.Struct("<H")
+# bytes per level: (dtype, value sent for full brightness)
+_LEVELS = {1: (np.dtype("<u1"), 200), 2: (np.dtype("<u2"), 64000)}
+
+
+def pack(message_type, sequence, levels, itemsize=1, pin=0, timestamp=None, presentation=0.0):
+    """Pack brightness levels into a binary packet
+
+    :param message_type: FRAME or PIN
+    :type message_type: int
+
+    :param sequence: packet sequence number
+    :type sequence: int
+
+    :param levels: brightness between 0 and 1.0 for each channel
+    :type levels: numpy.array
+
+    :param itemsize: bytes per level, 1 or 2
+    :type itemsize: int
+
+    :param pin: pin number for PIN messages
+    :type pin: int
+
+    :param timestamp: time the data belongs to, defaults to now
+    :type timestamp: float
+
+    :param presentation: server time the data should be shown, 0 for now
+    :type presentation: float
+
+    :return: the packet
+    :rtype: str
+    """
+    dtype, scale = _LEVELS[itemsize]
+    levels = np.clip(np.nan_to_num(np.asarray(levels, dtype=float)), 0.0, 1.0)
+    # rounded down, as the server's own pwm levels are
+    body = np.floor(levels * scale).astype(dtype).tostring()
+
+    if timestamp is None:
+        timestamp = time.time()
+
+    header = _HEADER.pack(MAGIC, VERSION, message_type, itemsize,
+                          sequence & 0xFFFFFFFF, timestamp, presentation, len(levels))
+
+    if message_type == PIN:
+        return header + _PIN.pack(pin) + body
+
+    return header + body
+
+
+def unpack(packet):
+    """Unpack a binary packet
+
+    :param packet: data received from the network
+    :type packet: str
+
+    :return: message type, sequence, timestamp, presentation, pin, levels
+    :rtype: tuple
+
+    :raise ValueError: if packet is not a valid packet
+    """
+    if len(packet) < _HEADER.size:
+        raise ValueError("packet too short")
+
+    magic, version, message_type, itemsize, sequence, timestamp, presentation, count = \
+        _HEADER.unpack_from(packet)
+
+    if magic != MAGIC or version != VERSION or itemsize not in _LEVELS:
+        raise ValueError("unknown packet format")
+
+    offset = _HEADER.size
+    pin = 0
+    if message_type == PIN:
+        pin, = _PIN.unpack_from(packet, offset)
+        offset += _PIN.size
+    elif message_type not in (FRAME, PING, PONG):
+        raise ValueError("unknown message type")
+
+    dtype, scale = _LEVELS[itemsize]
+    if len(packet) < offset + count * itemsize:
+        raise ValueError("packet truncated")
+
+    steps = np.frombuffer(packet, dtype=dtype, count=count, offset=offset)
+
+    # the middle of each step, so the client rounds down to the same pwm level
+    levels = (steps + 0.5) / float(scale)
+    levels[steps == 0] = 0.0
+    levels[steps >= scale] = 1.0
+
+    return message_type, sequence, timestamp, presentation, pin, levels
+
+
+class ClockSync(object):
+    """Estimate the offset between the server's clock and ours
+
+    Each PING / PONG exchange gives an offset estimate that is accurate to
+    half the round trip time, so the estimate from the quickest of the
+    recent exchanges is used.
+    """
+
+    def __init__(self, samples=8):
+        """
+        :param samples: number of recent exchanges to keep
+        :type samples: int
+        """
+        self.samples = deque(maxlen=samples)
+
+    def add(self, sent, server_time, received):
+        """Add the result of one exchange
+
+        :param sent: local time the PING was sent
+        :type sent: float
+
+        :param server_time: server time the PING was received
+        :type server_time: float
+
+        :param received: local time the PONG was received
+        :type received: float
+        """
+        round_trip = received - sent
+        offset = server_time - (sent + received) / 2.0
+        self.samples.append((round_trip, offset))
+
+    def synchronized(self):
+        """True once at least one exchange has completed"""
+        return len(self.samples) > 0
+
+    def offset(self):
+        """Server time minus local time
+
+        :return: offset in seconds
+        :rtype: float
+        """
+        return min(self.samples)[1]
+
+    def to_local(self, server_time):
+        """Convert a server time to local time
+
+        :param server_time: time on the server's clock
+        :type server_time: float
+
+        :return: the same moment on the local clock
+        :rtype: float
+        """
+        return server_time - self.offset()
 
 
 class Networking(object):
@@ -33,8 +229,25 @@ class Networking(object):
         self.port = cm.network.port
         self.network_buffer = cm.network.buffer
         self.channels = cm.network.channels
+        self.protocol = cm.network.protocol
+        self.itemsize = 1 if cm.hardware.pwm_range <= 200 else 2
+        # FRAME and PIN packets are numbered separately, clients only
+        # check FRAMEs for loss
+        self.sequence = 0
+        self.pin_sequence = 0
         self.playing = False
 
+        # when a client last sent a PING, an auto server sends pickle
+        # until one does, and again once none has for CLIENT_TIMEOUT seconds
+        self.client_seen = None
+        self.sending_legacy = self.protocol != "binary"
+        self.warned = set()
+
+        # clients sync their clock to the server's
+        self.clock_sync = ClockSync()
+        self.server_address = None
+        self.last_ping = 0.0
+
         self.network_stream = None
         self.setup()
 
@@ -54,6 +267,11 @@ class Networking(object):
             self.network_stream.bind(('', 0))
             self.network_stream.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
             log.info("streaming on port: " + str(self.port))
+
+            # answer clock sync requests from the clients
+            responder = threading.Thread(target=self.answer_pings, args=(self.network_stream,))
+            responder.setDaemon(True)
+            responder.start()
         except socket.error, msg:
             log.error('Failed create socket or bind. Error code: ' +
                       str(msg[0]) + ' : ' + msg[1])
@@ -78,6 +296,85 @@ class Networking(object):
             self.network_stream.close()
             sys.exit(1)
 
+    def answer_pings(self, stream):
+        """Answer PING packets from clients until the stream is closed
+
+        :param stream: the server's socket
+        :type stream: socket.socket
+        """
+        while True:
+            try:
+                data, address = stream.recvfrom(self.network_buffer)
+                received = time.time()
+                message_type, sequence, timestamp, _, _, _ = unpack(data)
+            except (ValueError, struct.error):
+                continue
+            except socket.error:
+                return
+
+            if message_type == PING:
+                self.client_seen = received
+
+                try:
+                    stream.sendto(pack(PONG, sequence, [], timestamp=timestamp,
+                                       presentation=received), address)
+                except socket.error:
+                    return
+
+    def legacy(self):
+        """True if the server should send pickled data
+
+        :rtype: bool
+        """
+        if self.protocol == "pickle":
+            return True
+        if self.protocol != "auto":
+            return False
+
+        return self.client_seen is None or time.time() - self.client_seen > CLIENT_TIMEOUT
+
+    def set_server(self, address):
+        """Record where the server's packets come from
+
+        Each song is played by a new server process, which sends pickle
+        until it is PINGed, so a new server is PINGed right away.
+
+        :param address: address of the server
+        :type address: tuple
+        """
+        if address != self.server_address:
+            self.server_address = address
+            self.last_ping = 0.0
+
+    def warn_once(self, key, message):
+        """Log a warning, the first time only for each key"""
+        if key not in self.warned:
+            self.warned.add(key)
+            log.warning(message)
+
+    def ping(self, interval=10.0):
+        """Send a clock sync request to the server if one is due
+
+        Requests are sent every second until a few exchanges have
+        completed, then every interval seconds.
+
+        :param interval: seconds between requests once synchronized
+        :type interval: float
+        """
+        if self.server_address is None or self.protocol == "pickle":
+            return
+
+        now = time.time()
+        if len(self.clock_sync.samples) < self.clock_sync.samples.maxlen:
+            interval = 1.0
+
+        if now - self.last_ping >= interval:
+            self.last_ping = now
+            try:
+                self.network_stream.sendto(pack(PING, 0, [], timestamp=now), self.server_address)
+            except socket.error, msg:
+                log.debug("clock sync request failed: " + str(msg))
+
     def close_connection(self):
         """Close the network stream"""
         if self.network_stream:
@@ -87,21 +384,144 @@ class Networking(object):
     def receive(self):
         """Receive the data sent from the server and decode it
 
-        :return: data
+        Packets that can not be decoded are skipped.
+
+        :return: (brightness levels,) or (pin, brightness)
         :rtype tuple: np.array | tuple
         """
-        try:
+        while True:
             data, address = self.network_stream.recvfrom(self.network_buffer)
-            data = cPickle.loads(data)
-        except (IndexError, cPickle.PickleError):
-            data = tuple(np.array([0 for _ in range(cm.hardware.gpio_len)]))
 
-        return data
+            try:
+                return self.decode(data)
+            except (ValueError, struct.error, IndexError, cPickle.PickleError) as error:
+                log.debug("Discarding packet from " + str(address) + ": " + str(error))
+
+    def receive_packet(self, timeout=None):
+        """Receive one packet with its sequence number and timestamp
+
+        Packets that can not be decoded are skipped.  Legacy pickled
+        packets have no sequence number or timestamp, these are None.
+        PONG packets are used to sync the clock and are not returned.
+
+        :param timeout: seconds to wait for a packet, None to wait forever
+        :type timeout: float
+
+        :return: message type, sequence, timestamp, presentation, pin, levels
+                 or None on timeout
+        :rtype: tuple
+        """
+        self.network_stream.settimeout(timeout)
+
+        while True:
+            try:
+                data, address = self.network_stream.recvfrom(self.network_buffer)
+            except socket.timeout:
+                return None
+            except socket.error as error:
+                # a timeout of 0 makes the socket non-blocking
+                if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return None
+                raise
+
+            try:
+                if data[:len(MAGIC)] == MAGIC:
+                    version = ord(data[len(MAGIC)]) if len(data) > len(MAGIC) else None
+                    if version != VERSION:
+                        self.warn_once(("version", version),
+                                       "Discarding packets of protocol version " + str(version) +
+                                       " from " + str(address) + ", this client understands " +
+                                       str(VERSION) + ", update the server or this client")
+
+                    packet = unpack(data)
+
+                    if packet[0] == PONG:
+                        self.clock_sync.add(packet[2], packet[3], time.time())
+                        continue
+
+                    self.set_server(address)
+                    return packet
+
+                # an auto server sends pickle until a PING reaches it
+                self.set_server(address)
+                if self.protocol != "pickle":
+                    self.warn_once("pickle",
+                                   "Discarding pickled packets from " + str(address) +
+                                   ", set protocol = pickle to accept them")
+                data = self.decode(data)
+                if len(data) == 2:
+                    return PIN, None, None, 0.0, data[0], np.array([data[1]])
+                return FRAME, None, None, 0.0, 0, np.asarray(data[0])
+            except (ValueError, struct.error, IndexError, cPickle.PickleError) as error:
+                log.debug("Discarding packet from " + str(address) + ": " + str(error))
+
+    def decode(self, data):
+        """Decode a packet
+
+        Pickled packets are only accepted when protocol = pickle, as
+        unpickling data from the network can execute arbitrary code.
+
+        :param data: packet received from the network
+        :type data: str
+
+        :return: (brightness levels,) or (pin, brightness)
+        :rtype tuple: np.array | tuple
+
+        :raise ValueError: if the packet can not be decoded
+        """
+        if data[:len(MAGIC)] == MAGIC:
+            message_type, _, _, _, pin, levels = unpack(data)
+
+            if message_type == PIN:
+                return pin, float(levels[0])
+            elif message_type != FRAME:
+                raise ValueError("not a data packet")
+
+            return levels,
+
+        if self.protocol == "pickle":
+            return cPickle.loads(data)
+
+        raise ValueError("not a lightshowpi packet")
+
+    def encode(self, args, timestamp=None, presentation=None):
+        """Encode data for broadcast
+
+        :param args: (brightness levels,) or (pin, brightness)
+        :type args: tuple
+
+        :param timestamp: media time of the data, defaults to now
+        :type timestamp: float
+
+        :param presentation: server time to show the data, None for now
+        :type presentation: float
+
+        :return: packet
+        :rtype: str
+        """
+        legacy = self.legacy()
+        if legacy != self.sending_legacy and self.protocol == "auto":
+            if legacy:
+                log.info("No updated clients are listening, sending pickled packets")
+            else:
+                log.info("Updated clients are listening, sending binary packets")
+        self.sending_legacy = legacy
+
+        if legacy:
+            return cPickle.dumps(args)
+
+        if len(args) == 2:
+            self.pin_sequence += 1
+            return pack(PIN, self.pin_sequence, [args[1]], self.itemsize, args[0], timestamp)
+
+        self.sequence += 1
+        return pack(FRAME, self.sequence, args[0], self.itemsize, timestamp=timestamp,
+                    presentation=presentation or 0.0)
 
     def broadcast(self, *args):
         """Broadcast data over the network
 
-        args will be pickled before being sent
+        args will be encoded (see encode) before being sent
 
         :param args: (list of lists) to broadcast clients channel data
 
@@ -110,13 +530,33 @@ class Networking(object):
         :type args: list | tuple
         """
         if self.networking == "server":
-            try:
-                data = cPickle.dumps(args)
-                self.network_stream.sendto(data, ('<broadcast>', self.port))
-            except socket.error, msg:
-                if msg[0] != 9:
-                    log.error(str(msg[0]) + ' ' + msg[1])
-                    print str(msg[0]) + ' ' + msg[1]
+            self.send(self.encode(args))
+
+    def broadcast_levels(self, levels, timestamp, presentation=None):
+        """Broadcast a frame of brightness levels stamped with its media time
+
+        :param levels: brightness for each channel
+        :type levels: numpy.array
+
+        :param timestamp: position in the song, in seconds, the frame belongs
+                          to, None for frames of the pre / post show, stamped now
+        :type timestamp: float
+
+        :param presentation: time.time() on this server when the frame is
+                             played, clients show it then, None to show on arrival
+        :type presentation: float
+        """
+        if self.networking == "server":
+            self.send(self.encode((levels,), timestamp, presentation))
+
+    def send(self, data):
+        """Send an encoded packet to all clients"""
+        try:
+            self.network_stream.sendto(data, ('<broadcast>', self.port))
+        except socket.error, msg:
+            if msg[0] != 9:
+                log.error(str(msg[0]) + ' ' + msg[1])
+                print str(msg[0]) + ' ' + msg[1]
 
     def set_playing(self):
         """Set a flag for playing,
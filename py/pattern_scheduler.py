@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+#
+
+"""Run light patterns in a single thread at a fixed tick rate.
+
+A pattern is a generator.  It sets the brightness of some lights with
+set(), then yields the number of seconds until it next needs to run,
+0 for the next tick.  The scheduler keeps the patterns on a heap by
+the time they are next due, and on each tick runs every pattern that
+is due, then writes the lights in one call if any were set.
+
+Ticks are counted from the start, so the timing does not drift, and a
+tick that comes around late is skipped rather than run twice.  Fades
+use the time of the tick, so they take the same time whatever the
+tick rate or the load.
+
+Third party dependencies:
+
+numpy: for the brightness of every light
+    http://www.numpy.org/
+"""
+
+import heapq
+import itertools
+import time
+
+import numpy as np
+
+
+class PatternScheduler(object):
+    """Drive any number of pattern generators from one loop"""
+
+    def __init__(self, write, length, rate=100.0, exit_event=None):
+        """Constructor
+
+        :param write: shows the lights, called as write(levels, used) with
+                      the brightness of every light and True for each
+                      light a pattern has set
+        :type write: function
+
+        :param length: number of lights
+        :type length: int
+
+        :param rate: ticks per second
+        :type rate: float
+
+        :param exit_event: stops the scheduler when set
+        :type exit_event: threading.Event
+        """
+        self.write = write
+        self.period = 1.0 / rate
+        self.exit_event = exit_event
+        self.levels = np.zeros(length, dtype=float)
+        self.used = np.zeros(length, dtype=bool)
+        self.changed = False
+        self.now = time.time()
+
+        # (due time, order added, pattern)
+        self.queue = list()
+        self.order = itertools.count()
+
+    def spawn(self, pattern, delay=0.0):
+        """Add a pattern
+
+        :param pattern: generator yielding the seconds until it runs again
+        :type pattern: generator
+
+        :param delay: seconds until it first runs
+        :type delay: float
+        """
+        heapq.heappush(self.queue, (self.now + delay, next(self.order), pattern))
+
+    def set(self, lights, brightness):
+        """Set the brightness of some lights, shown at the end of the tick
+
+        :param lights: indexes of the lights
+        :type lights: list
+
+        :param brightness: between 0 and 1.0
+        :type brightness: float
+        """
+        for light in lights:
+            self.levels[light] = brightness
+            self.used[light] = True
+        self.changed = True
+
+    def ramp(self, lights, start, end, seconds):
+        """Pattern that fades lights from one brightness to another
+
+        Used from other patterns with
+            for delay in scheduler.ramp(...):
+                yield delay
+
+        :param lights: indexes of the lights
+        :type lights: list
+
+        :param start: brightness at the start of the fade
+        :type start: float
+
+        :param end: brightness at the end of the fade
+        :type end: float
+
+        :param seconds: length of the fade
+        :type seconds: float
+        """
+        began = self.now
+        while True:
+            done = (self.now - began) / seconds if seconds > 0 else 1.0
+            if done >= 1.0:
+                self.set(lights, end)
+                return
+
+            self.set(lights, start + (end - start) * done)
+            yield 0
+
+    def wait(self, seconds):
+        """Sleep, returning early if the exit event is set
+
+        :return: True if the exit event is set
+        :rtype: bool
+        """
+        if self.exit_event is None:
+            time.sleep(seconds)
+            return False
+
+        return self.exit_event.wait(seconds)
+
+    def run(self):
+        """Run the patterns until they have all finished or the exit event is set"""
+        start = time.time()
+        tick = 0
+
+        while self.queue:
+            if self.exit_event is not None and self.exit_event.is_set():
+                return
+
+            self.now = start + tick * self.period
+
+            # patterns that yield 0 run again on the next tick, not this one
+            due = list()
+            while self.queue and self.queue[0][0] <= self.now:
+                due.append(heapq.heappop(self.queue))
+
+            for _, order, pattern in due:
+                try:
+                    delay = next(pattern)
+                except StopIteration:
+                    continue
+                heapq.heappush(self.queue, (self.now + max(delay, 0.0), order, pattern))
+
+            if self.changed:
+                self.write(self.levels, self.used)
+                self.changed = False
+
+            if not self.queue:
+                return
+
+            # the next tick a pattern is due, skipping ticks that are late
+            next_due = max(self.queue[0][0], time.time())
+            tick = max(tick + 1, int(-(-(next_due - start) // self.period)))
+
+            wait = start + tick * self.period - time.time()
+            if wait > 0 and self.wait(wait):
+                return
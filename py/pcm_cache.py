@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+#
+
+"""Cache of decoded audio.
+
+mp3, m4a and other compressed songs are decoded by an external program
+every time they are played, which on a single core Pi competes with the
+fft and the lights and delays the start of every song.  When a pcm
+cache directory is configured the decoded audio of a song is recorded
+the first time it is played, named after a hash of the song file, and
+later plays memory map the recording instead of starting a decoder.
+
+File layout (little endian):
+
+    header      magic, version, channels, frame rate, sample width, frames
+    frames      interleaved samples, as returned by decoder readframes
+
+The audio is stored uncompressed, decompressing it would cost much of
+the cpu time the cache is there to save.  Recordings are written to a
+temporary file and only renamed into place once the whole song has been
+read, so an interrupted play leaves nothing behind.  The directory is
+kept under its size limit by cache_store.
+"""
+
+import logging as log
+import mmap
+import os
+import struct
+import tempfile
+
+MAGIC = "LSPIPCM\0"
+VERSION = 1
+SUFFIX = ".pcm"
+
+_HEADER = struct.Struct("<8sHHIHxxQ4x")
+
+# songs that are already pcm are not worth caching
+_UNCOMPRESSED = (".wav",)
+
+
+class PcmFile(object):
+    """A cached song opened for playback
+
+    Implements the parts of the decoder interface used to play a song,
+    readframes is a copy out of the memory map.
+    """
+
+    def __init__(self, filename):
+        """Constructor
+
+        :param filename: path / filename of the pcm file
+        :type filename: str
+
+        :raise IOError: if the file is not a valid pcm file
+        """
+        self.filename = filename
+
+        with open(filename, "rb") as pcm_fp:
+            header = pcm_fp.read(_HEADER.size)
+            if len(header) != _HEADER.size:
+                raise IOError("Truncated pcm file header")
+
+            magic, version, self.channels, self.frame_rate, self.sample_width, self.frames = \
+                _HEADER.unpack(header)
+            if magic != MAGIC or version != VERSION:
+                raise IOError("Unsupported pcm file version " + str(version))
+
+            self.frame_size = self.channels * self.sample_width
+            if os.path.getsize(filename) < _HEADER.size + self.frames * self.frame_size:
+                raise IOError("Truncated pcm file data")
+
+            self.data = mmap.mmap(pcm_fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.position = _HEADER.size
+        self.end = _HEADER.size + self.frames * self.frame_size
+
+    def getnchannels(self):
+        return self.channels
+
+    def getsampwidth(self):
+        return self.sample_width
+
+    def getframerate(self):
+        return self.frame_rate
+
+    def getnframes(self):
+        return self.frames
+
+    def tell(self):
+        return (self.position - _HEADER.size) // self.frame_size
+
+    def rewind(self):
+        self.position = _HEADER.size
+
+    def readframes(self, count):
+        """Read up to count frames
+
+        :param count: number of frames
+        :type count: int
+
+        :return: frames, '' at the end of the song
+        :rtype: str
+        """
+        start = self.position
+        self.position = min(start + count * self.frame_size, self.end)
+
+        return self.data[start:self.position]
+
+    def close(self):
+        self.data.close()
+
+
+class PcmRecorder(object):
+    """Record a song's decoded audio to the cache as it is read
+
+    Wraps a decoder, every frame read is also written to a temporary
+    file, which is added to the cache once the end of the song is read.
+    A recording that can not be written is abandoned, the song still
+    plays.
+    """
+
+    def __init__(self, music_file, filename, store, song_filename):
+        """Constructor
+
+        :param music_file: opened song
+        :type music_file: decoder
+
+        :param filename: path / filename of the pcm file to record
+        :type filename: str
+
+        :param store: the pcm cache
+        :type store: cache_store.CacheStore
+
+        :param song_filename: path / filename of the song, for reference
+        :type song_filename: str
+        """
+        self.music_file = music_file
+        self.filename = filename
+        self.store = store
+        self.song_filename = song_filename
+        self.temp_filename = None
+        self.pcm_fp = None
+        self.length = 0
+        self.done = False
+
+    def getnchannels(self):
+        return self.music_file.getnchannels()
+
+    def getsampwidth(self):
+        return self.music_file.getsampwidth()
+
+    def getframerate(self):
+        return self.music_file.getframerate()
+
+    def getnframes(self):
+        return self.music_file.getnframes()
+
+    def _start(self):
+        """Open the temporary file, leaving room for the header"""
+        fd, self.temp_filename = tempfile.mkstemp(prefix=".pcm", dir=self.store.directory)
+        self.pcm_fp = os.fdopen(fd, "wb")
+        self.pcm_fp.write("\0" * _HEADER.size)
+
+    def _abandon(self, error):
+        """Stop recording after a write error"""
+        log.warning("Unable to cache the decoded audio of " + self.song_filename + ": " +
+                    str(error))
+        self.discard()
+        self.done = True
+
+    def _finish(self):
+        """The whole song has been read, add the recording to the cache"""
+        frame_size = self.getnchannels() * self.getsampwidth()
+
+        self.pcm_fp.seek(0)
+        self.pcm_fp.write(_HEADER.pack(MAGIC, VERSION, self.getnchannels(),
+                                       self.getframerate(), self.getsampwidth(),
+                                       self.length // frame_size))
+        self.pcm_fp.flush()
+        os.fsync(self.pcm_fp.fileno())
+        self.pcm_fp.close()
+        self.pcm_fp = None
+
+        os.rename(self.temp_filename, self.filename)
+        self.temp_filename = None
+        self.store.touch(self.filename, self.song_filename)
+        log.info("Cached the decoded audio of " + self.song_filename)
+
+    def readframes(self, count):
+        """Read up to count frames, recording them
+
+        :param count: number of frames
+        :type count: int
+
+        :return: frames, '' at the end of the song
+        :rtype: str
+        """
+        data = self.music_file.readframes(count)
+
+        if not self.done:
+            try:
+                if self.pcm_fp is None:
+                    self._start()
+
+                if data != '':
+                    self.pcm_fp.write(data)
+                    self.length += len(data)
+                else:
+                    self._finish()
+                    self.done = True
+            except (IOError, OSError) as error:
+                self._abandon(error)
+
+        return data
+
+    def discard(self):
+        """Throw away an unfinished recording"""
+        if self.pcm_fp is not None:
+            self.pcm_fp.close()
+            self.pcm_fp = None
+
+        if self.temp_filename is not None:
+            try:
+                os.remove(self.temp_filename)
+            except OSError:
+                pass
+            self.temp_filename = None
+
+    def close(self):
+        self.discard()
+        self.done = True
+        self.music_file.close()
+
+
+def open_song(store, song_filename, decode):
+    """Open a song, from the cache if its decoded audio is there
+
+    :param store: the pcm cache
+    :type store: cache_store.CacheStore
+
+    :param song_filename: path / filename of the song
+    :type song_filename: str
+
+    :param decode: opens the song with a decoder, called as decode(song_filename)
+    :type decode: function
+
+    :return: PcmFile if the song is cached, otherwise the decoder, wrapped
+             in a PcmRecorder if the song should be cached
+    :rtype: PcmFile | PcmRecorder | decoder
+    """
+    if song_filename.lower().endswith(_UNCOMPRESSED):
+        return decode(song_filename)
+
+    filename = store.cache_filename(song_filename)
+
+    if store.contains(filename):
+        try:
+            music_file = PcmFile(filename)
+            store.touch(filename)
+            log.debug("Playing decoded audio from " + filename)
+            return music_file
+        except (EnvironmentError, ValueError) as error:
+            log.warning("Ignoring cached audio '" + filename + "': " + str(error))
+
+    return PcmRecorder(decode(song_filename), filename, store, song_filename)
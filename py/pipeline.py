@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+#
+
+"""Producer / consumer pipeline used to play a song.
+
+Playback is split into three stages so a slow FFT or light update can
+not delay the next write to the sound card:
+
+    decoder     reads chunks from the music file into two bounded queues
+    output      writes chunks to the audio device and advances the clock
+    lights      computes (or reads cached) fft levels and updates the
+                lights when the clock reaches each chunk
+
+Only the output stage holds the decoder back.  If the light stage falls
+behind, the oldest chunk waiting for it is dropped rather than making
+the decoder, and so the audio, wait for the lights.
+
+The decoder and light stages run as daemon threads, optionally pinned to
+their own cpu core, the output stage runs in the callers thread.
+"""
+
+import ctypes
+import ctypes.util
+import logging as log
+import Queue
+import threading
+import time
+
+try:
+    _LIBC = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _LIBC.sched_setaffinity
+except (OSError, AttributeError):
+    _LIBC = None
+
+
+def set_cpu_affinity(cpu):
+    """Pin the calling thread to a single cpu core
+
+    :param cpu: index of the core, negative values leave the thread unpinned
+    :type cpu: int
+
+    :return: True if the thread was pinned
+    :rtype: bool
+    """
+    if cpu < 0 or _LIBC is None:
+        return False
+
+    mask = ctypes.c_ulong(1 << cpu)
+
+    # pid 0 is the calling thread
+    if _LIBC.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        log.warning("Unable to pin thread to cpu " + str(cpu))
+        return False
+
+    return True
+
+
+class PlaybackClock(object):
+    """The chunk of audio most recently handed to the output device
+
+    Shared by the output stage, which advances it, and the light stage,
+    which waits on it so lights follow the audio that is actually playing.
+    """
+
+    def __init__(self, chunk_seconds=0.0):
+        """
+        :param chunk_seconds: playing time of one chunk
+        :type chunk_seconds: float
+        """
+        self.row = -1
+        self.time = None
+        self.chunk_seconds = chunk_seconds
+        self.finished = False
+        self.condition = threading.Condition()
+
+    def advance(self, row):
+        """Record that row has been written to the audio device
+
+        :param row: index of the chunk
+        :type row: int
+        """
+        with self.condition:
+            self.row = row
+            self.time = time.time()
+            self.condition.notify_all()
+
+    def time_of(self, row):
+        """Estimate when row will be written to the audio device
+
+        :param row: index of the chunk
+        :type row: int
+
+        :return: time.time() the row is written
+        :rtype: float
+        """
+        with self.condition:
+            if self.time is None:
+                return time.time() + (row + 1) * self.chunk_seconds
+            return self.time + (row - self.row) * self.chunk_seconds
+
+    def position(self, when):
+        """Estimate the chunk of audio playing at a given time
+
+        :param when: time.time() to estimate for
+        :type when: float
+
+        :return: fractional index of the chunk, None before the first chunk is played
+        :rtype: float
+        """
+        with self.condition:
+            if self.time is None:
+                return None
+            return self.row + (when - self.time) / self.chunk_seconds
+
+    def finish(self):
+        """Release anyone waiting, no more audio will be played"""
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+    def wait_for(self, row):
+        """Block until row has been played
+
+        :param row: index of the chunk
+        :type row: int
+
+        :return: False if playback finished before reaching row
+        :rtype: bool
+        """
+        with self.condition:
+            while self.row < row and not self.finished:
+                self.condition.wait()
+
+            return self.row >= row
+
+
+class Pipeline(object):
+    """Queues, clock and threads for one song"""
+
+    def __init__(self, decode_depth=16, light_depth=16, cpus=None):
+        """
+        :param decode_depth: chunks the decoder may read ahead of the output
+        :type decode_depth: int
+
+        :param light_depth: chunks the light stage may fall behind the decoder
+        :type light_depth: int
+
+        :param cpus: cpu cores for the decoder, output and light stages
+        :type cpus: list
+        """
+        self.pcm_queue = Queue.Queue(max(decode_depth, 1))
+        self.light_queue = Queue.Queue(max(light_depth, 1))
+        self.clock = PlaybackClock()
+        self.stop_event = threading.Event()
+        self.cpus = list(cpus or []) + [-1, -1, -1]
+        self.threads = list()
+
+        # chunks the light stage fell too far behind to see
+        self.light_dropped = 0
+
+    def put(self, queue, item):
+        """Put item on a bounded queue, giving up if the pipeline is stopped
+
+        :return: False if the pipeline was stopped
+        :rtype: bool
+        """
+        while not self.stop_event.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                continue
+
+        return False
+
+    def offer(self, queue, item):
+        """Put item on a bounded queue without waiting, dropping the oldest item if it is full"""
+        while True:
+            try:
+                queue.put_nowait(item)
+                return
+            except Queue.Full:
+                pass
+
+            try:
+                queue.get_nowait()
+                self.light_dropped += 1
+            except Queue.Empty:
+                pass
+
+    def get(self, queue):
+        """Get the next item from a queue, None once the pipeline is stopped"""
+        while not self.stop_event.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+
+        return None
+
+    def decode(self, music_file, chunk_size):
+        """Decoder stage, feed each chunk to the output and light stages
+
+        :param music_file: opened music file
+        :type music_file: decoder | wave
+
+        :param chunk_size: frames per chunk
+        :type chunk_size: int
+        """
+        row = 0
+        data = music_file.readframes(chunk_size)
+
+        while data != '':
+            if not self.put(self.pcm_queue, (row, data)):
+                return
+            self.offer(self.light_queue, (row, data))
+
+            data = music_file.readframes(chunk_size)
+            row += 1
+
+        self.put(self.pcm_queue, None)
+        self.offer(self.light_queue, None)
+
+    def start(self, music_file, chunk_size, light_stage):
+        """Start the decoder and light threads
+
+        :param light_stage: called with this pipeline in its own thread
+        :type light_stage: function
+        """
+        self.clock.chunk_seconds = chunk_size / float(music_file.getframerate())
+        self.start_thread("decoder", self.cpus[0], self.decode, music_file, chunk_size)
+        set_cpu_affinity(self.cpus[1])
+        self.start_thread("lights", self.cpus[2], light_stage, self)
+
+    def start_thread(self, name, cpu, target, *args):
+        """Start a pipeline stage as a daemon thread"""
+        def run():
+            set_cpu_affinity(cpu)
+            try:
+                target(*args)
+            except Exception:
+                log.exception("Playback " + name + " stage failed")
+                self.stop_event.set()
+                self.clock.finish()
+
+        thread = threading.Thread(target=run, name=name)
+        thread.setDaemon(True)
+        thread.start()
+        self.threads.append(thread)
+
+    def chunks(self):
+        """Output stage, yields (row, data) for each decoded chunk in order"""
+        while True:
+            item = self.get(self.pcm_queue)
+            if item is None:
+                return
+            yield item
+
+    def light_chunks(self):
+        """Light stage, yields (row, data) for each decoded chunk in order"""
+        while True:
+            item = self.get(self.light_queue)
+            if item is None:
+                return
+            yield item
+
+    def finish(self):
+        """All audio has been played, let the light stage drain its queue"""
+        self.clock.finish()
+        for thread in self.threads:
+            thread.join()
+
+    def stop(self):
+        """Stop every stage now, used when playback is interrupted"""
+        self.stop_event.set()
+        self.clock.finish()
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+#
+
+"""Playlist shared by the player and check_sms.
+
+The playlist is a tab separated file, one song per line:
+
+    <song name><tab><path to song>[<tab><voters>[<tab>playing!]]
+
+voters is a comma separated list of the phone numbers that voted for
+the song, and "playing!" marks a voted for song that has started
+playing, so check_sms can tell its voters.
+
+Instead of each reader parsing the whole file, and each vote rewriting
+it, a PlaylistStore keeps the playlist in memory and records changes
+in an append only log next to it (the playlist filename plus ".log"),
+one event per line:
+
+    vote<tab><path to song><tab><voter>
+    playing<tab><path to song>
+    played<tab><path to song>       votes counted, clear them
+
+refresh() only reads what other processes have appended to the log
+since it was last called, and only parses the playlist again when the
+playlist file itself has changed.  Once the log is long the playlist is
+rewritten with the votes in it and the log is emptied.  The song with
+the most votes is kept on a heap, so finding it does not scan the
+playlist.
+"""
+
+import csv
+import errno
+import fcntl
+import heapq
+import logging as log
+import os
+import tempfile
+
+PLAYING = "playing!"
+
+# events in the log before it is folded into the playlist
+COMPACT_AFTER = 200
+
+
+class PlaylistStore(object):
+    """In memory playlist, kept in step with the playlist file and its log
+
+    songs is a list with one [name, path, set of voters] list per song,
+    with PLAYING appended to the songs that are playing because of votes.
+    """
+
+    def __init__(self, filename, compact_after=COMPACT_AFTER):
+        """Constructor
+
+        :param filename: path / filename of the playlist
+        :type filename: str
+
+        :param compact_after: events in the log before it is folded into the playlist
+        :type compact_after: int
+        """
+        self.filename = filename
+        self.log_filename = filename + ".log"
+        self.compact_after = compact_after
+
+        self.songs = list()
+        self.index = dict()
+        self.heap = list()
+        self.playlist_stat = None
+        self.log_offset = 0
+        self.log_events = 0
+
+        self.refresh()
+
+    def refresh(self, log_fp=None):
+        """Pick up changes made by other processes
+
+        :param log_fp: the log, already open and locked, by default it is
+                       opened for the read
+        :type log_fp: file
+
+        :return: True if anything changed
+        :rtype: bool
+        """
+        try:
+            playlist_stat = os.stat(self.filename)
+        except OSError:
+            playlist_stat = None
+
+        try:
+            log_size = os.path.getsize(self.log_filename)
+        except OSError:
+            log_size = 0
+
+        if _stat_key(playlist_stat) != _stat_key(self.playlist_stat) or log_size < self.log_offset:
+            self.load(log_fp)
+            return True
+
+        if log_size > self.log_offset:
+            self.read_log(log_fp)
+            return True
+
+        return False
+
+    def load(self, log_fp=None):
+        """Parse the playlist file, then replay the whole log
+
+        :param log_fp: the log, already open and locked, by default it is
+                       opened for the read
+        :type log_fp: file
+        """
+        songs = list()
+
+        with open(self.filename, 'rb') as playlist_fp:
+            fcntl.lockf(playlist_fp, fcntl.LOCK_SH)
+            self.playlist_stat = os.fstat(playlist_fp.fileno())
+
+            for song in csv.reader(playlist_fp, delimiter='\t'):
+                if len(song) < 2 or len(song) > 4:
+                    log.error('Invalid playlist.  Each line should be in the form: '
+                              '<song name><tab><path to song>')
+                    log.warning('Ignoring invalid entry: ' + str(song))
+                    continue
+
+                voters = set()
+                if len(song) > 2:
+                    voters = set(voter for voter in song[2].split(',') if voter)
+
+                entry = [song[0], song[1], voters]
+                if len(song) == 4:
+                    entry.append(PLAYING)
+                songs.append(entry)
+
+            fcntl.lockf(playlist_fp, fcntl.LOCK_UN)
+
+        self.songs = songs
+        self.index = dict()
+        for index, song in enumerate(songs):
+            self.index.setdefault(song[1], index)
+
+        self.rebuild_heap()
+
+        self.log_offset = 0
+        self.log_events = 0
+        self.read_log(log_fp)
+
+    def read_log(self, log_fp=None):
+        """Apply the events appended to the log since it was last read
+
+        :param log_fp: the log, already open and locked, by default it is
+                       opened for the read
+        :type log_fp: file
+        """
+        if log_fp is not None:
+            # closing another descriptor of the log would release its lock
+            log_fp.seek(self.log_offset)
+            data = log_fp.read()
+        else:
+            try:
+                with open(self.log_filename, 'rb') as log_fp:
+                    log_fp.seek(self.log_offset)
+                    data = log_fp.read()
+            except IOError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+                return
+
+        # a line that is still being written is read next time
+        end = data.rfind('\n') + 1
+        self.log_offset += end
+
+        for line in data[:end].splitlines():
+            self.apply(line.split('\t'))
+            self.log_events += 1
+
+    def apply(self, event):
+        """Apply an event from the log to the in memory playlist
+
+        Applying an event twice has no further effect.
+
+        :param event: event name and arguments
+        :type event: list
+
+        :return: True if the playlist changed
+        :rtype: bool
+        """
+        index = self.index.get(event[1]) if len(event) > 1 else None
+        if index is None:
+            return False
+
+        song = self.songs[index]
+
+        if event[0] == 'vote' and len(event) > 2:
+            if event[2] in song[2]:
+                return False
+            song[2].add(event[2])
+        elif event[0] == 'playing':
+            if len(song) > 3:
+                return False
+            song.append(PLAYING)
+        elif event[0] == 'played':
+            if len(song) == 3 and not song[2]:
+                return False
+            song[2] = set()
+            del song[3:]
+        else:
+            log.warning("Unknown playlist event: " + str(event))
+            return False
+
+        self.push_heap(index)
+        return True
+
+    def rebuild_heap(self):
+        """Start the heap over with only the current votes"""
+        self.heap = [(-len(song[2]), -index) for index, song in enumerate(self.songs)
+                     if song[2] and len(song) == 3]
+        heapq.heapify(self.heap)
+
+    def push_heap(self, index):
+        """Record the current votes of a song on the heap
+
+        The heap is ordered by votes, then by position in the playlist with
+        later songs first.  Entries are not removed when a song's votes
+        change, most_voted skips the entries that are out of date.
+        """
+        song = self.songs[index]
+        if song[2] and len(song) == 3:
+            heapq.heappush(self.heap, (-len(song[2]), -index))
+
+    def most_voted(self):
+        """Get the index of the song with the most votes that is not yet playing
+
+        :return: index of the song, None if no song has votes
+        :rtype: int
+        """
+        while self.heap:
+            votes, index = self.heap[0]
+            song = self.songs[-index]
+            if len(song) == 3 and len(song[2]) == -votes:
+                return -index
+            heapq.heappop(self.heap)
+
+        return None
+
+    def append(self, index, *event):
+        """Apply an event to a song and add it to the log
+
+        :param index: index of the song
+        :type index: int
+
+        :param event: event name and any further arguments
+        :type event: str
+        """
+        event = [event[0], self.songs[index][1]] + list(event[1:])
+        if not self.apply(event):
+            return
+
+        with open(self.log_filename, 'ab') as log_fp:
+            fcntl.lockf(log_fp, fcntl.LOCK_EX)
+            log_fp.write('\t'.join(event) + '\n')
+            log_fp.flush()
+            fcntl.lockf(log_fp, fcntl.LOCK_UN)
+
+        self.log_events += 1
+        if self.log_events >= self.compact_after:
+            self.compact()
+
+    def vote(self, index, voter):
+        """Add a vote for a song
+
+        :param index: index of the song
+        :type index: int
+
+        :param voter: who voted, each voter counts once per song
+        :type voter: str
+        """
+        self.append(index, 'vote', voter)
+
+    def start_playing(self, index):
+        """Mark a voted for song as playing"""
+        self.append(index, 'playing')
+
+    def played(self, index):
+        """Clear the votes of a song whose voters have been told it is playing"""
+        self.append(index, 'played')
+
+    def compact(self):
+        """Write the playlist with the current votes and empty the log"""
+        with open(self.log_filename, 'a+b') as log_fp:
+            # appends wait until the log has been folded in, the log is
+            # read through this descriptor so the lock is held throughout
+            fcntl.lockf(log_fp, fcntl.LOCK_EX)
+            try:
+                self.refresh(log_fp)
+
+                directory = os.path.dirname(os.path.abspath(self.filename))
+                fd, temp_filename = tempfile.mkstemp(prefix=".playlist", dir=directory)
+                with os.fdopen(fd, 'wb') as playlist_fp:
+                    writer = csv.writer(playlist_fp, delimiter='\t')
+                    for song in self.songs:
+                        row = song[:2]
+                        if song[2] or len(song) > 3:
+                            row.append(",".join(sorted(song[2])))
+                        row.extend(song[3:])
+                        writer.writerow(row)
+
+                if os.path.exists(self.filename):
+                    os.chmod(temp_filename, os.stat(self.filename).st_mode & 0o777)
+                os.rename(temp_filename, self.filename)
+                log_fp.truncate(0)
+
+                self.playlist_stat = os.stat(self.filename)
+                self.log_offset = 0
+                self.log_events = 0
+                self.rebuild_heap()
+            finally:
+                fcntl.lockf(log_fp, fcntl.LOCK_UN)
+
+
+def _stat_key(playlist_stat):
+    """The parts of a stat that change when a file is rewritten"""
+    if playlist_stat is None:
+        return None
+    return playlist_stat.st_ino, playlist_stat.st_mtime, playlist_stat.st_size
@@ -30,6 +30,8 @@ import sys
 import time
 import threading
 
+import show_timeline
+
 
 class PrePostShow(object):
     """The PreshowPostshow class handles all pre-show and post-show logic
@@ -43,7 +45,7 @@ class PrePostShow(object):
     done = 0
     play_now_interrupt = 1
 
-    def __init__(self, show="preshow", hardware=None):
+    def __init__(self, show="preshow", hardware=None, interrupt=None):
         """
 
         :param show: which show should be preformed
@@ -51,6 +53,10 @@ class PrePostShow(object):
 
         :param hardware: an instance of hardware_controller.py
         :type hardware: object
+
+        :param interrupt: set when play now is requested through the control
+                          channel, the state file is checked as well
+        :type interrupt: threading.Event
         """
         if hardware:
             self.hc = hardware
@@ -61,19 +67,66 @@ class PrePostShow(object):
         self.config = self.hc.cm.lightshow.get(show)
         self.show = show
         self.audio = None
+        self.interrupt = interrupt
+
+        # transitions are compiled once, into keyframes for every light
+        self.timeline = None
+        if isinstance(self.config, dict) and 'transitions' in self.config:
+            try:
+                self.timeline = show_timeline.compile_show(self.config, self.hc.GPIOLEN)
+            except (KeyError, TypeError, ValueError, AttributeError) as error:
+                logging.error("Invalid " + show + " transitions: " + str(error))
 
     def check_state(self):
         """Check State file
 
         Check the state file to see if play now requested
         """
-        # refresh state
-        self.hc.cm.load_state()
+        # refresh state, only re-reading the file if it has changed, play now
+        # requests through the control channel update the state directly,
+        # but the file is still written when the channel fails
+        self.hc.cm.refresh_state()
         if int(self.hc.cm.get_state('play_now', "0")):
             # play now requested!
             return True
         return False
 
+    def wait(self, seconds):
+        """Sleep between checks of the state, waking early for play now
+
+        :param seconds: longest time to wait
+        :type seconds: float
+        """
+        if self.interrupt is None:
+            time.sleep(seconds)
+        else:
+            self.interrupt.wait(seconds)
+
+    def interrupted(self, seconds):
+        """Wait, returning as soon as play now is requested
+
+        :param seconds: longest time to wait
+        :type seconds: float
+
+        :return: True if play now was requested
+        :rtype: bool
+        """
+        end = time.time() + seconds
+        while True:
+            if self.check_state():
+                return True
+
+            remaining = end - time.time()
+            if remaining <= 0:
+                return False
+
+            # check the state file every ~ .1 seconds, the control channel
+            # wakes us early
+            if self.interrupt is not None and not self.interrupt.is_set():
+                self.interrupt.wait(min(remaining, 0.1))
+            else:
+                time.sleep(min(remaining, 0.1))
+
     def execute(self):
         """Execute the pre/post show as defined by the current config
 
@@ -94,48 +147,19 @@ class PrePostShow(object):
         # start the audio if there is any
         self.start_audio()
 
-        if 'transitions' in self.config:
+        # the timeline is played against the clock the audio started on
+        start = time.time()
+
+        if self.timeline is not None:
             try:
                 # display transition based show
-                for transition in self.config['transitions']:
-                    start = time.time()
-
-                    if transition['type'].lower() == 'on':
-                        self.hc.turn_on_lights(True)
-                    else:
-                        self.hc.turn_off_lights(True)
-
-                    logging.debug('Transition to ' + transition['type'] + ' for '
-                                  + str(transition['duration']) + ' seconds')
-
-                    if 'channel_control' in transition:
-                        channel_control = transition['channel_control']
-
-                        for key in channel_control.keys():
-                            mode = key
-                            channels = channel_control[key]
-
-                            for channel in channels:
-                                if mode == 'on':
-                                    self.hc.set_light(int(channel) - 1, True, 1)
-                                elif mode == 'off':
-                                    self.hc.set_light(int(channel) - 1, True, 0)
-                                else:
-                                    logging.error("Unrecognized channel_control mode "
-                                                  "defined in preshow_configuration "
-                                                  + str(mode))
-
-                    # hold transition for specified time
-                    while transition['duration'] > (time.time() - start):
-                        # check for play now
-                        if self.check_state():
-                            # kill the audio playback if playing
-                            if self.audio:
-                                os.killpg(self.audio.pid, signal.SIGTERM)
-                                self.audio = None
-                            return PrePostShow.play_now_interrupt
-
-                        time.sleep(0.1)
+                if self.timeline.play(lambda levels: self.hc.set_lights(levels, True),
+                                      self.interrupted, start):
+                    # kill the audio playback if playing
+                    if self.audio:
+                        os.killpg(self.audio.pid, signal.SIGTERM)
+                        self.audio = None
+                    return PrePostShow.play_now_interrupt
             except KeyboardInterrupt:
                 pass
 
@@ -164,7 +188,7 @@ class PrePostShow(object):
 
                     return PrePostShow.play_now_interrupt
 
-                time.sleep(0.1)
+                self.wait(0.1)
 
         return PrePostShow.done
 
@@ -197,7 +221,7 @@ class PrePostShow(object):
                 break
 
             # Check once every ~ .1 seconds to break out
-            time.sleep(0.1)
+            self.wait(0.1)
 
         # restore path
         sys.path[:] = path
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+#
+
+"""Timeline of a transition based pre or post show.
+
+The transitions of a preshow_configuration or postshow_configuration
+are compiled, once, into a list of keyframes: the time of each keyframe
+from the start of the show, and the brightness of every light at that
+time.  Between two keyframes every light fades linearly from one to the
+other, two keyframes at the same time are a step, and two keyframes
+with the same brightness are a hold.
+
+Besides "type", "duration" and "channel_control", a transition may have
+
+    "fade": <seconds>
+        fade from the previous transition's brightness to this one's
+        over the first seconds of the transition instead of switching
+
+    "ramps": [{"channels": [<channel>, ...], "to": <brightness>,
+               "duration": <seconds>, "delay": <seconds>, "from": <brightness>}]
+        fade single channels during the transition, starting delay
+        seconds after the end of any fade, from their brightness at the
+        time or "from", to "to", then hold that brightness until the
+        next transition
+
+The show is played against the clock it started on, each keyframe is
+shown when it is due, so it does not drift however many transitions
+there are.  While lights fade frames are shown at a fixed rate, and
+while they hold nothing is done until the next keyframe or until the
+show is interrupted.
+
+Third party dependencies:
+
+numpy: for the brightness of every light
+    http://www.numpy.org/
+"""
+
+import bisect
+import logging
+import time
+
+import numpy as np
+
+# frames per second while lights are fading
+FADE_RATE = 50.0
+
+
+class Channel(object):
+    """Brightness of one light over time, a list of points joined by fades"""
+
+    def __init__(self):
+        self.times = [0.0]
+        self.values = [0.0]
+
+    def add(self, when, value):
+        """Add a point, points at the same time as the last are a step"""
+        self.times.append(max(when, self.times[-1]))
+        self.values.append(value)
+
+    def last(self):
+        """Brightness after the last point"""
+        return self.values[-1]
+
+    def at(self, when):
+        """Brightness just before and just after a time
+
+        :return: brightness before, brightness after
+        :rtype: tuple
+        """
+        return self.value(when, bisect.bisect_left), self.value(when, bisect.bisect_right)
+
+    def value(self, when, search):
+        """Brightness at a time, from the left or the right of any step"""
+        index = search(self.times, when)
+        if index == 0:
+            return self.values[0]
+        if index == len(self.times):
+            return self.values[-1]
+
+        start, end = self.times[index - 1], self.times[index]
+        if end == start:
+            return self.values[index]
+
+        done = (when - start) / (end - start)
+        return self.values[index - 1] + (self.values[index] - self.values[index - 1]) * done
+
+
+class Timeline(object):
+    """Keyframes of a show, and playing them"""
+
+    def __init__(self, times, levels):
+        """Constructor
+
+        :param times: seconds from the start of the show of each keyframe, in order
+        :type times: numpy.array
+
+        :param levels: brightness of every light at each keyframe, one row per keyframe
+        :type levels: numpy.array
+        """
+        self.times = times
+        self.levels = levels
+        self.duration = float(times[-1]) if len(times) else 0.0
+
+        # segments where every light holds its brightness
+        self.holds = np.all(levels[1:] == levels[:-1], axis=1)
+
+    def __len__(self):
+        return len(self.times)
+
+    def levels_at(self, when, segment, out):
+        """Brightness of every light at a time
+
+        :param when: seconds from the start of the show
+        :type when: float
+
+        :param segment: index of the keyframe at or before when
+        :type segment: int
+
+        :param out: array to write the brightness to
+        :type out: numpy.array
+        """
+        start, end = self.times[segment], self.times[segment + 1]
+        if self.holds[segment] or end <= start:
+            np.copyto(out, self.levels[segment + 1])
+            return
+
+        done = min(max((when - start) / (end - start), 0.0), 1.0)
+        np.subtract(self.levels[segment + 1], self.levels[segment], out)
+        out *= done
+        out += self.levels[segment]
+
+    def play(self, write, wait, start=None, rate=FADE_RATE):
+        """Show the timeline
+
+        :param write: shows the lights, called with the brightness of every light
+        :type write: function
+
+        :param wait: waits up to a number of seconds, returns True if the
+                     show should stop
+        :type wait: function
+
+        :param start: time the show started, default now
+        :type start: float
+
+        :param rate: frames per second while lights are fading
+        :type rate: float
+
+        :return: True if the show was interrupted
+        :rtype: bool
+        """
+        if len(self.times) < 2:
+            return False
+
+        if start is None:
+            start = time.time()
+        period = 1.0 / rate
+
+        levels = np.empty(self.levels.shape[1], dtype=self.levels.dtype)
+        segment = 0
+        last_segment = len(self.times) - 2
+        shown = -1
+
+        while True:
+            now = time.time() - start
+
+            # skip to the segment playing now, steps are zero length segments
+            while segment < last_segment and self.times[segment + 1] <= now:
+                segment += 1
+
+            if now >= self.duration:
+                write(self.levels[-1])
+                return False
+
+            # a hold only needs to be shown once
+            if not self.holds[segment] or shown != segment:
+                self.levels_at(now, segment, levels)
+                write(levels)
+                shown = segment
+
+            if self.holds[segment]:
+                due = self.times[segment + 1]
+            else:
+                # next frame on the show's clock, not a period after this one
+                due = min(self.times[segment + 1], (int(now / period) + 1) * period)
+
+            if wait(start + due - time.time()):
+                return True
+
+
+def compile_show(config, length):
+    """Compile the transitions of a show into a timeline
+
+    :param config: the show, parsed from json
+    :type config: dict
+
+    :param length: number of lights
+    :type length: int
+
+    :return: the show's keyframes
+    :rtype: Timeline
+    """
+    channels = [Channel() for _ in range(length)]
+    now = 0.0
+
+    for transition in config.get('transitions', []):
+        duration = float(transition['duration'])
+        target = [1.0 if transition['type'].lower() == 'on' else 0.0] * length
+
+        for mode, selected in transition.get('channel_control', {}).items():
+            if mode not in ('on', 'off'):
+                logging.error("Unrecognized channel_control mode defined in show "
+                              "configuration " + str(mode))
+                continue
+
+            for channel in _indexes(selected, length):
+                target[channel] = 1.0 if mode == 'on' else 0.0
+
+        fade = min(float(transition.get('fade', 0.0)), duration)
+        for channel, value in zip(channels, target):
+            # hold until the transition starts
+            channel.add(now, channel.last())
+            channel.add(now + fade, value)
+
+        for ramp in sorted(transition.get('ramps', []), key=lambda r: r.get('delay', 0.0)):
+            begin = now + fade + float(ramp.get('delay', 0.0))
+            end = min(begin + float(ramp['duration']), now + duration)
+
+            for index in _indexes(ramp['channels'], length):
+                channel = channels[index]
+                ramp_begin = max(begin, channel.times[-1])
+                if ramp_begin >= end:
+                    continue
+
+                channel.add(ramp_begin, channel.last())
+                channel.add(ramp_begin, float(ramp.get('from', channel.last())))
+                channel.add(end, float(ramp['to']))
+
+        now += duration
+
+    for channel in channels:
+        channel.add(now, channel.last())
+
+    # a keyframe at every point of every channel, two where any light steps
+    times = list()
+    levels = list()
+    for when in sorted(set(when for channel in channels for when in channel.times)):
+        before, after = zip(*[channel.at(when) for channel in channels])
+        times.append(when)
+        levels.append(before)
+        if before != after:
+            times.append(when)
+            levels.append(after)
+
+    return Timeline(np.array(times, dtype=float), np.array(levels, dtype=float))
+
+
+def _indexes(selected, length):
+    """Light indexes of 1 based channel numbers, ignoring those out of range"""
+    indexes = list()
+    for channel in selected:
+        if 0 < int(channel) <= length:
+            indexes.append(int(channel) - 1)
+        else:
+            logging.error("Show configuration channel " + str(channel) + " is out of range")
+
+    return indexes
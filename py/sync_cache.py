@@ -0,0 +1,527 @@
+#!/usr/bin/env python
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+#
+
+"""Binary, memory mapped sync cache files.
+
+A sync file holds the FFT levels computed for every chunk of a song,
+preceded by the standard deviation and mean of each channel.  Older
+versions of lightshowpi saved these with numpy.savetxt, which forces the
+whole song to be parsed before the first chunk can play.  This module
+stores the same data as float32 rows behind a small versioned header so
+it can be memory mapped and read on demand.
+
+File layout (little endian):
+
+    header      magic, version, reserved, columns, rows, config length
+    config      json encoded fft configuration used to build the matrix
+    padding     zeros up to a 16 byte boundary
+    std         float32 * columns
+    mean        float32 * columns
+    matrix      float32 * columns * rows
+
+Legacy text sync files are converted to this format the first time
+they are loaded.
+
+While a song is analyzed for the first time its rows are appended to a
+partial file (the sync filename plus ".part") with the PARTIAL flag set
+in the reserved header field.  The rows count in the header is only
+advanced once the rows it covers are on disk, so if playback is
+interrupted the next play can use those rows and only analyze the rest.
+When the song ends the std and mean are filled in and the file is
+renamed into place.
+
+Third party dependencies:
+
+numpy: for array support - http://www.numpy.org/
+"""
+
+import json
+import logging as log
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+MAGIC = "LSPISYNC"
+VERSION = 1
+
+# header flag, the file is a partial cache still being written
+PARTIAL = 1
+
+_HEADER = struct.Struct("<8sHHIII")
+_ALIGN = 16
+_DTYPE = np.dtype("<f4")
+
+
+def _file_mode():
+    """Mode of a new file under the process umask, mkstemp always uses 0600"""
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+_FILE_MODE = _file_mode()
+
+
+class SyncCache(object):
+    """A sync cache file opened for reading
+
+    std and mean are small in memory arrays, matrix is a read only
+    numpy.memmap so rows are only paged in from disk as they are used.
+    """
+
+    def __init__(self, filename, config, std, mean, matrix, partial=False):
+        self.filename = filename
+        self.config = config
+        self.std = std
+        self.mean = mean
+        self.matrix = matrix
+        self.partial = partial
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def matches(self, config):
+        """Check that this cache was built with the given fft configuration
+
+        :param config: fft configuration, see fft.FFT.get_config
+        :type config: dict
+
+        :return: True if the configurations are the same
+        :rtype: bool
+        """
+        return self.config == config
+
+
+class ColumnStats(object):
+    """Mean and standard deviation of the levels in each channel
+
+    Only positive levels are counted, zero means the chunk was silent
+    and NaN is never positive.  Rows can be added one at a time while a
+    song plays, so the statistics are ready the moment it ends.
+    """
+
+    def __init__(self, columns):
+        """Constructor
+
+        :param columns: number of channels
+        :type columns: int
+        """
+        self.count = np.zeros(columns, dtype=np.int64)
+        self.total = np.zeros(columns, dtype=np.float64)
+        self.squares = np.zeros(columns, dtype=np.float64)
+
+    def extend(self, rows):
+        """Add rows of fft levels
+
+        :param rows: one row, or a 2d array with one row per chunk
+        :type rows: numpy.array
+        """
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, len(self.count))
+        positive = rows > 0
+        values = np.where(positive, rows, 0.0)
+
+        self.count += positive.sum(axis=0)
+        self.total += values.sum(axis=0)
+        self.squares += (values * values).sum(axis=0)
+
+    push = extend
+
+    def mean(self):
+        """Get the mean of each channel, NaN if a channel has no levels
+
+        :rtype: numpy.array
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (self.total / self.count).astype(_DTYPE)
+
+    def std(self):
+        """Get the standard deviation of each channel, NaN if a channel has no levels
+
+        :rtype: numpy.array
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = self.total / self.count
+            variance = np.maximum(self.squares / self.count - mean * mean, 0.0)
+
+        return np.sqrt(variance).astype(_DTYPE)
+
+
+def column_stats(matrix):
+    """Compute the standard deviation and mean of a cache matrix
+
+    :param matrix: fft levels, one row per chunk
+    :type matrix: numpy.array
+
+    :return: std, mean
+    :rtype: tuple
+    """
+    stats = ColumnStats(np.shape(matrix)[-1])
+    stats.extend(matrix)
+
+    return stats.std(), stats.mean()
+
+
+class MatrixBuffer(object):
+    """Growable float32 row buffer for building a cache matrix
+
+    Storage is allocated on the first append, sized from the expected
+    number of rows when it is known, and doubled whenever it fills up so
+    appending a row is amortized O(1) instead of copying the whole
+    matrix like numpy.vstack does.  The mean and standard deviation of
+    the rows are kept up to date in stats.
+    """
+
+    def __init__(self, columns, expected_rows=0):
+        """Constructor
+
+        :param columns: length of each row
+        :type columns: int
+
+        :param expected_rows: rows to preallocate, 0 if unknown
+        :type expected_rows: int
+        """
+        self.columns = columns
+        self.expected_rows = max(int(expected_rows), 16)
+        self.rows = 0
+        self.buffer = None
+        self.stats = ColumnStats(columns)
+
+    def __len__(self):
+        return self.rows
+
+    def _reserve(self, rows):
+        """Make sure there is room for at least rows rows"""
+        if self.buffer is None:
+            self.buffer = np.empty((max(rows, self.expected_rows), self.columns), dtype=_DTYPE)
+        elif rows > len(self.buffer):
+            grown = np.empty((max(rows, 2 * len(self.buffer)), self.columns), dtype=_DTYPE)
+            grown[:self.rows] = self.buffer[:self.rows]
+            self.buffer = grown
+
+    def append(self, row):
+        """Add one row to the end of the matrix
+
+        :param row: fft levels for one chunk
+        :type row: numpy.array
+        """
+        self._reserve(self.rows + 1)
+        self.buffer[self.rows] = row
+        self.rows += 1
+        self.stats.push(row)
+
+    def extend(self, rows):
+        """Add several rows to the end of the matrix
+
+        :param rows: fft levels, one row per chunk
+        :type rows: numpy.array
+        """
+        if len(rows):
+            self._reserve(self.rows + len(rows))
+            self.buffer[self.rows:self.rows + len(rows)] = rows
+            self.rows += len(rows)
+            self.stats.extend(rows)
+
+    def view(self):
+        """Get the filled part of the buffer without copying
+
+        :return: the rows appended so far
+        :rtype: numpy.array
+        """
+        if self.buffer is None:
+            return np.empty((0, self.columns), dtype=_DTYPE)
+        return self.buffer[:self.rows]
+
+
+def _data_offset(config_length):
+    """Offset of the std row, the header and config padded to _ALIGN"""
+    offset = _HEADER.size + config_length
+    return offset + (-offset % _ALIGN)
+
+
+def is_binary(filename):
+    """Check if filename is already in the binary sync format
+
+    :param filename: path / filename of the sync file
+    :type filename: str
+
+    :return: True if the file starts with the binary magic number
+    :rtype: bool
+    """
+    with open(filename, "rb") as cache_fp:
+        return cache_fp.read(len(MAGIC)) == MAGIC
+
+
+def write(filename, matrix, std, mean, config):
+    """Write a sync cache file
+
+    The file is written to a temporary file in the same directory and
+    renamed into place so readers never see a partial cache, and any
+    open memory map of the previous file stays valid.
+
+    :param filename: path / filename of the sync file
+    :type filename: str
+
+    :param matrix: fft levels, one row per chunk
+    :type matrix: numpy.array
+
+    :param std: standard deviation of each channel
+    :type std: numpy.array
+
+    :param mean: mean of each channel
+    :type mean: numpy.array
+
+    :param config: fft configuration, see fft.FFT.get_config
+    :type config: dict
+    """
+    std = np.asarray(std, dtype=_DTYPE)
+    mean = np.asarray(mean, dtype=_DTYPE)
+    columns = len(std)
+    matrix = np.asarray(matrix, dtype=_DTYPE).reshape(-1, columns)
+
+    config_data = json.dumps(config, sort_keys=True)
+    offset = _data_offset(len(config_data))
+    header = _HEADER.pack(MAGIC, VERSION, 0, columns, len(matrix), len(config_data))
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_filename = tempfile.mkstemp(prefix=".sync", dir=directory)
+    try:
+        os.fchmod(fd, _FILE_MODE)
+        with os.fdopen(fd, "wb") as cache_fp:
+            cache_fp.write(header)
+            cache_fp.write(config_data)
+            cache_fp.write("\0" * (offset - len(header) - len(config_data)))
+            cache_fp.write(std.tostring())
+            cache_fp.write(mean.tostring())
+            cache_fp.write(np.ascontiguousarray(matrix).tostring())
+        os.rename(temp_filename, filename)
+    except (IOError, OSError):
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+
+def convert(filename, config):
+    """Convert a legacy numpy.savetxt sync file to the binary format
+
+    :param filename: path / filename of the sync file
+    :type filename: str
+
+    :param config: fft configuration to record in the header
+    :type config: dict
+
+    :raise IOError: if the text file can not be parsed
+    """
+    try:
+        cache_matrix = np.loadtxt(filename, ndmin=2)
+    except ValueError as error:
+        raise IOError("Unable to read legacy sync file: " + str(error))
+
+    if len(cache_matrix) < 2:
+        raise IOError("Legacy sync file is missing std and mean")
+
+    write(filename, cache_matrix[2:], cache_matrix[0], cache_matrix[1], config)
+    log.info("Converted legacy sync file '" + filename + "' to binary format")
+
+
+def partial_filename(filename):
+    """Name of the partial cache file written while filename is built"""
+    return filename + ".part"
+
+
+def load(filename, config, partial=False):
+    """Open a sync cache file for reading
+
+    :param filename: path / filename of the sync file
+    :type filename: str
+
+    :param config: fft configuration recorded if a legacy text file has
+                   to be converted, it should match the song's .cfg file
+    :type config: dict
+
+    :param partial: open a partial cache, only the rows before its resume
+                    marker are used and std and mean are not set
+    :type partial: bool
+
+    :return: the opened cache
+    :rtype: SyncCache
+
+    :raise IOError: if the file does not exist or is not a valid cache
+    """
+    if not partial and not is_binary(filename):
+        convert(filename, config)
+
+    with open(filename, "rb") as cache_fp:
+        header = cache_fp.read(_HEADER.size)
+        if len(header) != _HEADER.size:
+            raise IOError("Truncated sync file header")
+
+        magic, version, flags, columns, rows, config_length = _HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise IOError("Unsupported sync file version " + str(version))
+        if bool(flags & PARTIAL) != partial:
+            raise IOError("Sync file is " + ("complete" if partial else "partial"))
+
+        try:
+            cache_config = json.loads(cache_fp.read(config_length))
+        except ValueError:
+            raise IOError("Corrupt sync file config")
+
+    offset = _data_offset(config_length)
+    expected = offset + _DTYPE.itemsize * columns * (rows + 2)
+    if os.path.getsize(filename) < expected:
+        raise IOError("Truncated sync file data")
+
+    data = np.memmap(filename, dtype=_DTYPE, mode="r", offset=offset, shape=(rows + 2, columns))
+
+    return SyncCache(filename, cache_config, np.array(data[0]), np.array(data[1]), data[2:],
+                     partial)
+
+
+class CacheWriter(object):
+    """Write a sync cache a row at a time as a song is analyzed
+
+    Rows are appended to the partial cache file, nothing is written
+    until the first row is appended.  An existing cache the song starts
+    with is either continued, if it is this song's partial file, or
+    copied to the start of a new partial file.
+    """
+
+    def __init__(self, filename, columns, config, existing=None, sync_rows=64):
+        """Constructor
+
+        :param filename: path / filename of the sync file
+        :type filename: str
+
+        :param columns: number of channels
+        :type columns: int
+
+        :param config: fft configuration, see fft.FFT.get_config
+        :type config: dict
+
+        :param existing: rows the cache starts with
+        :type existing: SyncCache
+
+        :param sync_rows: rows to write between updates of the resume marker
+        :type sync_rows: int
+        """
+        self.filename = filename
+        self.partial_filename = partial_filename(filename)
+        self.columns = columns
+        self.config_data = json.dumps(config, sort_keys=True)
+        self.offset = _data_offset(len(self.config_data))
+        self.existing = existing
+        self.sync_rows = sync_rows
+        self.stats = ColumnStats(columns)
+        self.rows = 0
+        self.synced = 0
+        self.cache_fp = None
+
+    def __len__(self):
+        return self.rows
+
+    @property
+    def started(self):
+        """True once a row has been appended"""
+        return self.cache_fp is not None
+
+    def _write_header(self, flags):
+        """Rewrite the header with the rows on disk, leaves the file position at the end"""
+        self.cache_fp.seek(0)
+        self.cache_fp.write(_HEADER.pack(MAGIC, VERSION, flags, self.columns, self.synced,
+                                         len(self.config_data)))
+        self.cache_fp.seek(0, os.SEEK_END)
+
+    def _start(self):
+        """Open the partial file for appending"""
+        existing = self.existing
+        resume = existing is not None and existing.partial and \
+            os.path.abspath(existing.filename) == os.path.abspath(self.partial_filename)
+
+        if resume:
+            self.cache_fp = open(self.partial_filename, "r+b")
+            self.rows = self.synced = len(existing)
+            self.cache_fp.truncate(self.offset + _DTYPE.itemsize * self.columns * (self.rows + 2))
+            self.cache_fp.seek(0, os.SEEK_END)
+            self.stats.extend(existing.matrix)
+            log.info("Resuming partial sync file at row " + str(self.rows))
+            return
+
+        self.cache_fp = open(self.partial_filename, "w+b")
+        self._write_header(PARTIAL)
+        self.cache_fp.write(self.config_data)
+        self.cache_fp.write("\0" * (self.offset - _HEADER.size - len(self.config_data)))
+
+        # std and mean are filled in by finish
+        self.cache_fp.write(np.zeros(2 * self.columns, dtype=_DTYPE).tostring())
+
+        if existing is not None and len(existing):
+            self.cache_fp.write(np.ascontiguousarray(existing.matrix, dtype=_DTYPE).tostring())
+            self.stats.extend(existing.matrix)
+            self.rows = len(existing)
+
+    def append(self, row):
+        """Add one row to the end of the cache
+
+        :param row: fft levels for one chunk
+        :type row: numpy.array
+        """
+        if self.cache_fp is None:
+            self._start()
+
+        row = np.asarray(row, dtype=_DTYPE)
+        self.cache_fp.write(row.tostring())
+        self.stats.push(row)
+        self.rows += 1
+
+        if self.rows - self.synced >= self.sync_rows:
+            self.sync()
+
+    def sync(self):
+        """Make sure every row is on disk, then move the resume marker past them"""
+        if self.cache_fp is None:
+            return
+
+        self.cache_fp.flush()
+        os.fsync(self.cache_fp.fileno())
+        self.synced = self.rows
+        self._write_header(PARTIAL)
+
+    def close(self):
+        """Stop writing, leaving the partial file to resume from later"""
+        if self.cache_fp is not None:
+            self.sync()
+            self.cache_fp.close()
+            self.cache_fp = None
+
+    def finish(self):
+        """Fill in std and mean and rename the partial file into place
+
+        :return: std, mean
+        :rtype: tuple
+        """
+        std, mean = self.stats.std(), self.stats.mean()
+
+        if self.cache_fp is None:
+            self._start()
+
+        self.cache_fp.seek(self.offset)
+        self.cache_fp.write(std.tostring())
+        self.cache_fp.write(mean.tostring())
+        self.cache_fp.flush()
+        os.fsync(self.cache_fp.fileno())
+
+        self.synced = self.rows
+        self._write_header(0)
+        self.cache_fp.flush()
+        os.fsync(self.cache_fp.fileno())
+        self.cache_fp.close()
+        self.cache_fp = None
+
+        os.rename(self.partial_filename, self.filename)
+
+        return std, mean
@@ -31,11 +31,12 @@ FFT calculation can be CPU intensive and in some cases can adversely
 affect playback of songs (especially if attempting to decode the song
 as well, as is the case for an mp3).  For this reason, the FFT 
 calculations are cached after the first time a new song is played.
-The values are cached in a gzip'd text file in the same location as the
-song itself.  Subsequent requests to play the same song will use the
-cached information and not recompute the FFT, thus reducing CPU
-utilization dramatically and allowing for clear music playback of all
-audio file types.
+The values are cached in a binary sync file (see sync_cache.py) in the
+same location as the song itself, which is memory mapped on playback.
+Subsequent requests to play the same song will use the cached
+information and not recompute the FFT, thus reducing CPU utilization
+dramatically and allowing for clear music playback of all audio file
+types.
 
 Recent optimizations have improved this dramatically and most users are
 no longer reporting adverse playback of songs even on the first 
@@ -64,16 +65,16 @@ import ConfigParser
 import argparse
 import atexit
 import audioop
-import csv
-import fcntl
 import logging as log
 import os
 import random
 import subprocess
 import sys
+import threading
 import wave
 import alsaaudio as aa
 import json
+import math
 import signal
 import decoder
 import numpy as np
@@ -83,10 +84,21 @@ import errno
 import stat
 
 from collections import deque
+import brightness
+import cache_store
+import control
 import Platform
 import fft
+import jitter_buffer
+import light_scheduler
+import lookahead
+import networking
+import pcm_cache
+import pipeline
+import playlist_store
 from prepostshow import PrePostShow
 import RunningStats
+import sync_cache
 
 
 # Make sure SYNCHRONIZED_LIGHTS_HOME environment variable is set
@@ -123,6 +135,9 @@ filegroup.add_argument('--file', help='path to the song to play (required if no
 parser.add_argument('--readcache', type=int, default=1,
                     help='read light timing from cache if available. Default: true')
 
+# the show starts a copy of itself with --precache to analyze the next song
+parser.add_argument('--precache', help=argparse.SUPPRESS)
+
 log.basicConfig(filename=LOG_DIR + '/music_and_lights.play.dbg',
                 format='[%(asctime)s] %(levelname)s {%(pathname)s:%(lineno)d} - %(message)s',
                 level=log.INFO)
@@ -139,20 +154,41 @@ cm = hc.cm
 parser.set_defaults(playlist=cm.lightshow.playlist_path)
 args = parser.parse_args()
 
-decay_factor = cm.lightshow.decay_factor
-decay = np.zeros(cm.hardware.gpio_len, dtype='float32')
+brightness_calc = brightness.Brightness(cm.hardware.gpio_len, cm.lightshow.decay_factor)
 
 network = hc.network
 server = network.networking == 'server'
 client = network.networking == "client"
 
-if cm.lightshow.use_fifo:
+if cm.lightshow.use_fifo and args.precache is None:
     if os.path.exists(cm.lightshow.fifo):
         os.remove(cm.lightshow.fifo)
     os.mkfifo(cm.lightshow.fifo, 0777)
 
 CHUNK_SIZE = 2048  # Use a multiple of 8 (move this to config)
 
+# central sync file directory, None to keep sync files next to each song
+sync_store = None
+if cm.audio_processing.cache_dir:
+    sync_store = cache_store.CacheStore(cm.audio_processing.cache_dir,
+                                        cm.audio_processing.cache_dir_size)
+
+# decoded audio of compressed songs, None to decode them on every play
+pcm_store = None
+if cm.audio_processing.pcm_cache_dir:
+    pcm_store = cache_store.CacheStore(cm.audio_processing.pcm_cache_dir,
+                                       cm.audio_processing.pcm_cache_dir_size,
+                                       pcm_cache.SUFFIX)
+
+# the playlist, loaded on first use, also used by the control thread
+playlist = None
+playlist_lock = threading.RLock()
+
+# commands from check_sms, None if not listening
+control_server = None
+
+LOOKAHEAD_CHUNKS = 64  # chunks analyzed at a time by the lookahead process
+
 
 def end_early():
     """atexit function"""
@@ -164,6 +200,9 @@ def end_early():
 
     hc.clean_up()
 
+    if control_server is not None:
+        control_server.close()
+
     if cm.audio_processing.fm:
         fm_process.kill()
 
@@ -191,7 +230,29 @@ def enqueue_output(out, queue):
     out.close()
 
 
-def update_lights(matrix, mean, std):
+def light_levels(matrix, mean, std, out=None):
+    """Brightness of every channel for a row of the frequency response matrix
+
+    :param matrix: row of data from cache matrix
+    :type matrix: list
+
+    :param mean: standard mean of fft values
+    :type mean: list
+
+    :param std: standard deviation of fft values
+    :type std: list
+
+    :param out: array to write the levels to, by default a buffer that
+                is overwritten by the next call
+    :type out: numpy.array
+
+    :return: brightness levels, after any decay
+    :rtype: numpy.array
+    """
+    return brightness_calc.compute(matrix, mean, std, out)
+
+
+def update_lights(matrix, mean, std, timestamp=None):
     """Update the state of all the lights
 
     Update the state of all the lights based upon the current
@@ -205,28 +266,18 @@ def update_lights(matrix, mean, std):
 
     :param std: standard deviation of fft values
     :type std: list
-    """
-    global decay
 
-    brightness = matrix - mean + (std * 0.5)
-    brightness = brightness / (std * 1.25)
-
-    # insure that the brightness levels are in the correct range
-    brightness = np.clip(brightness, 0.0, 1.0)
-    brightness = np.round(brightness, decimals=3)
-
-    # calculate light decay rate if used
-    if decay_factor > 0:
-        decay = np.where(decay <= brightness, brightness, decay)
-        brightness = np.where(decay - decay_factor > 0, decay - decay_factor, brightness)
-        decay = np.where(decay - decay_factor > 0, decay - decay_factor, decay)
+    :param timestamp: position in the song (seconds) this row belongs to,
+                      sent to network clients, defaults to the current time
+    :type timestamp: float
+    """
+    brightness = light_levels(matrix, mean, std)
 
     # broadcast to clients if in server mode
     if server:
-        network.broadcast(brightness)
+        network.broadcast_levels(brightness, timestamp)
 
-    for blevel, pin in zip(brightness, range(hc.GPIOLEN)):
-        hc.set_light(pin, True, blevel)
+    hc.set_lights(brightness, True)
 
 
 def set_audio_device(sample_rate, num_channels):
@@ -314,8 +365,12 @@ def audio_in():
     log.debug("Running in %s mode - will run until Ctrl+C is pressed" % cm.lightshow.mode)
     print "Running in %s mode, use Ctrl+C to stop" % cm.lightshow.mode
 
-    # setup light_delay.
-    chunks_per_sec = ((16 * num_channels * sample_rate) / 8) / CHUNK_SIZE
+    # setup light_delay.  The audio input device is read a period of
+    # CHUNK_SIZE frames at a time, streams CHUNK_SIZE bytes at a time
+    frames_per_read = CHUNK_SIZE
+    if cm.lightshow.mode != 'audio-in':
+        frames_per_read = CHUNK_SIZE / (2 * num_channels)
+    chunks_per_sec = sample_rate / float(frames_per_read)
     light_delay = int(cm.audio_processing.light_delay * chunks_per_sec)
     matrix_buffer = deque([], 1000)
 
@@ -327,7 +382,11 @@ def audio_in():
     std = np.array([1.5 for _ in range(hc.GPIOLEN)], dtype='float32')
     count = 2
 
-    running_stats = RunningStats.Stats(hc.GPIOLEN)
+    # follow the mean / std of everything heard, or of roughly the last
+    # input_stats_seconds so the lights keep adapting to louder or quieter input
+    running_stats = RunningStats.create(cm.lightshow.input_stats,
+                                        hc.GPIOLEN,
+                                        cm.lightshow.input_stats_seconds * chunks_per_sec)
 
     # preload running_stats to avoid errors, and give us a show that looks
     # good right from the start
@@ -450,6 +509,9 @@ def load_custom_config(config_filename):
                 if config.has_option(lsc, inverted):
                     hc.inverted_channels = map(int, config.get(lsc, inverted).split(","))
 
+                # set_light and set_lights look the overrides up in tables
+                hc.build_override_masks()
+
                 # setup up custom preshow
                 has_preshow_configuration = config.has_option(lsc, 'preshow_configuration')
                 has_preshow_script = config.has_option(lsc, 'preshow_script')
@@ -519,36 +581,54 @@ def load_custom_config(config_filename):
                                                                              ',')) if temp else 0
 
 
-def setup_audio(song_filename):
-    """Setup audio file
-
-    and setup setup the output device.output is a lambda that will send data to
-    fm process or to the specified ALSA sound card
+def open_song(song_filename):
+    """Open a song for decoding, and an FFT calculator for it
 
     :param song_filename: path / filename to music file
     :type song_filename: str
-    :return: output, fm_process, fft_calc, music_file
-    :rtype tuple: lambda, subprocess, fft.FFT, decoder
+
+    :return: music_file, fft_calc
+    :rtype: tuple
     """
-    # Set up audio
     force_header = False
 
     if any([ax for ax in [".mp4", ".m4a", ".m4b"] if ax in song_filename]):
         force_header = True
 
-    music_file = decoder.open(song_filename, force_header)
-
-    sample_rate = music_file.getframerate()
-    num_channels = music_file.getnchannels()
+    if pcm_store is not None:
+        music_file = pcm_cache.open_song(pcm_store, song_filename,
+                                         lambda f: decoder.open(f, force_header))
+    else:
+        music_file = decoder.open(song_filename, force_header)
 
     fft_calc = fft.FFT(CHUNK_SIZE,
-                       sample_rate,
+                       music_file.getframerate(),
                        hc.GPIOLEN,
                        cm.audio_processing.min_frequency,
                        cm.audio_processing.max_frequency,
                        cm.audio_processing.custom_channel_mapping,
                        cm.audio_processing.custom_channel_frequencies)
 
+    return music_file, fft_calc
+
+
+def setup_audio(song_filename):
+    """Setup audio file
+
+    and setup setup the output device.output is a lambda that will send data to
+    fm process or to the specified ALSA sound card
+
+    :param song_filename: path / filename to music file
+    :type song_filename: str
+    :return: output, fm_process, fft_calc, music_file
+    :rtype tuple: lambda, subprocess, fft.FFT, decoder
+    """
+    # Set up audio
+    music_file, fft_calc = open_song(song_filename)
+
+    sample_rate = music_file.getframerate()
+    num_channels = music_file.getnchannels()
+
     # setup output device
     output = set_audio_device(sample_rate, num_channels)
 
@@ -565,7 +645,9 @@ def setup_audio(song_filename):
 def setup_cache(cache_filename, fft_calc):
     """Setup the cache_matrix, std and mean
 
-    loading them from a file if it exists, otherwise create empty arrays to be filled
+    loading them from a file if it exists, otherwise create empty arrays to be filled.
+    If the first play of the song was interrupted the rows analyzed before the
+    interruption are loaded from its partial cache file.
 
     :param cache_filename: path / filename to cache file
     :type cache_filename: str
@@ -573,14 +655,15 @@ def setup_cache(cache_filename, fft_calc):
     :param fft_calc: instance of FFT class
     :type fft_calc: fft.FFT
 
-    :return:  tuple of cache_found, cache_matrix, std, mean
-    :type tuple: (bool, numpy.array, numpy.array, numpy.array)
+    :return:  tuple of cache_found, cache, std, mean.  cache_found is True if
+              the cache is complete, cache is None if no rows are cached
+    :type tuple: (bool, sync_cache.SyncCache, numpy.array, numpy.array)
 
     :raise IOError:
     """
-    # create empty array for the cache_matrix
-    cache_matrix = np.empty(shape=[0, hc.GPIOLEN])
+    cache = None
     cache_found = False
+    fft_config = fft_calc.get_config()
 
     # The values 12 and 1.5 are good estimates for first time playing back
     # (i.e. before we have the actual mean and standard deviations
@@ -588,72 +671,205 @@ def setup_cache(cache_filename, fft_calc):
     mean = np.array([12.0 for _ in range(hc.GPIOLEN)], dtype='float32')
     std = np.array([1.5 for _ in range(hc.GPIOLEN)], dtype='float32')
 
+    # load the song's .cfg and compare it to the current configuration,
+    # the configuration is part of the name of sync files in the cache directory
+    config_found = sync_store is not None or fft_calc.compare_config(cache_filename)
+
     if args.readcache:
         # Read in cached fft
         try:
-            # load cache from file using numpy loadtxt
-            cache_matrix = np.loadtxt(cache_filename)
+            # memory map the cache file, legacy text files are converted
+            cache = sync_cache.load(cache_filename, fft_config)
 
             # compare configuration of cache file to current configuration
-            cache_found = fft_calc.compare_config(cache_filename)
+            cache_found = cache.matches(fft_config) and config_found
             if not cache_found:
-                # create empty array for the cache_matrix
-                cache_matrix = np.empty(shape=[0, hc.GPIOLEN])
                 raise IOError()
 
-            # get std from matrix / located at index 0
-            std = np.array(cache_matrix[0])
+            std = cache.std
+            mean = cache.mean
 
-            # get mean from matrix / located at index 1
-            mean = np.array(cache_matrix[1])
-
-            # delete mean and std from the array
-            cache_matrix = np.delete(cache_matrix, 0, axis=0)
-            cache_matrix = np.delete(cache_matrix, 0, axis=0)
+            # every level is cached, the fft will not be needed
+            fft_calc.release_audio_levels()
 
             log.debug("std: " + str(std) + ", mean: " + str(mean))
         except IOError:
-            cache_found = fft_calc.compare_config(cache_filename)
+            cache = None
             msg = "Cached sync data song_filename not found: '"
             log.warn(msg + cache_filename + "'.  One will be generated.")
 
-    return cache_found, cache_matrix, std, mean
+    partial_filename = sync_cache.partial_filename(cache_filename)
 
+    if args.readcache and not cache_found and os.path.isfile(partial_filename):
+        # pick up where an interrupted first play left off
+        try:
+            cache = sync_cache.load(partial_filename, fft_config, partial=True)
+            if not cache.matches(fft_config):
+                raise IOError("configuration has changed")
+        except IOError as error:
+            cache = None
+            log.warn("Ignoring partial sync data '" + partial_filename + "': " + str(error))
 
-def save_cache(cache_matrix, cache_filename, fft_calc):
-    """
-    Save matrix, std, and mean to cache_filename for use during future playback
+    if cache is not None and cache.partial:
+        log.info("Using " + str(len(cache)) + " rows from partial sync data")
 
-    :param cache_matrix: numpy array containing the matrix
-    :type cache_matrix: numpy.array
+        # estimate the statistics from the rows we have
+        partial_std, partial_mean = sync_cache.column_stats(cache.matrix)
+        usable = np.isfinite(partial_std) & (partial_std > 0)
+        std = np.where(usable, partial_std, std)
+        mean = np.where(usable, partial_mean, mean)
+    elif cache_found and os.path.isfile(partial_filename):
+        os.remove(partial_filename)
 
-    :param cache_filename: name of the cache file to look for
-    :type cache_filename: str
+    if cache_found and sync_store is not None:
+        sync_store.touch(cache_filename)
+
+    return cache_found, cache, std, mean
+
+
+def save_cache(writer, fft_calc):
+    """
+    Finish the cache written during playback so it can be used for future playback
+
+    :param writer: the cache written as the song played
+    :type writer: sync_cache.CacheWriter
 
     :param fft_calc: instance of fft.FFT
     :type fft_calc: fft.FFT
     """
-    # Compute the standard deviation and mean values for the cache
-    mean = np.empty(hc.GPIOLEN, dtype='float32')
-    std = np.empty(hc.GPIOLEN, dtype='float32')
+    # std and mean were kept up to date as rows were added
+    writer.finish()
+
+    cm_len = str(len(writer))
+    log.info("Cached sync data written to '." + writer.filename + "' [" + cm_len + " rows]")
+
+    if sync_store is None:
+        # Save fft config
+        fft_calc.save_config()
+        log.info("Cached config data written to '." + fft_calc.config_filename)
+    else:
+        # record the new sync file, making room for it if needed
+        sync_store.touch(writer.filename)
+
+
+def read_playlist():
+    """Get the playlist, up to date with any votes
+
+    :return: songs, the index of the song with the most votes (None if none)
+    :rtype: tuple
+    """
+    global playlist
+
+    with playlist_lock:
+        if playlist is None:
+            playlist = playlist_store.PlaylistStore(args.playlist)
+        else:
+            playlist.refresh()
+
+        return playlist.songs, playlist.most_voted()
+
+
+def request_play_now(song):
+    """Interrupt the show to play a song, or the next song if song is -1
+
+    :param song: song number, starting at 1, or -1
+    :type song: int
+    """
+    cm.update_state('play_now', str(song))
+    control_server.interrupt.set()
+
+
+def control_play(song):
+    """play command of the control channel"""
+    song = int(song)
+    if song < 1:
+        raise ValueError("song numbers start at 1")
+
+    request_play_now(song)
+    return "playing song " + str(song)
+
+
+def control_skip():
+    """skip command of the control channel"""
+    request_play_now(-1)
+    return "skipping ahead"
+
+
+def control_volume(level):
+    """volume command of the control channel, level is -, + or 0 - 100"""
+    if level not in ('-', '+') and not (level.isdigit() and 0 <= int(level) <= 100):
+        raise ValueError("volume must be -, + or between 0 and 100")
+
+    output, error = subprocess.Popen([cm.home_dir + '/bin/vol', level],
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE).communicate()
+    if error:
+        raise ValueError(error.strip())
+
+    return output.strip()
+
+
+def start_control():
+    """Listen for commands from check_sms while this song plays"""
+    global control_server
+
+    listener = control.ControlServer(control.socket_path(cm.home_dir),
+                                     {'play': control_play,
+                                      'skip': control_skip,
+                                      'volume': control_volume})
+    if listener.start():
+        control_server = listener
+
+    # pick up anything written to the state file before we were listening
+    cm.refresh_state()
 
-    for i in range(0, hc.GPIOLEN):
-        std[i] = np.std([item for item in cache_matrix[:, i] if item > 0])
-        mean[i] = np.mean([item for item in cache_matrix[:, i] if item > 0])
 
-    # Add mean and std to the top of the cache
-    cache_matrix = np.vstack([mean, cache_matrix])
-    cache_matrix = np.vstack([std, cache_matrix])
+def random_song_index(count, exclude=None):
+    """Index of the next random song
 
-    # Save the cache using numpy savetxt
-    np.savetxt(cache_filename, cache_matrix)
+    The choice is kept in the state so the song analyzed ahead of time
+    is the one get_song picks.
 
-    # Save fft config
-    fft_calc.save_config()
+    :param count: number of songs in the playlist
+    :type count: int
 
-    cm_len = str(len(cache_matrix))
-    log.info("Cached sync data written to '." + cache_filename + "' [" + cm_len + " rows]")
-    log.info("Cached config data written to '." + fft_calc.config_filename)
+    :param exclude: index of a song not to pick, if there are others
+    :type exclude: int
+
+    :rtype: int
+    """
+    # the lookahead thread picks the song too
+    with cm.state_lock:
+        index = int(cm.get_state('next_random_song', "-1"))
+
+        if not 0 <= index < count:
+            if exclude is not None and 0 <= exclude < count and count > 1:
+                index = random.randrange(0, count - 1)
+                if index >= exclude:
+                    index += 1
+            else:
+                index = random.randrange(0, count)
+            cm.update_state('next_random_song', str(index))
+
+    return index
+
+
+def song_paths(song_filename):
+    """Get the config and cache filenames of a song
+
+    :param song_filename: path / filename of the song, as in the playlist
+    :type song_filename: str
+
+    :return: tuple containing 3 strings: song_filename, config_filename, cache_filename
+    :rtype: tuple
+    """
+    song_filename = song_filename.replace("$SYNCHRONIZED_LIGHTS_HOME", cm.home_dir)
+
+    filename = os.path.abspath(song_filename)
+    config_filename = os.path.dirname(filename) + "/." + os.path.basename(song_filename) + ".cfg"
+    cache_filename = os.path.dirname(filename) + "/." + os.path.basename(song_filename) + ".sync"
+
+    return song_filename, config_filename, cache_filename
 
 
 def get_song():
@@ -668,64 +884,30 @@ def get_song():
     song_filename = args.file
 
     if args.playlist is not None and args.file is None:
-        most_votes = [None, None, []]
-
-        with open(args.playlist, 'rb') as playlist_fp:
-            fcntl.lockf(playlist_fp, fcntl.LOCK_SH)
-            playlist = csv.reader(playlist_fp, delimiter='\t')
-            songs = []
-
-            for song in playlist:
-                if len(song) < 2 or len(song) > 4:
-                    log.error('Invalid playlist.  Each line should be in the form: '
-                              '<song name><tab><path to song>')
-                    log.warning('Removing invalid entry')
-                    print "Error found in playlist"
-                    print "Deleting entry:", song
-                    continue
-                elif len(song) == 2:
-                    song.append(set())
-                else:
-                    song[2] = set(song[2].split(','))
-                    if len(song) == 3 and len(song[2]) >= len(most_votes[2]):
-                        most_votes = song
-                songs.append(song)
-
-            fcntl.lockf(playlist_fp, fcntl.LOCK_UN)
+        songs, most_votes = read_playlist()
 
-        if most_votes[0] is not None:
-            log.info("Most Votes: " + str(most_votes))
+        if most_votes is not None:
+            log.info("Most Votes: " + str(songs[most_votes]))
             current_song = most_votes
 
-            # Update playlist with latest votes
-            with open(args.playlist, 'wb') as playlist_fp:
-                fcntl.lockf(playlist_fp, fcntl.LOCK_EX)
-                writer = csv.writer(playlist_fp, delimiter='\t')
-
-                for song in songs:
-                    if current_song == song and len(song) == 3:
-                        song.append("playing!")
-
-                    if len(song[2]) > 0:
-                        song[2] = ",".join(song[2])
-                    else:
-                        del song[2]
-
-                writer.writerows(songs)
-                fcntl.lockf(playlist_fp, fcntl.LOCK_UN)
+            # voters are told it is playing by check_sms
+            with playlist_lock:
+                playlist.start_playing(current_song)
         else:
             # Get a "play now" requested song
             if 0 < play_now <= len(songs):
-                current_song = songs[play_now - 1]
+                current_song = play_now - 1
             # Get random song
             elif cm.lightshow.randomize_playlist:
-                current_song = songs[random.randrange(0, len(songs))]
+                with cm.state_lock:
+                    current_song = random_song_index(len(songs))
+                    cm.update_state('next_random_song', "-1")
             # Play next song in the lineup
             else:
                 if not (song_to_play <= len(songs) - 1):
                     song_to_play = 0
 
-                current_song = songs[song_to_play]
+                current_song = song_to_play
 
                 if (song_to_play + 1) <= len(songs) - 1:
                     next_song = (song_to_play + 1)
@@ -735,21 +917,274 @@ def get_song():
                 cm.update_state('song_to_play', str(next_song))
 
         # Get filename to play and store the current song playing in state cfg
-        song_filename = current_song[1]
-        cm.update_state('current_song', str(songs.index(current_song)))
+        song_filename = songs[current_song][1]
+        cm.update_state('current_song', str(current_song))
 
-    song_filename = song_filename.replace("$SYNCHRONIZED_LIGHTS_HOME", cm.home_dir)
+    return song_paths(song_filename)
 
-    filename = os.path.abspath(song_filename)
-    config_filename = os.path.dirname(filename) + "/." + os.path.basename(song_filename) + ".cfg"
-    cache_filename = os.path.dirname(filename) + "/." + os.path.basename(song_filename) + ".sync"
 
-    return song_filename, config_filename, cache_filename
+def predict_next_song(current_filename=None):
+    """Determine the song the next call to get_song will pick
+
+    Uses the same votes, play_now, random and song_to_play rules as
+    get_song, without changing the playlist.
+
+    :param current_filename: path / filename of the song playing, its
+                             sync file is being written so it is never
+                             returned
+    :type current_filename: str
+
+    :return: tuple containing 3 strings: song_filename, config_filename, cache_filename,
+             None if there is no playlist or the next song is the current one
+    :rtype: tuple
+    """
+    if args.playlist is None or args.file is not None:
+        return None
+
+    songs, most_votes = read_playlist()
+    if not songs:
+        return None
+
+    play_now = int(cm.get_state('play_now', "0"))
+
+    if most_votes is not None:
+        next_song = songs[most_votes]
+    elif 0 < play_now <= len(songs):
+        next_song = songs[play_now - 1]
+    elif cm.lightshow.randomize_playlist:
+        next_song = songs[random_song_index(len(songs),
+                                            int(cm.get_state('current_song', "-1")))]
+    else:
+        song_to_play = int(cm.get_state('song_to_play', "0"))
+        if not (song_to_play <= len(songs) - 1):
+            song_to_play = 0
+
+        next_song = songs[song_to_play]
+
+    paths = song_paths(next_song[1])
+    if paths[0] == current_filename:
+        return None
+
+    return paths
+
+
+def precache_command(song):
+    """Command line of the lookahead process that analyzes a song
+
+    :param song: song_filename, config_filename, cache_filename
+    :type song: tuple
+
+    :rtype: list
+    """
+    return [sys.executable, os.path.abspath(__file__),
+            '--log', args.log, '--precache', song[0]]
+
+
+def precache_song(song, stop_event):
+    """Build the sync file for a song before it is played
+
+    Runs in the lookahead process, started with --precache by the show,
+    so the song's custom configuration does not affect the song playing.
+    If stop_event is set the rows analyzed so far are kept in the partial
+    sync file for the song's first play to continue from.
+
+    :param song: song_filename, config_filename, cache_filename
+    :type song: tuple
+
+    :param stop_event: set when the analysis should stop
+    :type stop_event: threading.Event
+    """
+    song_filename, config_filename, cache_filename = song
+
+    load_custom_config(config_filename)
+    music_file, fft_calc = open_song(song_filename)
+
+    try:
+        analyze_song(music_file, fft_calc, song_filename, cache_filename, stop_event)
+    finally:
+        music_file.close()
+
+
+def analyze_song(music_file, fft_calc, song_filename, cache_filename, stop_event):
+    """Build the sync file for an opened song, see precache_song"""
+    if sync_store is not None:
+        cache_filename = sync_store.cache_filename(song_filename, fft_calc.get_config())
+
+    cache_found, cache, _, _ = setup_cache(cache_filename, fft_calc)
+    if cache_found:
+        return
+
+    writer = sync_cache.CacheWriter(cache_filename, hc.GPIOLEN, fft_calc.get_config(), cache)
+    num_channels = music_file.getnchannels()
+
+    # skip the chunks that are already cached
+    skipped = 0
+    cached = len(cache) if cache is not None else 0
+    while skipped < cached:
+        count = min(LOOKAHEAD_CHUNKS, cached - skipped)
+        if music_file.readframes(CHUNK_SIZE * count) == '':
+            break
+        skipped += count
+
+    data = music_file.readframes(CHUNK_SIZE * LOOKAHEAD_CHUNKS)
+
+    while data != '':
+        if stop_event.is_set():
+            writer.close()
+            if sync_store is not None and writer.started:
+                sync_store.touch(sync_cache.partial_filename(writer.filename))
+            log.info("Background analysis stopped [" + str(len(writer)) + " rows]")
+            return
+
+        for row in fft_calc.calculate_levels_batch(data, num_channels):
+            writer.append(row)
+
+        data = music_file.readframes(CHUNK_SIZE * LOOKAHEAD_CHUNKS)
+
+    save_cache(writer, fft_calc)
+
+
+def light_stage(pipe, fft_calc, cache_matrix, writer, mean, std, light_delay, chunk_seconds):
+    """Light stage of the playback pipeline
+
+    Read (or compute) the fft levels for every decoded chunk and update
+    the lights once the audio clock has reached that chunk plus light_delay.
+    Computed rows are added to the cache as they are computed.
+
+    The levels wait out light_delay in a buffer here, and a chunk is only
+    shown once a later chunk has arrived, so the stage never waits for
+    audio the decoder has not handed it yet however long the delay.
+
+    When serving, rows are computed up to network.presentation_lead
+    seconds ahead of the audio and broadcast right away, stamped with the
+    time they will be shown here, so clients can show them at that same
+    moment.
+
+    With a light_rate the lights are updated at that rate by a
+    light_scheduler.LightScheduler instead, and light_delay is applied in
+    seconds rather than whole chunks.
+
+    :param pipe: the playback pipeline
+    :type pipe: pipeline.Pipeline
+
+    :param fft_calc: instance of FFT class
+    :type fft_calc: fft.FFT
+
+    :param cache_matrix: cached fft levels, may cover only the start of the song
+    :type cache_matrix: numpy.array
+
+    :param writer: cache for the rows computed on this play
+    :type writer: sync_cache.CacheWriter
+
+    :param mean: standard mean of fft values
+    :type mean: numpy.array
+
+    :param std: standard deviation of fft values
+    :type std: numpy.array
+
+    :param light_delay: chunks to delay the lights from the audio
+    :type light_delay: int
+
+    :param chunk_seconds: duration of one chunk of audio
+    :type chunk_seconds: float
+    """
+    def show(due, row, brightness):
+        # wait for the audio, skipping the update if we have fallen behind it
+        if pipe.clock.wait_for(due) and pipe.clock.row <= due + 1:
+            if server and not lead:
+                network.broadcast_levels(brightness, row * chunk_seconds)
+            hc.set_lights(brightness, True)
+
+    # rows computed ahead of the audio, limited by how far ahead the
+    # decoder may read
+    lead = 0
+    if server:
+        lead = min(int(math.ceil(cm.network.presentation_lead / chunk_seconds)),
+                   cm.audio_processing.decode_queue_depth - 1)
+
+    # (row to show at, row, levels) waiting for the audio
+    pending = deque()
+
+    # the levels of each pending row, reused in turn
+    frames = [np.zeros(hc.GPIOLEN, dtype='float32') for _ in range(lead + light_delay + 1)]
+    frame = 0
+
+    # show frames at a fixed rate instead of once per chunk
+    scheduler = None
+    if cm.audio_processing.light_rate > 0:
+        scheduler = light_scheduler.LightScheduler(pipe.clock,
+                                                   pipe.stop_event,
+                                                   lambda levels: hc.set_lights(levels, True),
+                                                   hc.GPIOLEN,
+                                                   cm.audio_processing.light_rate,
+                                                   cm.audio_processing.light_delay,
+                                                   cm.audio_processing.light_interpolate,
+                                                   max(lead, 2))
+
+    # next row to add to the cache, rows are only added in order
+    next_row = len(cache_matrix)
+
+    for row, data in pipe.light_chunks():
+        # Control lights with cached timing values if they exist
+        if row < len(cache_matrix):
+            matrix = cache_matrix[row]
+        else:
+            if row == len(cache_matrix) and row > 0:
+                log.info("Ran out of cached FFT values at row " + str(row) +
+                         ", will update the cache.")
+
+            # No cache - Compute FFT in this chunk, and cache results
+            matrix = fft_calc.calculate_levels(data)
+
+            # Add the matrix to the end of the cache
+            if row == next_row:
+                writer.append(matrix)
+                next_row += 1
+            elif next_row >= 0:
+                log.warning("Lights fell behind the audio at row " + str(next_row) +
+                            ", the sync file will be finished on a later play")
+                next_row = -1
+
+        if scheduler is not None:
+            brightness = light_levels(matrix, mean, std)
+            if server:
+                presentation = None
+                if lead:
+                    presentation = pipe.clock.time_of(row) + cm.audio_processing.light_delay
+                network.broadcast_levels(brightness, row * chunk_seconds, presentation)
+
+            # shows the frames up to a couple of chunks before this one
+            scheduler.add(row, brightness)
+            continue
+
+        if len(pending) == len(frames):
+            # fallen a whole buffer behind, the oldest frame is already late
+            pending.popleft()
+
+        brightness = light_levels(matrix, mean, std, frames[frame])
+        frame = (frame + 1) % len(frames)
+        if lead:
+            network.broadcast_levels(brightness, row * chunk_seconds,
+                                     pipe.clock.time_of(row + light_delay))
+        pending.append((row + light_delay, row, brightness))
+
+        # show the rows due by the time the audio reaches the row lead rows back
+        while pending and pending[0][0] <= row - lead:
+            show(*pending.popleft())
+
+    while pending:
+        show(*pending.popleft())
+
+    if scheduler is not None:
+        scheduler.finish()
 
 
 def play_song():
     """Play the next song from the play list (or --file argument)."""
 
+    start_control()
+    interrupt = control_server.interrupt if control_server is not None else None
+
     # get the next song to play
     song_filename, config_filename, cache_filename = get_song()
 
@@ -766,7 +1201,7 @@ def play_song():
     network.unset_playing()
 
     if not play_now:
-        result = PrePostShow('preshow', hc).execute()
+        result = PrePostShow('preshow', hc, interrupt).execute()
 
         if result == PrePostShow.play_now_interrupt:
             play_now = int(cm.get_state('play_now', "0"))
@@ -777,55 +1212,87 @@ def play_song():
     if play_now:
         cm.update_state('play_now', "0")
         play_now = 0
+        if interrupt is not None:
+            interrupt.clear()
 
     # setup audio file and output device
     output, fft_calc, music_file, light_delay = setup_audio(song_filename)
 
+    # sync files in the cache directory are named after the audio and fft configuration
+    if sync_store is not None:
+        cache_filename = sync_store.cache_filename(song_filename, fft_calc.get_config())
+
     # setup our cache_matrix, std, mean
-    cache_found, cache_matrix, std, mean = setup_cache(cache_filename, fft_calc)
+    cache_found, cache, std, mean = setup_cache(cache_filename, fft_calc)
 
-    matrix_buffer = deque([], 1000)
+    if cache is not None:
+        cache_matrix = cache.matrix
+    else:
+        cache_matrix = np.empty((0, hc.GPIOLEN), dtype='float32')
 
-    # Process audio song_filename
-    row = 0
-    data = music_file.readframes(CHUNK_SIZE)
+    # rows computed on this play are written to a partial cache as they are computed
+    writer = sync_cache.CacheWriter(cache_filename, hc.GPIOLEN, fft_calc.get_config(), cache)
 
-    while data != '' and not play_now:
-        # output data to sound device
-        output(data)
+    chunk_seconds = CHUNK_SIZE / float(music_file.getframerate())
 
-        # Control lights with cached timing values if they exist
-        matrix = None
-        if cache_found and args.readcache:
-            if row < len(cache_matrix):
-                matrix = cache_matrix[row]
-            else:
-                log.warning("Ran out of cached FFT values, will update the cache.")
-                cache_found = False
+    # decode and light stages run in their own threads, output runs here
+    pipe = pipeline.Pipeline(cm.audio_processing.decode_queue_depth,
+                             cm.audio_processing.light_queue_depth,
+                             cm.audio_processing.pipeline_cpus)
+    pipe.start(music_file, CHUNK_SIZE,
+               lambda p: light_stage(p, fft_calc, cache_matrix, writer,
+                                     mean, std, light_delay, chunk_seconds))
 
-        if matrix is None:
-            # No cache - Compute FFT in this chunk, and cache results
-            matrix = fft_calc.calculate_levels(data)
+    # analyze the next song in the background while this one plays
+    next_song = None
+    if cm.audio_processing.lookahead and args.readcache:
+        next_song = lookahead.Lookahead(precache_command,
+                                        lambda: predict_next_song(song_filename))
+        next_song.start()
+
+    try:
+        for row, data in pipe.chunks():
+            # output data to sound device
+            output(data)
+            pipe.clock.advance(row)
 
-            # Add the matrix to the end of the cache 
-            cache_matrix = np.vstack([cache_matrix, matrix])
+            # Load new application state in case we've been interrupted, the
+            # control thread updates it directly but check_sms falls back to
+            # the file if the control channel fails
+            cm.refresh_state()
+            play_now = int(cm.get_state('play_now', "0"))
 
-        matrix_buffer.appendleft(matrix)
+            if play_now:
+                break
+    except (KeyboardInterrupt, SystemExit):
+        # keep the rows computed so far for the next play
+        pipe.stop()
+        writer.close()
+        music_file.close()
+        if next_song is not None:
+            next_song.stop()
+        raise
 
-        if len(matrix_buffer) > light_delay:
-            matrix = matrix_buffer[light_delay]
-            update_lights(matrix, mean, std)
+    if play_now:
+        pipe.stop()
+    else:
+        pipe.finish()
 
-        # Read next chunk of data from music song_filename
-        data = music_file.readframes(CHUNK_SIZE)
-        row += 1
+    # whatever the next song is, its analysis so far is kept for its first play
+    if next_song is not None:
+        next_song.stop()
 
-        # Load new application state in case we've been interrupted
-        cm.load_state()
-        play_now = int(cm.get_state('play_now', "0"))
+    music_file.close()
 
-    if not cache_found:
-        save_cache(cache_matrix, cache_filename, fft_calc)
+    if writer.started:
+        if play_now or pipe.stop_event.is_set() or pipe.light_dropped:
+            # interrupted, or rows are missing, the next play resumes from the partial cache
+            writer.close()
+            if sync_store is not None:
+                sync_store.touch(sync_cache.partial_filename(writer.filename))
+            log.info("Partial sync data saved [" + str(len(writer)) + " rows]")
+        else:
+            save_cache(writer, fft_calc)
 
     # Cleanup the pifm process
     if cm.audio_processing.fm:
@@ -835,11 +1302,15 @@ def play_song():
     network.unset_playing()
 
     if not play_now:
-        PrePostShow('postshow', hc).execute()
+        PrePostShow('postshow', hc, interrupt).execute()
 
     # We're done, turn it all off and clean up things ;)
     hc.clean_up()
 
+    # until the next song is playing commands go to the state file
+    if control_server is not None:
+        control_server.close()
+
 
 def network_client():
     """Network client support
@@ -859,23 +1330,43 @@ def network_client():
         channels = network.channels
         channel_keys = channels.keys()
 
-        while True:
-            data = network.receive()
+        # frames are reordered and shown at their media time
+        jitter = jitter_buffer.JitterBuffer(cm.network.jitter_delay)
+        stats_time = time.time()
 
-            if isinstance(data[0], int):
-                pin = data[0]
-                if pin in channel_keys:
-                    hc.set_light(channels[pin], True, float(data[1]))
-                continue
+        while True:
+            packet = network.receive_packet(jitter.time_until_next())
+
+            # keep the clock synced to the server's
+            network.ping()
+
+            if packet is not None:
+                message_type, sequence, timestamp, presentation, pin, levels = packet
+
+                if message_type == networking.PIN:
+                    if pin in channel_keys:
+                        hc.set_light(channels[pin], True, float(levels[0]))
+                elif sequence is None:
+                    # legacy packets have no sequence number, show them now
+                    for pin in channel_keys:
+                        hc.set_light(channels[pin], True, levels[pin])
+                elif presentation and network.clock_sync.synchronized():
+                    # scheduled by the server, show it when the server does
+                    due = network.clock_sync.to_local(presentation)
+                    jitter.push(sequence, timestamp, levels,
+                                due + cm.audio_processing.light_delay)
+                else:
+                    jitter.push(sequence, timestamp, levels)
 
-            elif isinstance(data[0], np.ndarray):
-                blevels = data[0]
+            blevels = jitter.pop_due()
 
-            else:
-                continue
+            if blevels is not None:
+                for pin in channel_keys:
+                    hc.set_light(channels[pin], True, blevels[pin])
 
-            for pin in channel_keys:
-                hc.set_light(channels[pin], True, blevels[pin])
+            if time.time() - stats_time > 60:
+                stats_time = time.time()
+                log.info("network stats: " + str(jitter.stats()))
 
     except KeyboardInterrupt:
         log.info("CTRL<C> pressed, stopping")
@@ -886,6 +1377,11 @@ def network_client():
 
 
 if __name__ == "__main__":
+    if args.precache is not None:
+        lookahead.run_analysis(precache_song, song_paths(args.precache),
+                               cm.audio_processing.lookahead_cpu)
+        sys.exit()
+
     # Make sure one of --playlist or --file was specified
     if args.file is None and args.playlist is None:
         print "One of --playlist or --file must be specified"
@@ -0,0 +1,143 @@
+# check the fft backends against each other
+# run usage
+#
+# python fft_backend_check.py [-c CHANNELS] [-t TOLERANCE] [song ...]
+#
+# Computes the levels of every chunk of the songs (or of a few seconds
+# of generated noise and tones) with each fft backend that can be loaded,
+# rpi_audio_levels only loads on a Pi.
+#
+# For each backend the output shows the mean and standard deviation of
+# the levels of each channel, next to the 12 and 1.5 the show starts
+# from before it knows a song's own.  If both backends load it also
+# shows how far apart their levels are, before and after each is
+# normalized by its own mean and standard deviation as the show does,
+# so a constant scale between the backends does not count.
+#
+# The check fails, with exit status 1, if the normalized levels of any
+# chunk differ by more than TOLERANCE standard deviations, 0.1 unless
+# given.
+
+import argparse
+import os
+import sys
+import wave
+
+import numpy as np
+
+# the modules are loaded from the py directory next to this one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "py"))
+
+import fft
+
+CHUNK_SIZE = 2048
+SAMPLE_RATE = 44100
+
+# the show's estimate of the mean and std before a song's are known
+INITIAL_MEAN = 12.0
+INITIAL_STD = 1.5
+
+# largest difference in normalized levels allowed between the backends
+TOLERANCE = 0.1
+
+
+def generated_audio(seconds=10.0):
+    """Stereo noise with a few tones over it, as 16 bit samples"""
+    rng = np.random.RandomState(0)
+    t = np.arange(int(seconds * SAMPLE_RATE)) / float(SAMPLE_RATE)
+    audio = rng.normal(0.0, 2000.0, len(t))
+    for frequency in (60, 440, 2500, 9000):
+        audio += 4000.0 * np.sin(2 * np.pi * frequency * t) * (np.sin(t * frequency / 100.0) > 0)
+
+    audio = np.clip(audio, -32768, 32767).astype("<i2")
+    return np.repeat(audio, 2).tostring(), SAMPLE_RATE, 2
+
+
+def read_song(song_filename):
+    """Decode a song
+
+    :return: audio data, sample rate, number of channels
+    :rtype: tuple
+    """
+    if song_filename.endswith('.wav'):
+        music_file = wave.open(song_filename, 'r')
+    else:
+        import decoder
+        music_file = decoder.open(song_filename)
+
+    try:
+        data = music_file.readframes(music_file.getnframes())
+        return data, music_file.getframerate(), music_file.getnchannels()
+    finally:
+        music_file.close()
+
+
+def levels(backend, data, sample_rate, num_channels, channels):
+    """Levels of every chunk with one backend"""
+    fft_calc = fft.FFT(CHUNK_SIZE, sample_rate, channels, 20, 15000, 0, 0,
+                       num_channels, backend)
+    return fft_calc.calculate_levels_batch(data, num_channels)
+
+
+def normalized(matrix):
+    """Levels as the show uses them, scaled by their own mean and std"""
+    std = matrix.std(axis=0)
+    std[std == 0] = 1.0
+    return (matrix - matrix.mean(axis=0)) / std
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--channels', type=int, default=8,
+                        help='number of light channels')
+    parser.add_argument('-t', '--tolerance', type=float, default=TOLERANCE,
+                        help='largest difference in normalized levels allowed, '
+                             'in standard deviations')
+    parser.add_argument('songs', nargs='*',
+                        help='songs to analyze, default generated noise and tones')
+    args = parser.parse_args()
+
+    if args.songs:
+        sources = [(song, read_song(song)) for song in args.songs]
+    else:
+        sources = [("generated", generated_audio())]
+
+    backends = list(fft.BACKENDS.keys())
+    if "gpu" not in backends:
+        print("rpi_audio_levels is not available, only the numpy backend is checked")
+
+    failed = False
+
+    for name, (data, sample_rate, num_channels) in sources:
+        print(name)
+
+        results = dict()
+        for backend in backends:
+            matrix = levels(backend, data, sample_rate, num_channels, args.channels)
+            results[backend] = matrix
+
+            # chunks of silence are left at zero, and not counted by the show either
+            audible = matrix[np.any(matrix != 0.0, axis=1)]
+            print("  %-8s %8s %8s" % (backend, "mean", "std"))
+            for channel in range(args.channels):
+                print("  %8d %8.2f %8.2f" % (channel + 1, audible[:, channel].mean(),
+                                            audible[:, channel].std()))
+            print("  %8s %8.2f %8.2f" % ("initial", INITIAL_MEAN, INITIAL_STD))
+
+        if len(results) > 1:
+            gpu, numpy_levels = results["gpu"], results["numpy"]
+            print("  largest difference in levels:            %.4f" %
+                  np.abs(gpu - numpy_levels).max())
+            difference = np.abs(normalized(gpu) - normalized(numpy_levels)).max()
+            print("  largest difference in normalized levels: %.4f" % difference)
+
+            if difference > args.tolerance:
+                print("  FAILED, more than the tolerance of %.4f" % args.tolerance)
+                failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
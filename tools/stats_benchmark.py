@@ -0,0 +1,131 @@
+# micro-benchmark of the per chunk light calculations
+# run usage
+#
+# python stats_benchmark.py [-c CHANNELS] [-n FRAMES]
+#
+# Times RunningStats push / mean / std and the brightness calculation
+# for every chunk of audio, and with python 3 also shows what memory they
+# allocate once they are running.
+#
+# Allocations are measured with tracemalloc, which numpy reports its
+# arrays to.  The output shows how many frames allocated memory that was
+# still in use or was freed again during the frame, and the most bytes
+# allocated by one frame.
+#
+# python 2, which the show runs on, has no tracemalloc and no way to see
+# numpy's allocations, so there only the times are shown.  The modules
+# run unchanged on python 3, run the benchmark with it to check them.
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# the modules are loaded from the py directory next to this one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "py"))
+
+import brightness
+import RunningStats
+
+
+def make_frames(channels, count):
+    """Random fft levels, like those of a song"""
+    rng = np.random.RandomState(0)
+    return [rng.normal(12.0, 1.5, channels).astype('float32') for _ in range(count)]
+
+
+def stats_frame(stats):
+    """One chunk of audio-in, push the levels and read back mean and std"""
+    def run(frame):
+        stats.push(frame)
+        stats.mean()
+        stats.std()
+    return run
+
+
+def brightness_frame(channels, decay_factor):
+    """One chunk of playback, the brightness of every light"""
+    calc = brightness.Brightness(channels, decay_factor)
+    mean = np.full(channels, 12.0, dtype='float32')
+    std = np.full(channels, 1.5, dtype='float32')
+
+    def run(frame):
+        calc.compute(frame, mean, std)
+    return run
+
+
+def measure(run, frames):
+    """Time run over every frame, and record what each frame allocated
+
+    :return: seconds per frame, frames that allocated, most bytes allocated
+             by one frame, without tracemalloc the last two are None
+    :rtype: tuple
+    """
+    # warm up, buffers are allocated on first use
+    for frame in frames[:16]:
+        run(frame)
+
+    start = time.time()
+    for frame in frames:
+        run(frame)
+    elapsed = (time.time() - start) / len(frames)
+
+    if tracemalloc is None:
+        return elapsed, None, None
+
+    allocating = 0
+    most = 0
+    tracemalloc.start()
+    for frame in frames:
+        # forget earlier allocations so the peak covers this frame only
+        tracemalloc.clear_traces()
+        run(frame)
+        peak = tracemalloc.get_traced_memory()[1]
+        if peak:
+            allocating += 1
+            most = max(most, peak)
+    tracemalloc.stop()
+
+    return elapsed, allocating, most
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--channels', type=int, default=8,
+                        help='number of light channels')
+    parser.add_argument('-n', '--frames', type=int, default=5000,
+                        help='number of frames to run')
+    args = parser.parse_args()
+
+    frames = make_frames(args.channels, args.frames)
+
+    tests = [("Stats", stats_frame(RunningStats.Stats(args.channels))),
+             ("EwmaStats", stats_frame(RunningStats.EwmaStats(args.channels, 1000))),
+             ("WindowStats", stats_frame(RunningStats.WindowStats(args.channels, 1000))),
+             ("brightness", brightness_frame(args.channels, 0.0)),
+             ("brightness + decay", brightness_frame(args.channels, 0.02))]
+
+    if tracemalloc is None:
+        print("tracemalloc is not available, run with python 3 to measure allocations")
+        print("%-20s %12s" % ("", "usec/frame"))
+    else:
+        print("%-20s %12s %12s %12s" % ("", "usec/frame", "allocating", "max bytes"))
+
+    for name, run in tests:
+        elapsed, allocating, most = measure(run, frames)
+        if tracemalloc is None:
+            print("%-20s %12.2f" % (name, elapsed * 1e6))
+        else:
+            print("%-20s %12.2f %12s %12s" % (name, elapsed * 1e6,
+                                              "%d/%d" % (allocating, len(frames)), most))
+
+
+if __name__ == "__main__":
+    main()
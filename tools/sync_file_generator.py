@@ -1,20 +1,31 @@
 # sync file generator for lightshowpi
 # run usage
 #
-# python sync_file_generator.py
+# python sync_file_generator.py [-j JOBS] [--force] [--no-playlist] folder
 #
-# Enter y to confirm that you wish to run this
-# Enter the path to the folder containing your audio files
-# along with the sync files it will also generate a playlist file
-# enter the path to this playlist file in your overrides.cfg and 
-# lightshowpi will use this as your new playlist
+# Generates the sync files for every song in folder, using one process
+# per cpu core (or JOBS processes).  Songs whose sync file already
+# matches the current fft configuration, and whose audio has not changed
+# since it was generated, are skipped unless --force is given.
+#
+# If cache_dir is set in your configuration the sync files are written
+# there instead of next to each song.
+#
+# A playlist file is also generated in folder, enter the path to this
+# playlist file in your overrides.cfg and lightshowpi will use this as
+# your new playlist
 
+import argparse
+import ConfigParser
 import decoder
+import functools
 import glob
+import multiprocessing
 import mutagen
-import numpy as np
 import os
+import signal
 import sys
+import time
 import wave
 
 HOME_DIR = os.getenv("SYNCHRONIZED_LIGHTS_HOME")
@@ -32,152 +43,290 @@ sys.path.insert(0, HOME_DIR + "/py")
 
 # import the configuration_manager and fft now that we can
 import fft
-import configuration_manager as cm
+import cache_store
+import configuration_manager
+import sync_cache
 
 #### reusing code from synchronized_lights.py
 #### no need to reinvent the wheel
 
-_CONFIG = cm.CONFIG
-GPIOLEN = len([int(pin) for pin in _CONFIG.get('hardware', 
-                                               'gpio_pins').split(',')])
-_MIN_FREQUENCY = _CONFIG.getfloat('audio_processing', 'min_frequency')
-_MAX_FREQUENCY = _CONFIG.getfloat('audio_processing', 'max_frequency')
-
-try:
-    _CUSTOM_CHANNEL_MAPPING = \
-        [int(channel) for channel in _CONFIG.get('audio_processing',\
-            'custom_channel_mapping').split(',')]
-except:
-    _CUSTOM_CHANNEL_MAPPING = 0
-
-try:
-    _CUSTOM_CHANNEL_FREQUENCIES = [int(channel) for channel in
-                                   _CONFIG.get('audio_processing',
-                                               'custom_channel_frequencies').split(',')]
-except:
-    _CUSTOM_CHANNEL_FREQUENCIES = 0
+cm = configuration_manager.Configuration()
+GPIOLEN = cm.hardware.gpio_len
 
 CHUNK_SIZE = 2048  # Use a multiple of 8 (move this to config)
+BLOCK_CHUNKS = 256  # chunks decoded and analyzed at a time
+
+# central sync file directory, None to write sync files next to each song
+store = None
+if cm.audio_processing.cache_dir:
+    store = cache_store.CacheStore(cm.audio_processing.cache_dir,
+                                   cm.audio_processing.cache_dir_size)
+
+# section of the song's .cfg file that records the audio the sync file was made from
+SOURCE_SECTION = "sync_source"
+
 
-def calculate_channel_frequency(min_frequency,
-                                max_frequency,
-                                custom_channel_mapping,
-                                custom_channel_frequencies):
+def sync_filenames(song_filename):
+    """Names of the sync and config files for a song
+
+    :param song_filename: path / filename of the song
+    :type song_filename: str
+
+    :return: cache_filename, config_filename
+    :rtype: tuple
     """
-    Calculate frequency values
+    song_filename = os.path.abspath(song_filename)
+    cache_filename = \
+        os.path.dirname(song_filename) + "/." + os.path.basename(song_filename) + ".sync"
+
+    return cache_filename, cache_filename.replace(".sync", ".cfg")
+
+
+def make_fft(sample_rate):
+    """FFT calculator for a song with the current configuration
+
+    :param sample_rate: sample rate of the song
+    :type sample_rate: int
+
+    :rtype: fft.FFT
+    """
+    return fft.FFT(CHUNK_SIZE,
+                   sample_rate,
+                   GPIOLEN,
+                   cm.audio_processing.min_frequency,
+                   cm.audio_processing.max_frequency,
+                   cm.audio_processing.custom_channel_mapping,
+                   cm.audio_processing.custom_channel_frequencies)
+
+
+def open_song(song_filename):
+    """Open a song for decoding"""
+    if song_filename.endswith('.wav'):
+        return wave.open(song_filename, 'r')
 
-    Calculate frequency values for each channel,
-    taking into account custom settings.
+    return decoder.open(song_filename)
+
+
+def song_sample_rate(song_filename):
+    """Sample rate of a song, the decoder is only opened to read it"""
+    musicfile = open_song(song_filename)
+    try:
+        return musicfile.getframerate()
+    finally:
+        musicfile.close()
+
+
+def record_source(fft_calc, song_stat, sha1):
+    """Record the audio a sync file was made from in its .cfg, then save the .cfg"""
+    if not fft_calc.config.has_section(SOURCE_SECTION):
+        fft_calc.config.add_section(SOURCE_SECTION)
+    fft_calc.config.set(SOURCE_SECTION, "mtime", repr(song_stat.st_mtime))
+    fft_calc.config.set(SOURCE_SECTION, "size", str(song_stat.st_size))
+    fft_calc.config.set(SOURCE_SECTION, "sha1", sha1)
+
+    fft_calc.save_config()
+
+
+def is_up_to_date(song_filename):
+    """Check if a song's sync file can be reused
+
+    The sync file is current if its .cfg matches the current fft
+    configuration and the song has not changed since it was made.  The
+    song is only hashed when its size matches but its mtime does not,
+    if the contents are unchanged the new mtime is recorded.
+
+    Sync files written by synchronized_lights do not record the song, they
+    are current if they are newer than the song, which is then recorded.
+
+    In the cache directory a sync file is named after the song's audio
+    and the fft configuration, so it is current if it exists.
+
+    :param song_filename: path / filename of the song
+    :type song_filename: str
+
+    :rtype: bool
     """
+    if store is not None:
+        fft_calc = make_fft(song_sample_rate(song_filename))
+        return store.contains(store.cache_filename(song_filename, fft_calc.get_config()))
+
+    cache_filename, config_filename = sync_filenames(song_filename)
+
+    if not (os.path.isfile(cache_filename) and os.path.isfile(config_filename)):
+        return False
+
+    config = ConfigParser.RawConfigParser(allow_no_value=True)
+    try:
+        with open(config_filename) as config_fp:
+            config.readfp(config_fp)
+
+        sample_rate = config.getint("fft", "sample_rate")
+    except (ConfigParser.Error, ValueError):
+        return False
+
+    # an unchanged song has the same sample rate it was cached with
+    fft_calc = make_fft(sample_rate)
+    if not fft_calc.compare_config(cache_filename):
+        return False
+
+    song_stat = os.stat(song_filename)
+
+    if not config.has_section(SOURCE_SECTION):
+        # written by the player as the song played
+        if os.path.getmtime(cache_filename) < song_stat.st_mtime:
+            return False
+
+        record_source(fft_calc, song_stat, cache_store.file_hash(song_filename))
+        return True
+
+    try:
+        mtime = config.getfloat(SOURCE_SECTION, "mtime")
+        size = config.getint(SOURCE_SECTION, "size")
+        sha1 = config.get(SOURCE_SECTION, "sha1")
+    except (ConfigParser.Error, ValueError):
+        return False
+
+    if song_stat.st_size != size:
+        return False
+    if song_stat.st_mtime == mtime:
+        return True
+    if cache_store.file_hash(song_filename) != sha1:
+        return False
+
+    fft_calc.config.set(SOURCE_SECTION, "mtime", repr(song_stat.st_mtime))
+    fft_calc.save_config()
+
+    return True
 
-    # How many channels do we need to calculate the frequency for
-    if custom_channel_mapping != 0 and len(custom_channel_mapping) == GPIOLEN:
-        channel_length = max(custom_channel_mapping)
-    else:
-        channel_length = GPIOLEN
-
-    octaves = (np.log(max_frequency / min_frequency)) / np.log(2)
-    octaves_per_channel = octaves / channel_length
-    frequency_limits = []
-    frequency_store = []
-
-    frequency_limits.append(min_frequency)
-    if custom_channel_frequencies != 0 and (len(custom_channel_frequencies)
-                                            >= channel_length + 1):
-        frequency_limits = custom_channel_frequencies
-    else:
-        for i in range(1, GPIOLEN + 1):
-            frequency_limits.append(frequency_limits[-1]
-                                    * 10 ** (3 /
-                                             (10 * (1 / octaves_per_channel))))
-    for i in range(0, channel_length):
-        frequency_store.append((frequency_limits[i], frequency_limits[i + 1]))
-
-    # we have the frequencies now lets map them if custom mapping is defined
-    if custom_channel_mapping != 0 and len(custom_channel_mapping) == GPIOLEN:
-        frequency_map = []
-        for i in range(0, GPIOLEN):
-            mapped_channel = custom_channel_mapping[i] - 1
-            mapped_frequency_set = frequency_store[mapped_channel]
-            mapped_frequency_set_low = mapped_frequency_set[0]
-            mapped_frequency_set_high = mapped_frequency_set[1]
-            frequency_map.append(mapped_frequency_set)
-        return frequency_map
-    else:
-        return frequency_store
 
 def cache_song(song_filename):
-    """Play the next song from the play list (or --file argument)."""
-    # Initialize FFT stats
-    matrix = [0 for _ in range(GPIOLEN)] # get length of gpio and assign it to a variable
+    """Generate the sync file for a song
+
+    :param song_filename: path / filename of the song
+    :type song_filename: str
+
+    :return: seconds of audio analyzed
+    :rtype: float
+    """
+    song_stat = os.stat(song_filename)
 
     # Set up audio
-    if song_filename.endswith('.wav'):
-        musicfile = wave.open(song_filename, 'r')
-    else:
-        musicfile = decoder.open(song_filename)
+    musicfile = open_song(song_filename)
 
-    sample_rate = musicfile.getframerate()
-    num_channels = musicfile.getnchannels()
+    try:
+        sample_rate = musicfile.getframerate()
+        num_channels = musicfile.getnchannels()
 
-    song_filename = os.path.abspath(song_filename)
+        fft_calc = make_fft(sample_rate)
 
-    # create empty array for the cache_matrix
-    cache_matrix = np.empty(shape=[0, GPIOLEN])
-    cache_filename = \
-        os.path.dirname(song_filename) + "/." + os.path.basename(song_filename) + ".sync"
+        # preallocated buffer for the cache_matrix, one row per chunk
+        cache_rows = sync_cache.MatrixBuffer(GPIOLEN, musicfile.getnframes() / CHUNK_SIZE + 1)
+
+        # hash the audio before it is read, so the sync file is never
+        # recorded against audio it was not made from
+        if store is not None:
+            cache_filename = store.cache_filename(song_filename, fft_calc.get_config())
+        else:
+            cache_filename, _ = sync_filenames(song_filename)
+            sha1 = cache_store.file_hash(song_filename)
+
+        # Process audio song_filename, a block of chunks at a time
+        data = musicfile.readframes(CHUNK_SIZE * BLOCK_CHUNKS)
 
-    # The values 12 and 1.5 are good estimates for first time playing back 
-    # (i.e. before we have the actual mean and standard deviations 
-    # calculated for each channel).
-    mean = [12.0 for _ in range(GPIOLEN)]
-    std = [1.5 for _ in range(GPIOLEN)]
+        while data != '':
+            # Compute FFT of every chunk in this block, and cache results
+            cache_rows.extend(fft_calc.calculate_levels_batch(data, num_channels))
 
-    # Process audio song_filename
-    row = 0
-    data = musicfile.readframes(CHUNK_SIZE) # move chunk_size to configuration_manager
-    frequency_limits = calculate_channel_frequency(_MIN_FREQUENCY,
-                                                   _MAX_FREQUENCY,
-                                                   _CUSTOM_CHANNEL_MAPPING,
-                                                   _CUSTOM_CHANNEL_FREQUENCIES)
+            # Read next block of data from music song_filename
+            data = musicfile.readframes(CHUNK_SIZE * BLOCK_CHUNKS)
+    finally:
+        musicfile.close()
 
-    while data != '':
-        # No cache - Compute FFT in this chunk, and cache results
-        matrix = fft.calculate_levels(data, CHUNK_SIZE, sample_rate, frequency_limits, GPIOLEN)
+    cache_matrix = cache_rows.view()
 
-        # Add the matrix to the end of the cache 
-        cache_matrix = np.vstack([cache_matrix, matrix])
+    # standard deviation and mean values, kept as the rows were added
+    std, mean = cache_rows.stats.std(), cache_rows.stats.mean()
 
-        # Read next chunk of data from music song_filename
-        data = musicfile.readframes(CHUNK_SIZE)
-        row = row + 1
+    # Save the cache in the binary sync format along with the fft config
+    sync_cache.write(cache_filename, cache_matrix, std, mean, fft_calc.get_config())
 
-    # Compute the standard deviation and mean values for the cache
-    for i in range(0, GPIOLEN):
-        std[i] = np.std([item for item in cache_matrix[:, i] if item > 0])
-        mean[i] = np.mean([item for item in cache_matrix[:, i] if item > 0])
+    audio_seconds = len(cache_matrix) * CHUNK_SIZE / float(sample_rate)
 
-    # Add mean and std to the top of the cache
-    cache_matrix = np.vstack([mean, cache_matrix])
-    cache_matrix = np.vstack([std, cache_matrix])
+    if store is not None:
+        # record the new sync file, making room for it if needed
+        store.touch(cache_filename, song_filename)
+        return audio_seconds
 
-    # Save the cache using numpy savetxt
-    np.savetxt(cache_filename, cache_matrix)
+    # load any existing .cfg first so custom sections are kept
+    fft_calc.compare_config(cache_filename)
+
+    # record the audio the sync file was made from
+    record_source(fft_calc, song_stat, sha1)
+
+    return audio_seconds
 
 #### end reuse 
 
-def main():        
-    print "Do you want to generating sync files"
-    print 
-    print "This could take a while if you have a lot of songs"
 
-    question = raw_input("Would you like to proceed? (Y to continue) :")
+def init_worker():
+    """Leave CTRL<C> to the main process"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def process_song(song_filename, force=False):
+    """Generate the sync file for a song unless it is up to date
 
-    if not question in ["y", "Y"]:
-        sys.exit(0)
+    Runs in a worker process, errors are returned instead of raised so
+    one bad song does not stop the others.
 
-    location = raw_input("Enter the path to the folder of songs:")
-    location += "/"
+    :param song_filename: path / filename of the song
+    :type song_filename: str
+
+    :param force: generate the sync file even if it is up to date
+    :type force: bool
+
+    :return: song_filename, status, seconds of audio, seconds taken
+    :rtype: tuple
+    """
+    start = time.time()
+
+    try:
+        if not force and is_up_to_date(song_filename):
+            return song_filename, "skipped", 0.0, time.time() - start
+
+        audio_seconds = cache_song(song_filename)
+    except Exception as error:
+        reason = error.__class__.__name__ + ": " + str(error)
+        return song_filename, "failed (" + reason + ")", 0.0, time.time() - start
+
+    return song_filename, "generated", audio_seconds, time.time() - start
+
+
+def song_title(song_filename):
+    """Title for the playlist, from the song's tags or its filename"""
+    metadata = mutagen.File(song_filename, easy=True)
+    if metadata is not None and "title" in metadata:
+        return metadata["title"][0]
+
+    title = os.path.splitext(os.path.basename(song_filename))[0].strip()
+    title = title.replace("_", " ")
+    title = title.replace("-", " - ")
+
+    return title
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate sync files for a folder of songs")
+    parser.add_argument("folder", help="path to the folder of songs")
+    parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(),
+                        help="number of songs to process at once (default: one per cpu core)")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="regenerate sync files that are already up to date")
+    parser.add_argument("--no-playlist", action="store_true",
+                        help="do not write a playlist file")
+    args = parser.parse_args()
+
+    location = os.path.abspath(args.folder) + "/"
 
     sync_list = list()
     audio_file_types = ["*.mp3", "*.mp4",
@@ -188,28 +337,61 @@ def main():
 
     for file_type in audio_file_types:
         sync_list.extend(glob.glob(location + file_type))
+    sync_list.sort()
+
+    if not sync_list:
+        print "No songs found in", location
+        sys.exit(1)
+
+    total = len(sync_list)
+    counts = {"generated": 0, "skipped": 0, "failed": 0}
+    audio_total = 0.0
+    start = time.time()
+
+    print "Generating sync files for", total, "songs using", max(args.jobs, 1), "processes"
+
+    pool = multiprocessing.Pool(max(args.jobs, 1), init_worker)
+    results = pool.imap_unordered(functools.partial(process_song, force=args.force), sync_list)
+
+    try:
+        for done in range(1, total + 1):
+            # a timeout keeps the wait interruptible by CTRL<C>
+            song, status, audio_seconds, elapsed = results.next(0xFFFF)
+
+            counts[status.split()[0]] += 1
+            audio_total += audio_seconds
+
+            line = "[%*d/%d] %-9s %s" % (len(str(total)), done, total, status.split()[0],
+                                         os.path.basename(song))
+            if audio_seconds:
+                line += " (%.0fs of audio in %.1fs)" % (audio_seconds, elapsed)
+            elif status.startswith("failed"):
+                line += " " + status[len("failed "):]
+            print line
+    except KeyboardInterrupt:
+        pool.terminate()
+        pool.join()
+        print "stopped"
+        sys.exit(1)
+
+    pool.close()
+    pool.join()
+
+    elapsed = time.time() - start
+    print
+    print "All Finished in %.1fs: %d generated, %d skipped, %d failed" % \
+        (elapsed, counts["generated"], counts["skipped"], counts["failed"])
+    if audio_total:
+        print "Analyzed %.0fs of audio, %.1fx realtime" % (audio_total, audio_total / elapsed)
+
+    if not args.no_playlist:
+        with open(location + "playlist", "w") as playlist_fp:
+            for song in sync_list:
+                playlist_fp.write(song_title(song) + "\t" + song + "\n")
+
+        print "A playlist was also generated"
+        print location + "playlist"
 
-    playlistFile = open(location + "playlist", "w")
-
-    for song in sync_list:
-        print "Generating sync file for",song
-        cache_song(song)
-        print "cached"
-
-        metadata = mutagen.File(song, easy=True)
-        if "title" in metadata:
-            title = metadata["title"][0]
-        else:
-            title = os.path.splitext(os.path.basename(song))[0].strip()
-            title = title.replace("_", " ")
-            title = title.replace("-", " - ")
-        playlistFile.write(title + "\t" + song + "\n")
-
-    playlistFile.close()
-
-    print "All Finished."
-    print "A playlist was also generated"
-    print location + "playlist"
     sys.path[:] = path
 
 if __name__ == "__main__":